@@ -5,7 +5,7 @@ from detectron2.config import configurable
 from detectron2.modeling import GeneralizedRCNN
 from detectron2.utils.registry import Registry
 
-from aldi.helpers import SaveIO, grad_reverse
+from aldi.helpers import SaveIO, capture, grad_reverse
 
 
 ALIGN_MIXIN_REGISTRY = Registry("ALIGN_MIXIN")
@@ -41,15 +41,15 @@ class AlignMixin(GeneralizedRCNN):
         self.img_align = ConvDiscriminator(img_da_input_dim, hidden_dims=img_da_hidden_dims) if img_da_enabled else None
         self.ins_align = FCDiscriminator(ins_da_input_dim, hidden_dims=ins_da_hidden_dims) if ins_da_enabled else None 
 
-        # register hooks so we can grab output of sub-modules
-        self.backbone_io, self.rpn_io, self.roih_io, self.boxhead_io = SaveIO(), SaveIO(), SaveIO(), SaveIO()
-        self.backbone.register_forward_hook(self.backbone_io)
-        self.proposal_generator.register_forward_hook(self.rpn_io)
-        self.roi_heads.register_forward_hook(self.roih_io)
-
+        # register hooks so we can grab output of sub-modules (only saved within forward passes that do alignment)
+        self.backbone_io = SaveIO() if img_da_enabled else None
+        self.boxhead_io = SaveIO() if ins_da_enabled else None
+        self.align_hook_handles = []
+        if img_da_enabled:
+            self.align_hook_handles.append(self.backbone.register_forward_hook(self.backbone_io))
         if ins_da_enabled:
             assert hasattr(self.roi_heads, 'box_head'), "Instance alignment only implemented for ROI Heads with box_head."
-            self.roi_heads.box_head.register_forward_hook(self.boxhead_io)
+            self.align_hook_handles.append(self.roi_heads.box_head.register_forward_hook(self.boxhead_io))
 
     @classmethod
     def from_config(cls, cfg):
@@ -68,36 +68,45 @@ class AlignMixin(GeneralizedRCNN):
 
         return ret
 
+    def remove_alignment(self):
+        """Remove the alignment heads and the hooks that capture their inputs (e.g. for an inference-only teacher)."""
+        for handle in self.align_hook_handles:
+            handle.remove()
+        self.align_hook_handles = []
+        self.img_align, self.ins_align = None, None
+        self.backbone_io, self.boxhead_io = None, None
+
     def forward(self, *args, do_align=False, labeled=True, **kwargs):
-        output = super().forward(*args, **kwargs)
-        if self.training:
-            if do_align:
-                # extract needed info for alignment: domain labels, image features, instance features
-                domain_label = 1 if labeled else 0
-                img_features = list(self.backbone_io.output.values())
-                device = img_features[0].device
-                if self.img_align:
-                    features = self.backbone_io.output
-                    features = grad_reverse(features[self.img_da_layer])
-                    domain_preds = self.img_align(features)
-                    loss = F.binary_cross_entropy_with_logits(domain_preds, torch.FloatTensor(domain_preds.data.size()).fill_(domain_label).to(device))
-                    output["loss_da_img"] = self.img_da_weight * loss
-                if self.ins_align:
-                    instance_features = self.boxhead_io.output
-                    features = grad_reverse(instance_features)
-                    domain_preds = self.ins_align(features)
-                    loss = F.binary_cross_entropy_with_logits(domain_preds, torch.FloatTensor(domain_preds.data.size()).fill_(domain_label).to(device))
-                    output["loss_da_ins"] = self.ins_da_weight * loss
-            elif self.img_align or self.ins_align:
-                # need to utilize the modules at some point during the forward pass or PyTorch complains.
-                # this is only an issue when cfg.SOLVER.BACKWARD_AT_END=False, because intermediate backward()
-                # calls may not have used alignment heads
-                # see: https://github.com/pytorch/pytorch/issues/43259#issuecomment-964284292
-                fake_output = 0
-                for aligner in [self.img_align, self.ins_align]:
-                    if aligner is not None:
-                        fake_output += sum([p.sum() for p in aligner.parameters()]) * 0
-                output["_da"] = fake_output
+        # the sub-module outputs needed for alignment are released as soon as the alignment losses are computed
+        with capture(self.backbone_io, self.boxhead_io, enabled=self.training and do_align):
+            output = super().forward(*args, **kwargs)
+            if self.training:
+                if do_align:
+                    # extract needed info for alignment: domain labels, image features, instance features
+                    domain_label = 1 if labeled else 0
+                    device = self.device
+                    if self.img_align:
+                        features = self.backbone_io.output
+                        features = grad_reverse(features[self.img_da_layer])
+                        domain_preds = self.img_align(features)
+                        loss = F.binary_cross_entropy_with_logits(domain_preds, torch.FloatTensor(domain_preds.data.size()).fill_(domain_label).to(device))
+                        output["loss_da_img"] = self.img_da_weight * loss
+                    if self.ins_align:
+                        instance_features = self.boxhead_io.output
+                        features = grad_reverse(instance_features)
+                        domain_preds = self.ins_align(features)
+                        loss = F.binary_cross_entropy_with_logits(domain_preds, torch.FloatTensor(domain_preds.data.size()).fill_(domain_label).to(device))
+                        output["loss_da_ins"] = self.ins_da_weight * loss
+                elif self.img_align or self.ins_align:
+                    # need to utilize the modules at some point during the forward pass or PyTorch complains.
+                    # this is only an issue when cfg.SOLVER.BACKWARD_AT_END=False, because intermediate backward()
+                    # calls may not have used alignment heads
+                    # see: https://github.com/pytorch/pytorch/issues/43259#issuecomment-964284292
+                    fake_output = 0
+                    for aligner in [self.img_align, self.ins_align]:
+                        if aligner is not None:
+                            fake_output += sum([p.sum() for p in aligner.parameters()]) * 0
+                    output["_da"] = fake_output
         return output
 
 class ConvDiscriminator(torch.nn.Module):
@@ -1,4 +1,6 @@
-from functools import partial
+import copy
+from functools import lru_cache, partial
+import logging
 import math
 import warnings
 import torch
@@ -9,42 +11,187 @@ import torch.nn.functional as F
 from detectron2 import model_zoo
 from detectron2.config import instantiate
 from detectron2.modeling.backbone import Backbone
-from detectron2.modeling.backbone.vit import get_vit_lr_decay_rate
+from detectron2.modeling.backbone.vit import Attention, get_vit_lr_decay_rate
 from detectron2.modeling.backbone.build import BACKBONE_REGISTRY
-from detectron2.modeling.backbone.utils import get_abs_pos
+from detectron2.modeling.backbone.utils import get_abs_pos, get_rel_pos
 from detectron2.modeling.backbone.fpn import FPN, LastLevelMaxPool
 from detectron2.layers import ShapeSpec
 
+from aldi.memory import PeakMemoryMeter
+
+
+class ViTCheckpointPolicy:
+    """Chooses which blocks of a ViT to checkpoint during training. One of:
+    - "all": every block
+    - "every_k": every k-th block
+    - "global": only the global attention blocks (i.e. not in window_block_indexes), which use the most memory
+    - "budget": as few blocks as possible (global attention blocks first) so that the activations of the blocks 
+      that are not checkpointed fit in budget_bytes. The activation memory of one windowed and one global 
+      attention block is measured on the first input, and scaled linearly with the number of tokens for
+      other input sizes. With explicit attention, the attention weights of global blocks grow quadratically
+      with the number of tokens per image, so larger images may exceed the budget (see cfg.VIT.USE_SDPA).
+    """
+    POLICIES = ["all", "every_k", "global", "budget"]
+
+    def __init__(self, policy="all", every_k=2, budget_bytes=0):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown activation checkpointing policy {policy}; must be one of {self.POLICIES}.")
+        self.policy = policy
+        self.every_k = every_k
+        self.budget_bytes = budget_bytes
+        self._bytes_per_token = None # is global attention block -> measured activation bytes per token
+        self._budget_choices = {} # number of tokens -> blocks to checkpoint
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(cfg.VIT.ACT_CHECKPOINT_POLICY, cfg.VIT.ACT_CHECKPOINT_EVERY_K, cfg.VIT.ACT_CHECKPOINT_MEMORY_BUDGET_MB * 2**20)
+
+    def select(self, blocks, x):
+        """Return (indices of blocks to checkpoint, indices of blocks to measure) for input x."""
+        all_blocks = set(range(len(blocks)))
+        if self.policy == "all":
+            return all_blocks, set()
+        if self.policy == "every_k":
+            return { i for i in all_blocks if i % self.every_k == self.every_k - 1 }, set()
+        is_global = [blk.window_size == 0 for blk in blocks]
+        if self.policy == "global":
+            return { i for i in all_blocks if is_global[i] }, set()
+        if self._bytes_per_token is not None:
+            return self._choose(blocks, _num_tokens(x)), set()
+        # first block of each kind is measured without checkpointing
+        to_measure = { is_global.index(g) for g in set(is_global) }
+        return all_blocks - to_measure, to_measure
+
+    def record(self, blocks, x, measured):
+        """Record {block index: measured activation bytes} of the blocks measured for input x."""
+        is_global = [blk.window_size == 0 for blk in blocks]
+        self._bytes_per_token = { is_global[i]: peak / _num_tokens(x) for i, peak in measured.items() }
+        checkpointed = self._choose(blocks, _num_tokens(x))
+        logging.getLogger(__name__).info(f"Checkpointing {len(checkpointed)} of {len(blocks)} ViT blocks for input shape "
+                                         f"{tuple(x.shape)} (measured {[m // 2**20 for m in measured.values()]} MB per block).")
+
+    def _choose(self, blocks, num_tokens):
+        """Choose blocks to checkpoint for inputs with num_tokens tokens, from the measured memory per token."""
+        if num_tokens not in self._budget_choices:
+            memory = [self._bytes_per_token[blk.window_size == 0] * num_tokens for blk in blocks]
+            checkpointed, total = set(), sum(memory)
+            for i in sorted(range(len(blocks)), key=lambda i: -memory[i]):
+                if total <= self.budget_bytes:
+                    break
+                checkpointed.add(i)
+                total -= memory[i]
+            self._budget_choices[num_tokens] = checkpointed
+        return self._budget_choices[num_tokens]
+
+
+def _num_tokens(x):
+    """Number of tokens in a batch of ViT inputs (N, H, W, C)."""
+    return x.numel() // x.shape[-1]
 
 # TODO: hacky: patch forward method of the ViT backbone to enable
 # vanilla PyTorch non-reantrant checkpointing which works with DDP
-def checkpointed_vit_forward(self, use_checkpointing, x):
+def checkpointed_vit_forward(self, use_checkpointing, x, policy=None):
     x = self.patch_embed(x)
     if self.pos_embed is not None:
         x = x + get_abs_pos(
             self.pos_embed, self.pretrain_use_cls_token, (x.shape[1], x.shape[2])
         )
 
-    for blk in self.blocks:
-        if use_checkpointing and self.training:
+    # no checkpointing in eval mode or without gradients (e.g. for the EMA teacher)
+    checkpointed, measured = set(), {}
+    if use_checkpointing and self.training and torch.is_grad_enabled():
+        policy = policy or ViTCheckpointPolicy()
+        checkpointed, to_measure = policy.select(self.blocks, x)
+    else:
+        to_measure = set()
+
+    block_input = x
+    for i, blk in enumerate(self.blocks):
+        if i in checkpointed:
             x = checkpoint(blk, x, use_reentrant=False)
+        elif i in to_measure:
+            with PeakMemoryMeter(x.device) as meter:
+                x = blk(x)
+            measured[i] = meter.peak
         else:
             x = blk(x)
+    if measured:
+        policy.record(self.blocks, block_input, measured)
 
     outputs = {self._out_features[0]: x.permute(0, 3, 1, 2)}
     return outputs
 
+class SDPAAttention(Attention):
+    """detectron2.modeling.backbone.vit.Attention computed with torch's fused scaled_dot_product_attention.
+    The decomposed relative position terms are folded into the queries and keys (see fold_decomposed_rel_pos),
+    so neither the attention matrix nor an (N, N) attention bias is materialized."""
+    def forward(self, x):
+        B, H, W, _ = x.shape
+        # q, k, v with shape (B, nHead, H * W, C)
+        q, k, v = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4).unbind(0)
+        dim = v.shape[-1]
+
+        if self.use_rel_pos:
+            q, k, v = fold_decomposed_rel_pos(q, k, v, self.scale, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
+        else:
+            q = q * self.scale
+
+        x = F.scaled_dot_product_attention(q, k, v, scale=1.0)[..., :dim]
+        x = x.reshape(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        x = self.proj(x)
+        return x
+
+def fold_decomposed_rel_pos(q, k, v, scale, rel_pos_h, rel_pos_w, q_size, k_size):
+    """Returns q, k, v such that softmax(q @ k^T) @ v, truncated to the original channels of v, is the scaled
+    attention with decomposed relative positions of detectron2.modeling.backbone.utils.add_decomposed_rel_pos:
+    the relative position terms of each query are appended to it, and each key gets one-hot encodings of its
+    row and column. All three are zero-padded to the same number of channels, a multiple of 8, as required by
+    the fused attention kernels."""
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+    Rh = get_rel_pos(q_h, k_h, rel_pos_h)
+    Rw = get_rel_pos(q_w, k_w, rel_pos_w)
+
+    B, num_heads, _, dim = q.shape
+    r_q = q.reshape(B, num_heads, q_h, q_w, dim)
+    rel_h = torch.einsum("bnhwc,hkc->bnhwk", r_q, Rh).reshape(B, num_heads, q_h * q_w, k_h)
+    rel_w = torch.einsum("bnhwc,wkc->bnhwk", r_q, Rw).reshape(B, num_heads, q_h * q_w, k_w)
+    q = torch.cat([q * scale, rel_h.to(q.dtype), rel_w.to(q.dtype)], dim=-1)
+
+    rows = F.one_hot(torch.arange(k_h, device=k.device).repeat_interleave(k_w), k_h).to(k.dtype)
+    cols = F.one_hot(torch.arange(k_w, device=k.device).repeat(k_h), k_w).to(k.dtype)
+    k = torch.cat([k, rows.expand(B, num_heads, -1, -1), cols.expand(B, num_heads, -1, -1)], dim=-1)
+
+    pad = -q.shape[-1] % 8
+    return F.pad(q, (0, pad)), F.pad(k, (0, pad)), F.pad(v, (0, q.shape[-1] + pad - dim))
+
+def patch_vit_attention(net, cfg):
+    if cfg.VIT.USE_SDPA:
+        for blk in net.blocks:
+            blk.attn.__class__ = SDPAAttention
+
+@lru_cache(maxsize=None)
+def _model_zoo_config(path):
+    return model_zoo.get_config(path)
+
+def get_model_zoo_config(path):
+    """Same as detectron2.model_zoo.get_config, but each config file is only parsed once.
+    Returns a copy that can be modified."""
+    return copy.deepcopy(_model_zoo_config(path))
+
 @BACKBONE_REGISTRY.register()
 def build_vitdet_b_backbone(cfg, input_shape):
-    backbone = model_zoo.get_config("common/models/mask_rcnn_vitdet.py").model.backbone
+    backbone = get_model_zoo_config("common/models/mask_rcnn_vitdet.py").model.backbone
     backbone.square_pad = 0 # disable square padding
     backbone = instantiate(backbone)
-    backbone.net.forward = partial(checkpointed_vit_forward, backbone.net, cfg.VIT.USE_ACT_CHECKPOINT)
+    backbone.net.forward = partial(checkpointed_vit_forward, backbone.net, cfg.VIT.USE_ACT_CHECKPOINT,
+                                   policy=ViTCheckpointPolicy.from_config(cfg))
+    patch_vit_attention(backbone.net, cfg)
     return backbone
 
 @BACKBONE_REGISTRY.register()
 def build_vitdet_l_backbone(cfg, input_shape):
-    backbone = model_zoo.get_config("common/models/mask_rcnn_vitdet.py").model.backbone
+    backbone = get_model_zoo_config("common/models/mask_rcnn_vitdet.py").model.backbone
     backbone.square_pad = 0 # disable square padding
 
     # ViT-L stuff
@@ -59,13 +206,15 @@ def build_vitdet_l_backbone(cfg, input_shape):
 
     backbone = instantiate(backbone)
 
-    backbone.net.forward = partial(checkpointed_vit_forward, backbone.net, cfg.VIT.USE_ACT_CHECKPOINT)
+    backbone.net.forward = partial(checkpointed_vit_forward, backbone.net, cfg.VIT.USE_ACT_CHECKPOINT,
+                                   policy=ViTCheckpointPolicy.from_config(cfg))
+    patch_vit_attention(backbone.net, cfg)
    
     return backbone
 
 def get_adamw_optim(model, params={}, include_vit_lr_decay=False, vit_size='b'):
     """See detectron2/projects/ViTDet/configs/COCO/mask_rcnn_vitdet_b_100ep.py"""
-    optimizer = model_zoo.get_config("common/optim.py").AdamW
+    optimizer = get_model_zoo_config("common/optim.py").AdamW
     # From VitDet paper: We also use a layer-wise lr decay [10][2] of 0.7/0.8/0.9 for ViT-B/L/H with 
     # MAE pre-training, which has a small gain of up to 0.3 AP; **we have not seen this gain for 
     # hierarchical backbones or ViT with supervised pre-training.**
@@ -190,7 +339,8 @@ class ConvNextBlock(nn.Module):
     r""" ConvNeXt Block. There are two equivalent implementations:
     (1) DwConv -> LayerNorm (channels_first) -> 1x1 Conv -> GELU -> 1x1 Conv; all in (N, C, H, W)
     (2) DwConv -> Permute to (N, H, W, C); LayerNorm (channels_last) -> Linear -> GELU -> Linear; Permute back
-    We use (2) as we find it slightly faster in PyTorch
+    We use (2) as we find it slightly faster in PyTorch. With channels_last memory format inputs,
+    the permutes are free (no copies are made).
     
     Args:
         dim (int): Number of input channels.
@@ -236,10 +386,21 @@ class ConvNeXt(Backbone):
         layer_scale_init_value (float): Init value for Layer Scale. Default: 1e-6.
         head_init_scale (float): Init scaling value for classifier weights and biases. Default: 1.
         out_features (tuple(int)): Stage numbers of the outputs given to the Neck.
+        channels_last (bool): Use channels_last memory format for weights, activations and outputs. Default: False
+        act_checkpoint (str): Activation checkpointing during training: "none", "stage" (checkpoint each stage as
+            a whole) or "block" (checkpoint each block). Uses non-reentrant checkpointing, which works with DDP
+            and replays the same DropPath masks. Default: "none"
+        act_checkpoint_stages (tuple(int)): Stages to apply activation checkpointing to. Default: all
     """
     def __init__(self, in_chans=3, depths=[3, 3, 9, 3], dims=[96, 192, 384, 768], 
-                 drop_path_rate=0., layer_scale_init_value=1e-6, out_features=None):
+                 drop_path_rate=0., layer_scale_init_value=1e-6, out_features=None, channels_last=False,
+                 act_checkpoint="none", act_checkpoint_stages=(0, 1, 2, 3)):
         super().__init__()
+        self.channels_last = channels_last
+        if act_checkpoint not in ["none", "stage", "block"]:
+            raise ValueError(f"Unknown activation checkpointing mode {act_checkpoint}.")
+        self.act_checkpoint = act_checkpoint
+        self.act_checkpoint_stages = act_checkpoint_stages
 
         self.downsample_layers = nn.ModuleList() # stem and 3 intermediate downsampling conv layers
         stem = nn.Sequential(
@@ -286,6 +447,8 @@ class ConvNeXt(Backbone):
             self.add_module(layer_name, layer)
 
         self.apply(self._init_weights)
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
 
     def _init_weights(self, m):
         if isinstance(m, (nn.Conv2d, nn.Linear)):
@@ -311,19 +474,30 @@ class ConvNeXt(Backbone):
         self.apply(_init_weights)
 
     def forward_features(self, x):
+        memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+        x = x.contiguous(memory_format=memory_format)
         outs ={} 
         for i in range(4):
             x = self.downsample_layers[i](x)
-            x = self.stages[i](x)
+            x = self._forward_stage(i, x)
             if i in self._out_features:
                 norm_layer = getattr(self, f'norm{i}')
                 x_out = norm_layer(x)
-                out = x_out.contiguous()
+                out = x_out.contiguous(memory_format=memory_format)
                 stage_name = i
                 outs[stage_name] = out
 
         return outs  # {"stage%d" % (i+2,): out for i, out in enumerate(outs)} #tuple(outs)
 
+    def _forward_stage(self, i, x):
+        if self.act_checkpoint == "none" or i not in self.act_checkpoint_stages or not (self.training and torch.is_grad_enabled()):
+            return self.stages[i](x)
+        if self.act_checkpoint == "stage":
+            return checkpoint(self.stages[i], x, use_reentrant=False)
+        for blk in self.stages[i]:
+            x = checkpoint(blk, x, use_reentrant=False)
+        return x
+
     def forward(self, x):
         x = self.forward_features(x)
         return x
@@ -333,6 +507,9 @@ class LayerNorm(nn.Module):
     The ordering of the dimensions in the inputs. channels_last corresponds to inputs with 
     shape (batch_size, height, width, channels) while channels_first corresponds to inputs 
     with shape (batch_size, channels, height, width).
+    channels_first inputs are normalized with the fused F.layer_norm on a (N, H, W, C) view, which is
+    free for channels_last memory format inputs, instead of computing the statistics by hand.
+    Outputs have the same memory format as the inputs.
     """
     def __init__(self, normalized_shape, eps=1e-6, data_format="channels_last"):
         super().__init__()
@@ -348,11 +525,10 @@ class LayerNorm(nn.Module):
         if self.data_format == "channels_last":
             return F.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
         elif self.data_format == "channels_first":
-            u = x.mean(1, keepdim=True)
-            s = (x - u).pow(2).mean(1, keepdim=True)
-            x = (x - u) / torch.sqrt(s + self.eps)
-            x = self.weight[:, None, None] * x + self.bias[:, None, None]
-            return x
+            channels_last = x.is_contiguous(memory_format=torch.channels_last)
+            x = F.layer_norm(x.permute(0, 2, 3, 1), self.normalized_shape, self.weight, self.bias, self.eps)
+            x = x.permute(0, 3, 1, 2) # channels_last memory format
+            return x if channels_last else x.contiguous()
 
 @BACKBONE_REGISTRY.register()
 def build_convnext_backbone(cfg, input_shape):
@@ -367,7 +543,10 @@ def build_convnext_backbone(cfg, input_shape):
         dims=cfg.MODEL.CONVNEXT.DIMS,
         drop_path_rate=cfg.MODEL.CONVNEXT.DROP_PATH_RATE,
         layer_scale_init_value=cfg.MODEL.CONVNEXT.LAYER_SCALE_INIT_VALUE,
-        out_features=cfg.MODEL.CONVNEXT.OUT_FEATURES
+        out_features=cfg.MODEL.CONVNEXT.OUT_FEATURES,
+        channels_last=cfg.MODEL.CONVNEXT.CHANNELS_LAST,
+        act_checkpoint=cfg.MODEL.CONVNEXT.ACT_CHECKPOINT,
+        act_checkpoint_stages=cfg.MODEL.CONVNEXT.ACT_CHECKPOINT_STAGES,
     )
 
 @BACKBONE_REGISTRY.register()
@@ -389,4 +568,7 @@ def build_convnext_fpn_backbone(cfg, input_shape: ShapeSpec):
         top_block=LastLevelMaxPool(),
         fuse_type=cfg.MODEL.FPN.FUSE_TYPE,
     )
+    if cfg.MODEL.CONVNEXT.CHANNELS_LAST:
+        # keep the FPN in channels_last too, so that its convs don't convert between memory formats
+        backbone.to(memory_format=torch.channels_last)
     return backbone
\ No newline at end of file
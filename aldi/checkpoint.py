@@ -1,32 +1,149 @@
+import copy
 from typing import Any, Dict
 
+import torch
 from fvcore.common.checkpoint import _IncompatibleKeys
 from detectron2.checkpoint.detection_checkpoint import DetectionCheckpointer
 from detectron2.checkpoint.c2_model_loading import align_and_update_state_dicts
 
 
-class DetectionCheckpointerWithEMA(DetectionCheckpointer):
+_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+def _cast_state_dict(state_dict, dtype):
+    """Cast all floating point tensors in state_dict to dtype. Integer buffers (e.g. BatchNorm's
+    num_batches_tracked) and non-tensor entries are left untouched."""
+    if dtype is None or dtype == torch.float32:
+        return state_dict
+    ret = type(state_dict)(
+        (k, v.to(dtype) if isinstance(v, torch.Tensor) and v.is_floating_point() else v)
+        for k, v in state_dict.items()
+    )
+    # module versions, used by e.g. BatchNorm to load old state dicts
+    if hasattr(state_dict, "_metadata"):
+        ret._metadata = state_dict._metadata
+    return ret
+
+
+class _CastStateDict:
+    """Wraps a module or checkpointable so that its state_dict is cast to dtype (see `_cast_state_dict`)."""
+    def __init__(self, obj, dtype):
+        self.obj = obj
+        self.dtype = dtype
+
+    def state_dict(self):
+        return _cast_state_dict(self.obj.state_dict(), self.dtype)
+
+
+class CompactDetectionCheckpointer(DetectionCheckpointer):
+    """Same as DetectionCheckpointer, but:
+    - can store the student ("model") and/or EMA ("ema") weights in half precision.
+      Weights are cast back to the dtype of the module they are loaded into.
+    - can load native .pth checkpoints with memory-mapped tensors (`mmap=True`), so that only the
+      tensors that are actually copied into the model are read from disk. Falls back to regular
+      loading if a checkpoint cannot be memory-mapped.
+    - can create a lean copy of itself for weights-only checkpoints (see `lean_copy`).
+    - can require that loading initializes every weight of the model (`require_complete=True`), for models
+      built without weight initialization (see aldi.model.build_aldi). Missing weights raise an error instead
+      of being left uninitialized.
+    """
+    def __init__(self, model, save_dir="", *, save_to_disk=None, model_dtype="float32", ema_dtype="float32",
+                 mmap=False, require_complete=False, **checkpointables):
+        super().__init__(model, save_dir=save_dir, save_to_disk=save_to_disk, **checkpointables)
+        self.model_dtype = _DTYPES[model_dtype]
+        self.ema_dtype = _DTYPES[ema_dtype]
+        self.mmap = mmap
+        self.require_complete = require_complete
+        self._tag_on_save = True
+
+    def lean_copy(self, exclude=("trainer",)):
+        """Return a checkpointer that shares this checkpointer's model and checkpointables,
+        minus those in `exclude`. By default this drops the trainer state (optimizer, scheduler,
+        etc.), which is not needed for e.g. *_model_best.pth checkpoints.
+        Saving with the copy does not update `last_checkpoint`, so resuming still uses a full checkpoint.
+        """
+        ret = copy.copy(self)
+        ret.checkpointables = { k: v for k, v in self.checkpointables.items() if k not in exclude }
+        ret._tag_on_save = False
+        return ret
+
+    def save(self, name: str, **kwargs: Any) -> None:
+        """Same as Checkpointer.save, but casts weights to the configured dtypes."""
+        model, ema = self.model, self.checkpointables.get("ema")
+        try:
+            self.model = _CastStateDict(model, self.model_dtype)
+            if ema is not None:
+                self.checkpointables["ema"] = _CastStateDict(ema, self.ema_dtype)
+            super().save(name, **kwargs)
+        finally:
+            self.model = model
+            if ema is not None:
+                self.checkpointables["ema"] = ema
+
+    def tag_last_checkpoint(self, last_filename_basename: str) -> None:
+        """Only tag the last checkpoint if this is not a lean copy."""
+        if self._tag_on_save:
+            super().tag_last_checkpoint(last_filename_basename)
+
+    def load(self, path: str, checkpointables=None) -> Dict[str, Any]:
+        if self.require_complete and not path:
+            raise ValueError("No checkpoint to load, but the model's weights were not initialized.")
+        return super().load(path, checkpointables)
+
+    def _load_model(self, checkpoint: Any) -> _IncompatibleKeys:
+        incompatible = super()._load_model(checkpoint)
+        if self.require_complete and incompatible.missing_keys:
+            raise ValueError(f"The checkpoint does not contain {len(incompatible.missing_keys)} weights of the model, "
+                             f"which would be left uninitialized: {', '.join(incompatible.missing_keys)}")
+        return incompatible
+
+    def _load_file(self, filename: str) -> Dict[str, Any]:
+        if not (self.mmap and filename.endswith(".pth")):
+            return super()._load_file(filename)
+        try:
+            # mmap requires a real file on disk, not a file object
+            loaded = torch.load(self.path_manager.get_local_path(filename), map_location=torch.device("cpu"),
+                                mmap=True, weights_only=False)
+        except (RuntimeError, OSError, ValueError) as e:
+            # e.g. checkpoints written with the legacy (non-zipfile) serialization cannot be memory-mapped
+            self.logger.info(f"Could not memory-map {filename} ({e}); loading it into memory instead.")
+            return super()._load_file(filename)
+        if "model" not in loaded:
+            loaded = {"model": loaded}
+        return loaded
+
+
+class DetectionCheckpointerWithEMA(CompactDetectionCheckpointer):
     """The default DetectionCheckpointer will load from the 'model' entry in
     the checkpoint file. This is not desirable if you want to initialize from a model
     that was trained (i.e. burned-in) with EMA. This class will load the EMA model instead
     at the beginning of training.
+    The EMA weights replace the 'model' entry before it is loaded, so the model is only loaded once,
+    and (with memory-mapped loading) student weights that are shadowed by EMA weights are never read.
     This behavior can be disabled by setting cfg.EMA.LOAD_FROM_EMA_ON_START = False.
     """
-    def __init__(self, model, save_dir="", *, save_to_disk=None, **checkpointables):
-        super().__init__(model, save_dir=save_dir, save_to_disk=save_to_disk, **checkpointables)
+    def __init__(self, model, save_dir="", *, save_to_disk=None, **kwargs):
+        super().__init__(model, save_dir=save_dir, save_to_disk=save_to_disk, **kwargs)
+        self._load_ema_as_model = False
 
     def resume_or_load(self, path: str, *, resume: bool = True) -> Dict[str, Any]:
-        ret = super().resume_or_load(path, resume=resume)
-        if (not resume) and path.endswith(".pth") and "ema" in ret.keys():
+        self._load_ema_as_model = (not resume) and path.endswith(".pth")
+        try:
+            return super().resume_or_load(path, resume=resume)
+        finally:
+            self._load_ema_as_model = False
+
+    def _load_model(self, checkpoint: Any) -> _IncompatibleKeys:
+        if self._load_ema_as_model and "ema" in checkpoint:
             self.logger.info("Loading EMA weights as model starting point.")
             ema_dict = {
-                k.replace('model.', '', 1): v for k, v in ret['ema'].items()
+                k.replace('model.', '', 1): v for k, v in checkpoint.pop("ema").items()
             }
-            incompatible = self.model.load_state_dict(ema_dict, strict=False)
-            if incompatible is not None:
-                self._log_incompatible_keys(_IncompatibleKeys(
-                    missing_keys=incompatible.missing_keys,
-                    unexpected_keys=incompatible.unexpected_keys,
-                    incorrect_shapes=[]
-                ))
-        return ret
\ No newline at end of file
+            # fall back to the student weights for anything the EMA model does not contain
+            model_dict = checkpoint.get("model", {})
+            ema_dict.update({ k: v for k, v in model_dict.items() if k not in ema_dict })
+            checkpoint["model"] = ema_dict
+        return super()._load_model(checkpoint)
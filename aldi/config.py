@@ -31,6 +31,55 @@ def add_aldi_config(cfg):
      # also determines if EMA is used for eval when running tools/train_net.py --eval-only.
     _C.EMA.LOAD_FROM_EMA_ON_START = True
     _C.EMA.START_ITER = 0
+    # pseudo-label with an int8 copy of the EMA model (faster on CPU; requires MODEL.DEVICE cpu), whose
+    # nn.Linear layers are dynamically quantized and refreshed from the EMA weights every REFRESH_PERIOD iterations.
+    # agreement with the EMA model's pseudo-labels is logged after each refresh (pseudo_label/int8_*).
+    # only nn.Linear layers are quantized, so convolutional backbones (e.g. ResNet) gain little; see aldi/ema.py:quantized_copy.
+    _C.EMA.QUANTIZE = CN()
+    _C.EMA.QUANTIZE.ENABLED = False
+    _C.EMA.QUANTIZE.REFRESH_PERIOD = 100
+
+    # Checkpoint storage
+    _C.CHECKPOINT = CN()
+    # dtype used to store the student ("model") and EMA ("ema") weights in checkpoint files.
+    # one of: { "float32", "float16", "bfloat16" }. Weights are cast back to the model's dtype on load.
+    # note that storing the student in reduced precision also affects resumed training runs.
+    _C.CHECKPOINT.MODEL_DTYPE = "float32"
+    _C.CHECKPOINT.EMA_DTYPE = "float32"
+    # if False, *_model_best.pth checkpoints only contain weights (no optimizer/scheduler state)
+    _C.CHECKPOINT.BEST_INCLUDE_TRAINER_STATE = True
+    # load .pth checkpoints with memory-mapped tensors to reduce startup time and peak host memory
+    # (falls back to regular loading for checkpoints or file systems that do not support it)
+    _C.CHECKPOINT.MMAP_LOAD = False
+
+    # Store training annotations as arrays of boxes and classes instead of lists of dicts (cheaper to
+    # store and map; not used if MODEL.MASK_ON or MODEL.KEYPOINT_ON), and drop annotations of unlabeled data.
+    _C.DATALOADER.COMPACT_ANNOTATIONS = False
+
+    # Dataloader worker autotuning: instead of giving each dataloader (labeled/unlabeled)
+    # DATALOADER.NUM_WORKERS workers, split a total budget between them in proportion to
+    # the measured time their data pipelines need per batch. See aldi/dataloader.py:autotune_num_workers.
+    _C.DATALOADER.AUTOTUNE = CN()
+    _C.DATALOADER.AUTOTUNE.ENABLED = False
+    # total workers per GPU; 0 means all CPUs available per GPU minus the main process threads
+    _C.DATALOADER.AUTOTUNE.TOTAL_WORKERS = 0
+    # torch intra-op threads of the main (training) process; 0 means the CPUs per GPU left over after the workers (at least 1)
+    _C.DATALOADER.AUTOTUNE.MAIN_PROCESS_THREADS = 0
+    # number of images each pipeline is timed on during warm-up
+    _C.DATALOADER.AUTOTUNE.WARMUP_IMAGES = 8
+
+    # Save the position of the training dataloaders in checkpoints, so that resumed training
+    # continues with the same data order and augmentations (see aldi/dataloader.py:WeakStrongDataloader).
+    # In distributed training, this gathers the dataloader positions of all processes after every step.
+    _C.DATALOADER.RESUMABLE = False
+
+    # Batch images with similar shapes after augmentation together (per dataloader, so labeled/unlabeled
+    # ratios are unchanged) to reduce padding, e.g. with multi-scale augmentation.
+    # Shapes are compared after rounding up to multiples of GRANULARITY pixels.
+    # See aldi/dataloader.py:ShapeGroupedDataset.
+    _C.DATALOADER.SHAPE_GROUPING = CN()
+    _C.DATALOADER.SHAPE_GROUPING.ENABLED = False
+    _C.DATALOADER.SHAPE_GROUPING.GRANULARITY = 64
 
     # Begin domain adaptation settings
     _C.DOMAIN_ADAPT = CN()
@@ -75,20 +124,66 @@ def add_aldi_config(cfg):
     # Vision Transformer settings
     _C.VIT = CN()
     _C.VIT.USE_ACT_CHECKPOINT = True
+    # which blocks to checkpoint, one of: { "all", "every_k", "global", "budget" }.
+    # see aldi/backbone.py:ViTCheckpointPolicy
+    _C.VIT.ACT_CHECKPOINT_POLICY = "all"
+    _C.VIT.ACT_CHECKPOINT_EVERY_K = 2
+    # for "budget": memory in MB that the activations of blocks that are not checkpointed may use
+    _C.VIT.ACT_CHECKPOINT_MEMORY_BUDGET_MB = 0
+    # compute attention with torch's fused scaled_dot_product_attention (keeps relative position biases)
+    _C.VIT.USE_SDPA = False
 
     # We interpret SOLVER.IMS_PER_BATCH as the total batch size on all GPUs, for 
     # experimental consistency. Gradient accumulation is used according to 
     # num_gradient_accum_steps = IMS_PER_BATCH / (NUM_GPUS * IMS_PER_GPU)
     _C.SOLVER.IMS_PER_GPU = 2
 
+    # Alternatively, choose the number of images per GPU automatically and separately for each phase
+    # of training (source weak/strong, target align, distill) by measuring the memory used by the
+    # forward and backward passes of the first micro-batches of each phase. Requires SOLVER.BACKWARD_AT_END=False. See aldi/memory.py:MicroBatchSizer.
+    _C.SOLVER.AUTO_IMS_PER_GPU = CN()
+    _C.SOLVER.AUTO_IMS_PER_GPU.ENABLED = False
+    # memory budget per GPU in MB; 0 means 90% of total GPU memory.
+    # must be set when training on CPU, where only activation memory is measured.
+    _C.SOLVER.AUTO_IMS_PER_GPU.MEMORY_BUDGET_MB = 0
+
     # We use gradient accumulation to run the weak/strong/unlabeled data separately
     # Should we call backward intermittently during accumulation or at the end?
     # The former is slower but less memory usage
     _C.SOLVER.BACKWARD_AT_END = True
 
+    # Alternatively (with BACKWARD_AT_END=False), choose for each phase of training whether to call backward
+    # after every micro-batch or to keep its graph until the last backward pass of the step, based on the
+    # activation memory measured during the first steps. See aldi/memory.py:BackwardScheduler.
+    _C.SOLVER.AUTO_BACKWARD = CN()
+    _C.SOLVER.AUTO_BACKWARD.ENABLED = False
+    # memory budget per GPU in MB; 0 means 90% of total GPU memory.
+    # must be set when training on CPU, where only activation memory is measured.
+    _C.SOLVER.AUTO_BACKWARD.MEMORY_BUDGET_MB = 0
+
+    # If BACKWARD_AT_END is False, only synchronize gradients across GPUs during the last
+    # backward pass of each step (intermediate gradients are accumulated locally with DDP.no_sync)
+    _C.SOLVER.DDP_NO_SYNC = False
+    # Size of DDP gradient communication buckets in MB (PyTorch default: 25)
+    _C.SOLVER.DDP_BUCKET_CAP_MB = 25
+
     # Enable use of different optimizers (necessary to match VitDet settings)
     _C.SOLVER.OPTIMIZER = "SGD"
 
+    # Compile the backbone and heads with torch.compile. Only the forward methods of MODULES are compiled (the ALDI
+    # model as a whole has many graph breaks); forward hooks on them still run eagerly. See aldi/model.py:compile_modules.
+    # Training (student) and inference (teacher, pseudo-labeling, evaluation) forward passes are compiled separately,
+    # with their own torch.compile modes, e.g. INFERENCE_MODE "max-autotune-no-cudagraphs" for inference-only nodes.
+    _C.MODEL.COMPILE = CN()
+    _C.MODEL.COMPILE.ENABLED = False
+    _C.MODEL.COMPILE.MODULES = ["backbone", "proposal_generator.rpn_head", "roi_heads.box_head", "roi_heads.box_predictor"]
+    _C.MODEL.COMPILE.TRAIN = True
+    _C.MODEL.COMPILE.TRAIN_MODE = "default"
+    _C.MODEL.COMPILE.INFERENCE = True
+    _C.MODEL.COMPILE.INFERENCE_MODE = "default"
+    # None lets torch decide which input shapes are dynamic after the first recompilation
+    _C.MODEL.COMPILE.DYNAMIC = None
+
     # Extra configs for convnext
     # Default is ConvNext-T (Resnet-50 equiv.)
     _C.MODEL.CONVNEXT = CN()
@@ -97,4 +192,10 @@ def add_aldi_config(cfg):
     _C.MODEL.CONVNEXT.DROP_PATH_RATE= 0.2
     _C.MODEL.CONVNEXT.LAYER_SCALE_INIT_VALUE= 1e-6
     _C.MODEL.CONVNEXT.OUT_FEATURES= [0, 1, 2, 3]
+    # use channels_last memory format in the backbone and FPN (avoids copies in LayerNorm and block permutes)
+    _C.MODEL.CONVNEXT.CHANNELS_LAST = False
+    # activation checkpointing during training (trades compute for memory):
+    # one of { "none", "stage", "block" }, applied to the stages in ACT_CHECKPOINT_STAGES
+    _C.MODEL.CONVNEXT.ACT_CHECKPOINT = "none"
+    _C.MODEL.CONVNEXT.ACT_CHECKPOINT_STAGES = [0, 1, 2, 3]
     _C.SOLVER.WEIGHT_DECAY_RATE= 0.95
\ No newline at end of file
@@ -1,11 +1,24 @@
 import copy
+import itertools
+import logging
+import math
+import operator
+import os
+import random
+import time
+from collections import defaultdict
 import torch
+import torch.utils.data as torchdata
 import numpy as np
 
-from detectron2.structures import Instances, Boxes
+from detectron2.data.common import DatasetFromList
+from detectron2.data.samplers import TrainingSampler
+from detectron2.structures import Instances, Boxes, BoxMode
+from detectron2.utils import comm
+from detectron2.utils.env import seed_all_rng
 
 from aldi.aug import WEAK_IMG_KEY
-from aldi.dropin import DatasetMapper
+from aldi.dropin import COMPACT_ANNOTATIONS_KEY, DatasetMapper
 
 
 class SaveWeakDatasetMapper(DatasetMapper):
@@ -25,16 +38,271 @@ class UnlabeledDatasetMapper(SaveWeakDatasetMapper):
         # delete any gt boxes
         dataset_dict.pop("annotations", None)
         dataset_dict.pop("sem_seg_file_name", None)
-        dataset_dict['instances'] = Instances(dataset_dict['instances'].image_size, gt_boxes=Boxes([]), 
-                                              gt_classes=torch.tensor([], dtype=torch.int64))
+        # without annotations (e.g. with compact annotations, see compact_dataset_dicts), the mapper adds no instances
+        image_size = dataset_dict['instances'].image_size if 'instances' in dataset_dict else tuple(dataset_dict['image'].shape[-2:])
+        dataset_dict['instances'] = Instances(image_size, gt_boxes=Boxes([]), gt_classes=torch.tensor([], dtype=torch.int64))
         return dataset_dict
 
+def compact_dataset_dicts(dataset_dicts, keep_annotations=True):
+    """Replace the list of annotation dicts of each image by arrays of boxes (XYXY_ABS) and classes,
+    which are much cheaper to store, serialize, and transform (see dropin.DatasetMapper).
+    Masks and keypoints are dropped, so only use this if the model does not need them.
+    Crowd annotations are dropped, as the mapper would do.
+    If keep_annotations is False (e.g. for unlabeled data), annotations are removed altogether.
+    """
+    ret = []
+    for d in dataset_dicts:
+        annos = d.get("annotations")
+        if annos is not None:
+            d = { k: v for k, v in d.items() if k != "annotations" }
+            if keep_annotations:
+                annos = [a for a in annos if a.get("iscrowd", 0) == 0]
+                d[COMPACT_ANNOTATIONS_KEY] = {
+                    "boxes": np.array([BoxMode.convert(a["bbox"], a["bbox_mode"], BoxMode.XYXY_ABS) for a in annos], 
+                                      dtype=np.float32).reshape(-1, 4),
+                    "classes": np.array([a["category_id"] for a in annos], dtype=np.int64),
+                }
+        ret.append(d)
+    return ret
+
+class SeekableTrainingSampler(TrainingSampler):
+    """Same as detectron2.data.samplers.TrainingSampler, but the permutation of each epoch is derived
+    from the seed and the epoch number, so that iteration can start at any position of this worker's
+    index stream without replaying the indices before it (see `seek`)."""
+    def __init__(self, size, shuffle=True, seed=None):
+        super().__init__(size, shuffle=shuffle, seed=seed)
+        self._start = 0
+
+    def seek(self, position):
+        """Start the next iteration at the given position of this worker's index stream."""
+        self._start = position
+
+    def index_at(self, position):
+        """The dataset index at the given position of this worker's index stream."""
+        epoch, offset = divmod(self._rank + position * self._world_size, self._size)
+        return self._permutation(epoch)[offset].item()
+
+    def _permutation(self, epoch):
+        if not self._shuffle:
+            return torch.arange(self._size)
+        g = torch.Generator()
+        g.manual_seed(self._seed + epoch)
+        return torch.randperm(self._size, generator=g)
+
+    def __iter__(self):
+        yield from itertools.islice(self._infinite_indices(), 0, None, self._world_size)
+
+    def _infinite_indices(self):
+        epoch, offset = divmod(self._rank + self._start * self._world_size, self._size)
+        while True:
+            yield from self._permutation(epoch)[offset:].tolist()
+            epoch, offset = epoch + 1, 0
+
+class SeededMapDataset(torchdata.IterableDataset):
+    """Map the dataset dicts at the indices of a SeekableTrainingSampler, like Detectron2's ToIterableDataset
+    over a MapDataset, but seed all random number generators before mapping each image from the sampler's seed,
+    the process rank, and the image's position in the sampler's index stream. Augmentations then do not depend
+    on which dataloader worker maps an image, and an image mapped again with `at` (e.g. after resuming) gets the
+    same augmentations. If the mapper returns None for an image, the next images of the dataset are tried.
+    """
+    def __init__(self, dataset_dicts, mapper, sampler):
+        self.dataset_dicts = dataset_dicts
+        self.mapper = mapper
+        self.sampler = sampler
+
+    def __iter__(self):
+        worker_info = torchdata.get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        positions = itertools.count(self.sampler._start)
+        for position, index in itertools.islice(zip(positions, self.sampler), worker_id, None, num_workers):
+            yield self._map(position, index)
+
+    def at(self, position):
+        """The mapped image at the given position of the sampler's index stream."""
+        return self._map(position, self.sampler.index_at(position))
+
+    def _map(self, position, index):
+        # don't change the random state of the main process (e.g. with num_workers=0, or when resuming)
+        in_main_process = torchdata.get_worker_info() is None
+        if in_main_process:
+            rng_states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+        seed_all_rng(int(np.random.SeedSequence([self.sampler._seed, self.sampler._rank, position]).generate_state(1)[0]))
+        try:
+            for i in range(len(self.dataset_dicts)):
+                d = self.mapper(self.dataset_dicts[(index + i) % len(self.dataset_dicts)])
+                if d is not None:
+                    return d
+            raise RuntimeError("The mapper returned None for all images.")
+        finally:
+            if in_main_process:
+                random.setstate(rng_states[0])
+                np.random.set_state(rng_states[1])
+                torch.set_rng_state(rng_states[2])
+
+class ShapeGroupedDataset(torchdata.IterableDataset):
+    """Like detectron2.data.common.AspectRatioGroupedDataset, but groups images by their shape after
+    augmentation (rounded up to multiples of `granularity` pixels), so that little compute is spent on padding
+    when images of different sizes are batched together (e.g. with multi-scale augmentation).
+    If granularity is None, images are grouped by aspect ratio only, like AspectRatioGroupedDataset.
+    If more than `max_buffered` images are waiting in incomplete groups, a batch is made from the largest
+    group plus the images from the groups with the most similar shapes.
+    If drop_last is False, the images left in incomplete groups when a finite dataset is exhausted are yielded
+    in (possibly smaller) batches in the same way, instead of being dropped.
+
+    If given the SeekableTrainingSampler and the SeededMapDataset it loads from, its position can be saved and
+    restored with state_dict/load_state_dict: images that were waiting in incomplete groups are mapped again
+    (with the same augmentations), and the sampler continues where it left off. This relies on the DataLoader
+    returning images in sampler order.
+    """
+    def __init__(self, dataset, batch_size, granularity=64, max_buffered=None, sampler=None, mapped_dataset=None,
+                 drop_last=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.granularity = granularity
+        self.max_buffered = max_buffered or 8 * batch_size
+        self.drop_last = drop_last
+        self.sampler = sampler
+        self.mapped_dataset = mapped_dataset
+        self.position = 0 # number of images loaded from the sampler
+        self.pending = [] # sampler positions of images waiting in incomplete groups
+        self._restored_pending = []
+
+    def _shape_key(self, d):
+        h, w = d["image"].shape[-2:]
+        if self.granularity is None:
+            return (int(w > h),)
+        return (math.ceil(h / self.granularity), math.ceil(w / self.granularity))
+
+    def _take_nearest(self, buckets, key):
+        batch = []
+        for k in sorted(buckets, key=lambda k: sum(abs(a - b) for a, b in zip(k, key))):
+            n = self.batch_size - len(batch)
+            batch.extend(buckets[k][:n])
+            del buckets[k][:n]
+            if not buckets[k]:
+                del buckets[k]
+            if len(batch) == self.batch_size:
+                break
+        return batch
+
+    def _positioned(self):
+        """Yield (sampler position, image), starting with any images restored from a state dict."""
+        for position in self._restored_pending:
+            yield position, self.mapped_dataset.at(position)
+        self._restored_pending = []
+        for d in self.dataset:
+            self.position += 1
+            yield self.position - 1, d
+
+    def __iter__(self):
+        buckets = defaultdict(list)
+        num_buffered = 0
+        for position, d in self._positioned():
+            key = self._shape_key(d)
+            buckets[key].append((position, d))
+            num_buffered += 1
+            if len(buckets[key]) == self.batch_size:
+                num_buffered -= self.batch_size
+                batch = buckets.pop(key)
+            elif num_buffered >= self.max_buffered:
+                num_buffered -= self.batch_size
+                batch = self._take_nearest(buckets, max(buckets, key=lambda k: len(buckets[k])))
+            else:
+                continue
+            self.pending = sorted(p for bucket in buckets.values() for p, _ in bucket)
+            yield [d for _, d in batch]
+        if not self.drop_last:
+            while buckets:
+                batch = self._take_nearest(buckets, max(buckets, key=lambda k: len(buckets[k])))
+                yield [d for _, d in batch]
+            self.pending = []
+
+    def state_dict(self):
+        assert self.sampler is not None, "ShapeGroupedDataset needs its sampler to save its state."
+        return { "seed": self.sampler._seed, "position": self.position, "pending": list(self.pending) }
+
+    def load_state_dict(self, state):
+        """Restore the state; must be called before iteration starts."""
+        self.sampler._seed = state["seed"]
+        self.sampler.seek(state["position"])
+        self.position = state["position"]
+        self._restored_pending = list(state["pending"])
+
+def build_grouped_train_loader(dataset_dicts, mapper, total_batch_size, num_workers=0, granularity=None):
+    """Same as detectron2.data.build_detection_train_loader with the default TrainingSampler, but uses
+    SeekableTrainingSampler, SeededMapDataset and ShapeGroupedDataset, so that the loader's position can be saved
+    and restored. With granularity=None, images are grouped by aspect ratio as in Detectron2, otherwise by shape
+    after augmentation."""
+    world_size = comm.get_world_size()
+    assert total_batch_size > 0 and total_batch_size % world_size == 0, \
+        f"Total batch size ({total_batch_size}) must be divisible by the number of gpus ({world_size})."
+    sampler = SeekableTrainingSampler(len(dataset_dicts))
+    mapped_dataset = SeededMapDataset(DatasetFromList(dataset_dicts, copy=False), mapper, sampler)
+    data_loader = torchdata.DataLoader(mapped_dataset, num_workers=num_workers, collate_fn=operator.itemgetter(0))
+    return ShapeGroupedDataset(data_loader, total_batch_size // world_size, granularity, 
+                               sampler=sampler, mapped_dataset=mapped_dataset)
+
+def padding_waste(batched_inputs, size_divisibility=1):
+    """Fraction of the padded batch tensor (see detectron2.structures.ImageList) that is padding."""
+    shapes = [tuple(d["image"].shape[-2:]) for d in batched_inputs]
+    max_h, max_w = max(h for h, _ in shapes), max(w for _, w in shapes)
+    if size_divisibility > 1:
+        max_h = math.ceil(max_h / size_divisibility) * size_divisibility
+        max_w = math.ceil(max_w / size_divisibility) * size_divisibility
+    return 1 - sum(h * w for h, w in shapes) / (len(shapes) * max_h * max_w)
+
+def cpus_per_process():
+    """Number of CPUs available to this process, split evenly between the processes on this machine."""
+    num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return max(1, num_cpus // comm.get_local_size())
+
+def autotune_num_workers(pipelines, total_workers, num_images=8):
+    """Split total_workers dataloader workers between data pipelines in proportion to the time each
+    pipeline needs to produce a batch. Each pipeline's mapper is timed on num_images random images
+    in the main process; in distributed training, timings are averaged over all processes.
+    Args:
+        pipelines (list[tuple]): (dataset_dicts, mapper, batch_size) for each dataloader
+        total_workers (int): number of workers to split
+        num_images (int): number of images to time each mapper on
+    Returns:
+        list[int]: number of workers for each pipeline. Every pipeline gets at least 1 worker, so they only
+            add up to total_workers if there are at least as many workers as pipelines.
+    """
+    rng = random.Random(comm.get_rank())
+    costs = []
+    for dataset_dicts, mapper, batch_size in pipelines:
+        # first image is not timed, to exclude one-time setup costs
+        samples = [dataset_dicts[rng.randrange(len(dataset_dicts))] for _ in range(num_images + 1)]
+        mapper(samples[0])
+        start = time.perf_counter()
+        for d in samples[1:]:
+            mapper(d)
+        costs.append((time.perf_counter() - start) / num_images * batch_size)
+    costs = np.mean(comm.all_gather(costs), axis=0)
+
+    # at least one worker each, then distribute the rest by largest remainder
+    shares = total_workers * costs / max(costs.sum(), 1e-9)
+    num_workers = np.maximum(np.floor(shares).astype(int), 1)
+    for i in np.argsort(num_workers - shares):
+        if num_workers.sum() >= total_workers:
+            break
+        num_workers[i] += 1
+    # raising cheap pipelines to one worker may exceed the total: take workers from the most over-served pipelines
+    while num_workers.sum() > max(total_workers, len(num_workers)):
+        over_served = np.where(num_workers > 1, num_workers - shares, -np.inf)
+        num_workers[np.argmax(over_served)] -= 1
+
+    logging.getLogger(__name__).info(f"Dataloader workers: {num_workers.tolist()} (of {total_workers}) for measured "
+                                     f"batch times of {[round(c, 3) for c in costs]} seconds per worker.")
+    return num_workers.tolist()
+
 class TwoDataloaders:
     class NoneIterator:
         def __next__(self):
             return None
         
     def __init__(self, loader0, loader1):
+        self.loaders = (loader0, loader1)
         self.loader0 = TwoDataloaders.NoneIterator() if loader0 is None else iter(loader0)
         self.loader1 = TwoDataloaders.NoneIterator() if loader1 is None else iter(loader1)
     
@@ -43,17 +311,62 @@ class TwoDataloaders:
             yield (next(self.loader0), next(self.loader1))
 
 class WeakStrongDataloader:
-    def __init__(self, labeled_loader, unlabeled_loader, batch_contents=("labeled_weak", "labeled_strong", "unlabeled_strong")):
+    """Combines labeled and unlabeled dataloaders.
+    If both are resumable (i.e. have state_dict/load_state_dict, see build_grouped_train_loader), this can be
+    used as a checkpointable to resume training with the same data order and augmentations.
+    In distributed training, only the main process saves checkpoints, so every process must call `sync_state`
+    after every step (ALDITrainer does this with a hook); state_dict warns if the state it returns is out of date.
+    Limitations: the state of random number generators outside of the dataloaders (e.g. in the model) is not
+    saved, and the state can only be restored with the same number of processes.
+    """
+    LOADER_NAMES = ("labeled", "unlabeled")
+
+    def __init__(self, labeled_loader, unlabeled_loader, batch_contents=("labeled_weak", "labeled_strong", "unlabeled_strong"),
+                 num_workers=None):
         self.loader = TwoDataloaders(labeled_loader, unlabeled_loader)
         self.batch_contents = batch_contents
+        self.num_workers = num_workers # total workers of both loaders, if known
+        self._synced_state = None
+        self._num_batches, self._synced_num_batches = 0, 0
     
     def __iter__(self):
         for batch in self.loader:
+            self._num_batches += 1
             yield unpack_data_weak_strong(*batch, batch_contents=self.batch_contents)
 
     def __len__(self):
         return len(self.loader)
 
+    def resumable(self):
+        return all(loader is None or hasattr(loader, "state_dict") for loader in self.loader.loaders)
+
+    def sync_state(self):
+        """Gather the state of the loaders of all processes. Must be called by all processes."""
+        states = comm.all_gather({ name: loader.state_dict() for name, loader in zip(self.LOADER_NAMES, self.loader.loaders)
+                                   if loader is not None })
+        self._synced_state = { name: [s[name] for s in states] for name in states[0] }
+        self._synced_num_batches = self._num_batches
+
+    def state_dict(self):
+        if comm.get_world_size() == 1:
+            self.sync_state()
+        elif self._synced_num_batches != self._num_batches:
+            logging.getLogger(__name__).warning(f"Saving the dataloader state from {self._num_batches - self._synced_num_batches} "
+                                                "batches ago: sync_state was not called after the last step.")
+        return self._synced_state or {}
+
+    def load_state_dict(self, state):
+        logger = logging.getLogger(__name__)
+        for name, loader in zip(self.LOADER_NAMES, self.loader.loaders):
+            if loader is None or name not in state:
+                continue
+            if len(state[name]) != comm.get_world_size():
+                logger.warning(f"Not restoring the {name} dataloader state: it was saved with {len(state[name])} "
+                               f"processes, but there are {comm.get_world_size()} now.")
+                continue
+            loader.load_state_dict(state[name][comm.get_rank()])
+            logger.info(f"Restored the {name} dataloader state at position {state[name][comm.get_rank()]['position']}.")
+
 def unpack_data_weak_strong(labeled, unlabeled, batch_contents=("labeled_weak", "labeled_strong", "unlabeled_strong")):
     """
     Postprocess data from a SaveWeakDatasetMapper to expose both weakly and strongly augmented images.
@@ -1,3 +1,5 @@
+import contextlib
+from functools import lru_cache
 import torch
 import torch.nn.functional as F
 from torch.nn.parallel import DistributedDataParallel as DDP
@@ -8,10 +10,12 @@ from detectron2.layers import cat
 from detectron2.layers.wrappers import cross_entropy
 from detectron2.modeling.sampling import subsample_labels
 from detectron2.modeling.box_regression import _dense_box_regression_loss
+from detectron2.modeling.proposal_generator.rpn import RPN
+from detectron2.modeling.roi_heads.fast_rcnn import FastRCNNOutputLayers
 from detectron2.utils.registry import Registry
 from fvcore.nn import smooth_l1_loss
 
-from aldi.helpers import SaveIO, ManualSeed, ReplaceProposalsOnce, set_attributes
+from aldi.helpers import SaveIO, capture, set_attributes
 from aldi.pseudolabeler import PseudoLabeler
 
 DISTILLER_REGISTRY = Registry("DISTILLER")
@@ -87,6 +91,9 @@ class HardDistiller(Distiller):
 @DISTILLER_REGISTRY.register()
 class ALDIDistiller(Distiller):
     """Compute hard or soft distillation (based on config values) for Faster R-CNN based students/teachers.
+    Hard losses that are not enabled are only added with zero weight (to keep their parameters in the graph)
+    when DDP needs them (see `keep_unused_in_graph`). Otherwise the student skips them entirely
+    (see DistillMixin.only_losses) and they are not logged.
     """
 
     def __init__(self, teacher, student, do_hard_cls=False, do_hard_obj=False, do_hard_rpn_reg=False, do_hard_roi_reg=False,
@@ -113,92 +120,112 @@ class ALDIDistiller(Distiller):
                         pseudo_label_threshold=cfg.DOMAIN_ADAPT.TEACHER.THRESHOLD)
 
     def register_hooks(self):
-        self.student_rpn_io, self.student_rpn_head_io, self.student_boxpred_io = SaveIO(), SaveIO(), SaveIO()
-        self.teacher_backbone_io, self.teacher_rpn_head_io, self.teacher_boxpred_io, self.teacher_anchor_io = SaveIO(), SaveIO(), SaveIO(), SaveIO()
+        # the teacher's outputs are returned by DistillMixin.distill_targets, so only the student needs hooks,
+        # and only for the outputs that the enabled distillation losses use (see __call__ for when they are saved)
+        self.student_rpn_head_io = SaveIO() if self.rpn_distill_enabled() else None
+        self.student_box_pooler_io = SaveIO(save_input=True, save_output=False) if self.roih_distill_enabled() else None
+        self.student_boxpred_io = SaveIO() if self.roih_distill_enabled() else None
         
         student_model = self.student.module if type(self.student) is DDP else self.student
-        teacher_model = self.teacher.module if type(self.teacher) is DDP else self.teacher
-
-        student_model.proposal_generator.register_forward_hook(self.student_rpn_io)
-        student_model.proposal_generator.rpn_head.register_forward_hook(self.student_rpn_head_io)
-        student_model.roi_heads.box_predictor.register_forward_hook(self.student_boxpred_io)
 
-        teacher_model.backbone.register_forward_hook(self.teacher_backbone_io)
-        teacher_model.proposal_generator.rpn_head.register_forward_hook(self.teacher_rpn_head_io)
-        teacher_model.roi_heads.box_predictor.register_forward_hook(self.teacher_boxpred_io)
-        teacher_model.proposal_generator.anchor_generator.register_forward_hook(self.teacher_anchor_io)
+        for module, io in [(student_model.proposal_generator.rpn_head, self.student_rpn_head_io),
+                           (student_model.roi_heads.box_pooler, self.student_box_pooler_io),
+                           (student_model.roi_heads.box_predictor, self.student_boxpred_io)]:
+            if io is not None:
+                module.register_forward_hook(io)
 
-        # Make sure seeds are the same for proposal sampling in teacher/student
-        self.seeder = ManualSeed()
-        teacher_model.roi_heads.register_forward_pre_hook(self.seeder)
-        student_model.roi_heads.register_forward_pre_hook(self.seeder)
-
-        # Teacher and student second stage need to have the same input proposals in order to distill predictions on those proposals
-        self.teacher_proposal_replacer = ReplaceProposalsOnce()
-        teacher_model.roi_heads.register_forward_pre_hook(self.teacher_proposal_replacer)
+    def keep_unused_in_graph(self):
+        """Whether hard losses that are not enabled must be added with zero weight. DDP expects every parameter
+        to be used by a backward pass that synchronizes gradients, unless it searches for unused parameters
+        itself (find_unused_parameters=True). Backward passes under DDP.no_sync and single-process training
+        (without DDP) do not need them."""
+        return (type(self.student) is DDP and self.student.require_backward_grad_sync
+                and not self.student.find_unused_parameters)
 
     def distill_enabled(self):
         return any([self.do_hard_cls, self.do_hard_obj, self.do_hard_rpn_reg, self.do_hard_roi_reg,
                     self.do_cls_dst, self.do_obj_dst, self.do_rpn_reg_dst, self.do_roih_reg_dst])
 
+    def rpn_distill_enabled(self):
+        return self.do_obj_dst or self.do_rpn_reg_dst
+
+    def roih_distill_enabled(self):
+        return self.do_cls_dst or self.do_roih_reg_dst
+
     def _distill_forward(self, teacher_batched_inputs, student_batched_inputs):
         # first, get hard pseudo labels -- this is done in place
         # even if not included in overall loss, we need them for RPN proposal sampling
         # TODO there may be a more efficient way to do the latter if you don't want hard losses
         self.pseudo_labeler(teacher_batched_inputs, student_batched_inputs)
-        
-        self.seeder.reset_seed()
 
-        # teacher might be in eval mode -- this is important for inputs/outputs aligning
+        # if we don't need to keep unused losses around, tell the student to only compute the hard losses that are enabled
+        student_model = self.student.module if type(self.student) is DDP else self.student
+        prune_losses = not self.keep_unused_in_graph() and hasattr(student_model, "only_losses")
+        with student_model.only_losses(self.enabled_hard_losses()) if prune_losses else contextlib.nullcontext():
+            standard_losses = self.student(student_batched_inputs)
+
+        # Teacher and student second stage need to have the same input proposals in order to distill predictions on those proposals,
+        # so we give the teacher the proposals the student sampled for its ROI heads
+        student_proposal_boxes = self.student_box_pooler_io.input[1] if self.roih_distill_enabled() else None
+
+        # teacher might be in eval mode -- we use train mode so that the backbone behaves as it does for the student
+        teacher_model = self.teacher.module if type(self.teacher) is DDP else self.teacher
         was_eval = not self.teacher.training
         if was_eval: 
             self.teacher.train()
 
-        standard_losses = self.student(student_batched_inputs)
-        student_proposals, _ = self.student_rpn_io.output
-
-        self.teacher_proposal_replacer.set_proposals(student_proposals)
-        with torch.no_grad():
-            self.teacher(teacher_batched_inputs)
+        # only compute the teacher outputs that are distilled
+        teacher_outputs = teacher_model.distill_targets(teacher_batched_inputs, proposal_boxes=student_proposal_boxes,
+                                                        rpn=self.rpn_distill_enabled())
         
         # return to eval mode if necessary
         if was_eval: 
             self.teacher.eval()
 
-        return standard_losses
+        return standard_losses, teacher_outputs
 
     def __call__(self, teacher_batched_inputs, student_batched_inputs):
         losses = {}
 
-        # Do a forward pass to get activations, and get hard pseudo-label losses if desired
-        hard_losses = self._distill_forward(teacher_batched_inputs, student_batched_inputs)
+        # the student hooks only save outputs within this scope, and release them once the losses are computed
+        with capture(self.student_rpn_head_io, self.student_box_pooler_io, self.student_boxpred_io):
+            # Do a forward pass to get activations, and get hard pseudo-label losses if desired
+            hard_losses, teacher_outputs = self._distill_forward(teacher_batched_inputs, student_batched_inputs)
+            teacher_rpn_outputs, teacher_anchors, teacher_box_predictions = teacher_outputs
+            enabled_hard_losses = self.enabled_hard_losses()
+            for k, v in hard_losses.items():
+                if k in enabled_hard_losses:
+                    losses[k] = v
+                elif self.keep_unused_in_graph():
+                    # Need to add to standard losses so that the optimizer can see it
+                    losses[k] = v * 0.0
+
+            if self.rpn_distill_enabled():
+                losses.update(self.get_rpn_losses(teacher_batched_inputs, teacher_rpn_outputs, teacher_anchors))
+            if self.roih_distill_enabled():
+                losses.update(self.get_roih_losses(teacher_box_predictions))
+
+        return losses
+    
+    def enabled_hard_losses(self):
+        """Names of the standard (i.e., pseudo-label) student losses that are enabled."""
         loss_to_attr = {
             "loss_cls": self.do_hard_cls,
             "loss_rpn_cls": self.do_hard_obj,
             "loss_rpn_loc": self.do_hard_rpn_reg,
             "loss_box_reg": self.do_hard_roi_reg,
         }
-        for k, v in hard_losses.items():
-            if loss_to_attr.get(k, False):
-                losses[k] = v
-            else:
-                # Need to add to standard losses so that the optimizer can see it
-                losses[k] = v * 0.0
+        return { k for k, enabled in loss_to_attr.items() if enabled }
 
-        losses.update(self.get_rpn_losses(teacher_batched_inputs))
-        losses.update(self.get_roih_losses())
-
-        return losses
-    
-    def get_rpn_losses(self, teacher_batched_inputs):
+    def get_rpn_losses(self, teacher_batched_inputs, teacher_rpn_outputs, teacher_anchors):
         losses = {}
         student_objectness_logits, student_proposal_deltas = self.student_rpn_head_io.output
-        teacher_objectness_logits, teacher_proposal_deltas = self.teacher_rpn_head_io.output
+        teacher_objectness_logits, teacher_proposal_deltas = teacher_rpn_outputs
 
         # the RPN samples proposals for loss computation *after* the RPN head
         # so we need to mimic this logic ourselves to match -- it's a bit complicated to reverse engineer
         rpn = (self.teacher.module if type(self.teacher) is DDP else self.teacher).proposal_generator
-        pseudo_gt_labels = torch.stack(rpn.label_and_sample_anchors(self.teacher_anchor_io.output, 
+        pseudo_gt_labels = torch.stack(rpn.label_and_sample_anchors(teacher_anchors, 
                                                                        [i['instances'].to(self.teacher.device) for i in teacher_batched_inputs])[0])
         valid_mask = torch.flatten(pseudo_gt_labels >= 0) # the proposals we'll compute loss for
         fg_mask = pseudo_gt_labels == 1 # proposals matched to a pseudo GT box
@@ -228,10 +255,10 @@ class ALDIDistiller(Distiller):
 
         return losses
     
-    def get_roih_losses(self):
+    def get_roih_losses(self, teacher_box_predictions):
         losses = {}
         student_cls_logits, student_proposal_deltas = self.student_boxpred_io.output
-        teacher_cls_logits, teacher_proposal_deltas = self.teacher_boxpred_io.output
+        teacher_cls_logits, teacher_proposal_deltas = teacher_box_predictions
 
         # Postprocessing -- for now just sharpening
         teacher_cls_probs = F.softmax(teacher_cls_logits / self.cls_temperature, dim=1)
@@ -278,8 +305,107 @@ class ALDIDistiller(Distiller):
         return losses
 
 
+class _SkipRPNLosses:
+    """Mixed into the student's RPN by DistillMixin: skips anchor labeling/sampling and the
+    RPN losses while skip_losses is set (see DistillMixin.only_losses)."""
+    skip_losses = False
+
+    def label_and_sample_anchors(self, anchors, gt_instances):
+        if self.skip_losses:
+            return None, None
+        return super().label_and_sample_anchors(anchors, gt_instances)
+
+    def losses(self, *args, **kwargs):
+        if self.skip_losses:
+            return {}
+        return super().losses(*args, **kwargs)
+
+
+class _SkipBoxPredictorLosses:
+    """Mixed into the student's box predictor by DistillMixin: skips the ROI heads losses
+    while skip_losses is set (see DistillMixin.only_losses)."""
+    skip_losses = False
+
+    def losses(self, predictions, proposals):
+        if self.skip_losses:
+            return {}
+        return super().losses(predictions, proposals)
+
+
+@lru_cache(maxsize=None)
+def _with_mixin(cls, mixin):
+    """A subclass of cls with mixin added, created once per (cls, mixin) pair."""
+    return type(cls.__name__, (mixin, cls), {})
+
+
 # Any modifications to the torch module itself go here and are mixed in
 # See align.py for an example
-# For now, no modifications are needed
 @DISTILL_MIXIN_REGISTRY.register()
-class DistillMixin(GeneralizedRCNN): pass
+class DistillMixin(GeneralizedRCNN):
+    """Adds `only_losses`, which lets a distiller request a subset of the standard training losses."""
+    RPN_LOSSES = ("loss_rpn_cls", "loss_rpn_loc")
+    ROIH_LOSSES = ("loss_cls", "loss_box_reg")
+
+    def __init__(self, **kwargs):
+        super(DistillMixin, self).__init__(**kwargs)
+        # the RPN and box predictor are built by their registries, so their losses are made skippable
+        # by switching them to subclasses that override their loss methods
+        rpn, box_predictor = self._loss_modules()
+        if rpn is not None:
+            rpn.__class__ = _with_mixin(type(rpn), _SkipRPNLosses)
+        if box_predictor is not None:
+            box_predictor.__class__ = _with_mixin(type(box_predictor), _SkipBoxPredictorLosses)
+
+    def _loss_modules(self):
+        """The RPN and box predictor, or None if the model does not use the standard Detectron2 ones."""
+        rpn = self.proposal_generator if isinstance(self.proposal_generator, RPN) else None
+        box_predictor = getattr(self.roi_heads, "box_predictor", None)
+        box_predictor = box_predictor if isinstance(box_predictor, FastRCNNOutputLayers) else None
+        return rpn, box_predictor
+
+    @contextlib.contextmanager
+    def only_losses(self, loss_names):
+        """Within this context, the RPN skips anchor labeling/sampling and its losses if none of RPN_LOSSES are
+        in loss_names, and the box predictor skips its losses if none of ROIH_LOSSES are in loss_names.
+        Proposal sampling in the ROI heads still happens, since distillation losses are computed on the sampled proposals.
+        """
+        rpn, box_predictor = self._loss_modules()
+        if rpn is not None:
+            rpn.skip_losses = not any(k in loss_names for k in self.RPN_LOSSES)
+        if box_predictor is not None:
+            box_predictor.skip_losses = not any(k in loss_names for k in self.ROIH_LOSSES)
+        try:
+            yield
+        finally:
+            if rpn is not None:
+                rpn.skip_losses = False
+            if box_predictor is not None:
+                box_predictor.skip_losses = False
+
+    @torch.no_grad()
+    def distill_targets(self, batched_inputs, proposal_boxes=None, rpn=True):
+        """Run only the parts of the model that produce distillation targets.
+        Args:
+            batched_inputs: same as in forward; instances are not needed.
+            proposal_boxes (list[Boxes] or None): if given, run the box predictor on these proposals.
+            rpn (bool): whether to run the RPN head and anchor generator.
+        Returns:
+            (rpn_outputs, anchors, box_predictions), with None for parts that were not run.
+        No proposals are generated or sampled, no losses are computed, and no autograd graph is built.
+        """
+        images = self.preprocess_image(batched_inputs)
+        features = self.backbone(images.tensor)
+
+        rpn_outputs, anchors = None, None
+        if rpn:
+            rpn_features = [features[f] for f in self.proposal_generator.in_features]
+            rpn_outputs = self.proposal_generator.rpn_head(rpn_features)
+            anchors = self.proposal_generator.anchor_generator(rpn_features)
+
+        box_predictions = None
+        if proposal_boxes is not None:
+            box_features = self.roi_heads.box_pooler([features[f] for f in self.roi_heads.box_in_features], proposal_boxes)
+            box_features = self.roi_heads.box_head(box_features)
+            box_predictions = self.roi_heads.box_predictor(box_features)
+
+        return rpn_outputs, anchors, box_predictions
@@ -21,6 +21,7 @@ from detectron2.engine.train_loop import AMPTrainer as _AMPTrainer
 from detectron2.engine.train_loop import SimpleTrainer as _SimpleTrainer
 from detectron2.engine.defaults import create_ddp_model
 from detectron2.engine.defaults import DefaultTrainer as _DefaultTrainer
+from detectron2.structures import Boxes, Instances
 from detectron2.utils.logger import setup_logger
 from detectron2.utils import comm
 from detectron2.utils.events import get_event_storage
@@ -74,11 +75,12 @@ class DefaultTrainer(_DefaultTrainer):
                 model, data_loader, optimizer
             )
     
-    def _create_checkpointer(self, model, cfg, ckpt_cls=DetectionCheckpointer):
+    def _create_checkpointer(self, model, cfg, ckpt_cls=DetectionCheckpointer, **kwargs):
         return ckpt_cls(
                 model,
                 cfg.OUTPUT_DIR,
                 trainer=weakref.proxy(self),
+                **kwargs,
             )
 
     def create_ddp_model(self, model, broadcast_buffers, cfg):
@@ -183,14 +185,20 @@ class AMPTrainer(_AMPTrainer):
     def do_backward(self, losses):
         self.grad_scaler.scale(losses).backward()
     
+# Key for annotations stored as arrays instead of a list of dicts; see aldi.dataloader.compact_dataset_dicts
+COMPACT_ANNOTATIONS_KEY = "compact_annotations"
+
 class DatasetMapper(_DatasetMapper):
     def __call__(self, dataset_dict):
         """
         Same as detectron2.data.dataset_mapper.DatasetMapper, but adds a way to
         access the aug_input object in subclasses without copy-pasting the entire
         __call__ method.
+        Also supports compact annotations (see aldi.dataloader.compact_dataset_dicts), which
+        are transformed without being modified, so the dataset dict does not need to be deep-copied.
         """
-        dataset_dict = copy.deepcopy(dataset_dict)
+        # the only nested structure that is modified in place is the list of annotations
+        dataset_dict = copy.deepcopy(dataset_dict) if "annotations" in dataset_dict else copy.copy(dataset_dict)
         image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
         utils.check_image_size(dataset_dict, image)
         if "sem_seg_file_name" in dataset_dict:
@@ -210,10 +218,13 @@ class DatasetMapper(_DatasetMapper):
             )
         if not self.is_train:
             dataset_dict.pop("annotations", None)
+            dataset_dict.pop(COMPACT_ANNOTATIONS_KEY, None)
             dataset_dict.pop("sem_seg_file_name", None)
             return dataset_dict
         if "annotations" in dataset_dict:
             self._transform_annotations(dataset_dict, transforms, image_shape)
+        elif COMPACT_ANNOTATIONS_KEY in dataset_dict:
+            self._transform_compact_annotations(dataset_dict, transforms, image_shape)
 
         ## Change is here ##
         dataset_dict = self._after_call(dataset_dict, aug_input)
@@ -221,5 +232,14 @@ class DatasetMapper(_DatasetMapper):
 
         return dataset_dict
     
+    def _transform_compact_annotations(self, dataset_dict, transforms, image_shape):
+        """Same as _transform_annotations (without masks/keypoints), for compact annotations."""
+        annos = dataset_dict.pop(COMPACT_ANNOTATIONS_KEY)
+        boxes = transforms.apply_box(annos["boxes"]).clip(min=0)
+        boxes = np.minimum(boxes, list(image_shape + image_shape)[::-1])
+        instances = Instances(image_shape, gt_boxes=Boxes(torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4)),
+                              gt_classes=torch.as_tensor(annos["classes"], dtype=torch.int64))
+        dataset_dict["instances"] = utils.filter_empty_instances(instances)
+
     def _after_call(self, dataset_dict, aug_input):
         return dataset_dict
\ No newline at end of file
@@ -1,14 +1,54 @@
 import copy
-from collections import OrderedDict
+import itertools
+import logging
+import torch
 from torch import nn
+from torch.ao.quantization import quantize_dynamic
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 import detectron2.utils.comm as comm
+from detectron2.layers import FrozenBatchNorm2d
+from detectron2.utils.events import get_event_storage
+
+from aldi.pseudolabeler import pseudo_label_agreement
+
+
+def frozen_tensors(model):
+    """Return {state dict key: tensor} for the parameters and buffers of model that training does not change:
+    parameters that do not require gradients (e.g. backbone stages frozen by cfg.MODEL.BACKBONE.FREEZE_AT), and
+    buffers of FrozenBatchNorm2d or of other modules whose own parameters are all frozen (except BatchNorm,
+    which updates its running statistics during training)."""
+    ret = {}
+    for module_name, module in model.named_modules():
+        prefix = module_name + "." if module_name else ""
+        params = list(module.named_parameters(recurse=False))
+        ret.update({ prefix + name: p for name, p in params if not p.requires_grad })
+        frozen_buffers = isinstance(module, FrozenBatchNorm2d) or \
+                         (params and not any(p.requires_grad for _, p in params) and not isinstance(module, _BatchNorm))
+        if frozen_buffers:
+            ret.update({ prefix + name: b for name, b in module.named_buffers(recurse=False)
+                         if b is not None and name not in module._non_persistent_buffers_set })
+    return ret
 
 
 class EMA(nn.Module):
-    def __init__(self, model, alpha, start_iter=0):
+    """Exponential moving average of the student weights, used as the teacher.
+    The teacher is only used for inference, so it is a stripped copy of the given model: alignment heads
+    (and the hooks that feed them) are removed and gradients are disabled. Only the weights the teacher
+    has are updated.
+    If the student is given, its frozen parameters and buffers (see `frozen_tensors`) are shared with the
+    teacher instead of copied. Shared tensors are not updated, but are still part of the teacher's state dict.
+    """
+    def __init__(self, model, alpha, start_iter=0, student=None):
         super(EMA, self).__init__()
         self.model = copy.deepcopy(model)
+        if hasattr(self.model, "remove_alignment"):
+            self.model.remove_alignment()
+        self.shared_keys = set()
+        if student is not None:
+            self._share_frozen_tensors(student.module if type(student) is DDP else student)
+        self.model.requires_grad_(False)
         self.alpha = alpha
         self.start_iter = start_iter
 
@@ -16,6 +56,21 @@ class EMA(nn.Module):
         # for now, disable updating DETR query embeddings only
         self.exclude_keys = ['query_embed']
 
+    def _share_frozen_tensors(self, student):
+        teacher_state = self.model.state_dict()
+        shared = { k: v for k, v in frozen_tensors(student).items()
+                   if k in teacher_state and teacher_state[k].shape == v.shape and teacher_state[k].dtype == v.dtype }
+        for key, tensor in shared.items():
+            module_name, _, name = key.rpartition(".")
+            module = self.model.get_submodule(module_name)
+            if name in module._parameters:
+                module._parameters[name] = tensor
+            else:
+                module._buffers[name] = tensor
+        self.shared_keys = set(shared)
+        logging.getLogger(__name__).info(f"Sharing {len(shared)} frozen parameters and buffers "
+                                         f"({sum(t.numel() * t.element_size() for t in shared.values()) // 2**20} MB) between the student and EMA models.")
+
     def _get_student_dict(self, model):
         # account for DDP
         if comm.get_world_size() > 1:
@@ -27,28 +82,26 @@ class EMA(nn.Module):
         return student_model_dict
 
     def _init_ema_weights(self, model):
-        self.model.load_state_dict(self._get_student_dict(model))
+        student_model_dict = self._get_student_dict(model)
+        self.model.load_state_dict({ k: v for k, v in student_model_dict.items() if k in self.model.state_dict() })
 
+    @torch.no_grad()
     def _update_ema(self, model, iter):
         student_model_dict = self._get_student_dict(model)
 
-        # update teacher
-        new_teacher_dict = OrderedDict()
+        # update teacher in place
         for key, value in self.model.state_dict().items():
-            if key in student_model_dict.keys():
-                if any([k in key for k in self.exclude_keys]):
-                    # just copy any excluded keys
-                    new_teacher_dict[key] = student_model_dict[key] * 1
+            if key in self.shared_keys:
+                continue
+            elif key in student_model_dict.keys():
+                if any([k in key for k in self.exclude_keys]) or not value.is_floating_point():
+                    # just copy any excluded keys (and integer buffers)
+                    value.copy_(student_model_dict[key])
                 else:
-                    new_teacher_dict[key] = (
-                        student_model_dict[key] *
-                        (1 - self.alpha) + value * self.alpha
-                    )
+                    value.lerp_(student_model_dict[key].to(value.dtype), 1 - self.alpha)
             else:
                 raise Exception("{} is not found in student model".format(key))
 
-        self.model.load_state_dict(new_teacher_dict)
-
     def update_weights(self, model, iter):
         # Init/update ema model
         if iter <= self.start_iter:
@@ -56,5 +109,69 @@ class EMA(nn.Module):
         else:
             self._update_ema(model, iter)
 
+    def load_state_dict(self, state_dict, strict=True):
+        # checkpoints may contain weights the teacher does not have (e.g. alignment heads), and
+        # checkpoints saved without shared tensors get them from the student, which loads them too
+        own_state = super(EMA, self).state_dict(keep_vars=True)
+        state_dict = { k: v for k, v in state_dict.items() if k in own_state }
+        for k in self.shared_keys:
+            state_dict.setdefault("model." + k, own_state["model." + k])
+        return super(EMA, self).load_state_dict(state_dict, strict=strict)
+
+    def inference(self, data, **kwargs):
+        return self.model.inference(data, **kwargs)
+
+
+def quantized_copy(model, dtype=torch.qint8):
+    """Return a copy of model whose nn.Linear layers are dynamically quantized (int8 weights, with activations
+    quantized on the fly), for faster inference on CPU. All other parameters and buffers are shared with model
+    instead of copied. Only nn.Linear layers are quantized, so this helps ViT backbones, but for convolutional
+    backbones only the box head of Faster R-CNN gets faster. Its fully connected layers are roughly a tenth of the
+    compute of an R50-FPN Faster R-CNN at test time, which bounds the speedup at around 10%."""
+    memo = {}
+    for module in model.modules():
+        if not isinstance(module, nn.Linear):
+            memo.update({ id(t): t for t in itertools.chain(module.parameters(recurse=False), module.buffers(recurse=False)) })
+    return quantize_dynamic(copy.deepcopy(model, memo), {nn.Linear}, dtype=dtype, inplace=True)
+
+
+class QuantizedEMA(nn.Module):
+    """Int8 copy of an EMA model (see `quantized_copy`) used as the teacher for pseudo-labeling on CPU.
+    It is refreshed from the EMA weights every refresh_period iterations; only its quantized layers are
+    stale in between, since all other tensors are shared with the EMA model. The first time it pseudo-labels
+    after each refresh, the EMA model also pseudo-labels the same images, and the agreement between the
+    two is logged (see aldi.pseudolabeler.pseudo_label_agreement).
+    It is not checkpointed, since it can always be rebuilt from the EMA weights.
+    """
+    def __init__(self, ema, refresh_period, threshold=0.8, dtype=torch.qint8):
+        super(QuantizedEMA, self).__init__()
+        # not a submodule, so that it is not part of this module's state dict or train/eval mode
+        self._ema = [ema]
+        self.refresh_period = refresh_period
+        self.threshold = threshold
+        self.dtype = dtype
+        self.model = None
+        self.last_refresh = None
+        self._check_agreement = False
+
+    def update_weights(self, iter):
+        if self.last_refresh is None or iter - self.last_refresh >= self.refresh_period:
+            self.model = quantized_copy(self._ema[0].model, self.dtype).train(self.training)
+            self.last_refresh = iter
+            self._check_agreement = True
+
     def inference(self, data, **kwargs):
-        return self.model.inference(data, **kwargs)
\ No newline at end of file
+        predictions = self.model.inference(data, **kwargs)
+        if self._check_agreement:
+            self._check_agreement = False
+            ema_model = self._ema[0].model
+            was_training = ema_model.training
+            ema_model.eval()
+            with torch.no_grad():
+                reference = ema_model.inference(data, **kwargs)
+            ema_model.train(was_training)
+            precision, recall = pseudo_label_agreement(predictions, reference, self.threshold)
+            storage = get_event_storage()
+            storage.put_scalar("pseudo_label/int8_precision", precision, smoothing_hint=False)
+            storage.put_scalar("pseudo_label/int8_recall", recall, smoothing_hint=False)
+        return predictions
@@ -0,0 +1,87 @@
+import logging
+import time
+import numpy as np
+import torch
+
+from detectron2.export import TracingAdapter
+from detectron2.modeling import GeneralizedRCNN
+from detectron2.modeling.meta_arch.build import META_ARCH_REGISTRY
+from detectron2.modeling.postprocessing import detector_postprocess
+
+from aldi.checkpoint import CompactDetectionCheckpointer, DetectionCheckpointerWithEMA
+from aldi.model import materialize, meta_parameters
+
+
+def build_deployable_model(cfg, weights, use_ema=True):
+    """Build a plain detector (cfg.MODEL.META_ARCHITECTURE, e.g. GeneralizedRCNN) from an ALDI checkpoint,
+    for inference outside of training. Unlike aldi.model.build_aldi, the model has no ALDI mixins, alignment
+    heads, or hooks. Weights are not randomly initialized, since they are all loaded from the checkpoint.
+    Args:
+        weights (str): path to a checkpoint.
+        use_ema (bool): load the EMA (teacher) weights if the checkpoint contains them, otherwise the student weights.
+    Returns:
+        the model, in eval mode on cfg.MODEL.DEVICE
+    """
+    with meta_parameters():
+        model = META_ARCH_REGISTRY.get(cfg.MODEL.META_ARCHITECTURE)(cfg)
+    materialize(model, cfg.MODEL.DEVICE)
+    model.to(torch.device(cfg.MODEL.DEVICE))
+
+    # alignment heads in the checkpoint are reported as unused by the checkpointer
+    if use_ema:
+        DetectionCheckpointerWithEMA(model, mmap=cfg.CHECKPOINT.MMAP_LOAD, require_complete=True).resume_or_load(weights, resume=False)
+    else:
+        CompactDetectionCheckpointer(model, mmap=cfg.CHECKPOINT.MMAP_LOAD, require_complete=True).load(weights)
+    return model.eval().requires_grad_(False)
+
+
+def tracing_adapter(model, image):
+    """Wrap model in a TracingAdapter that maps an image tensor (C, H, W) in cfg.INPUT.FORMAT, already resized
+    to the test size, to flattened predictions (in the resized image's coordinates) for torch.jit.trace / ONNX export.
+    Use `adapter.outputs_schema` to turn the outputs of the exported model back into Instances."""
+    inference = None # call the model directly
+    if isinstance(model, GeneralizedRCNN):
+        def inference(model, inputs):
+            # skip resizing predictions to the original image size, which is done outside the exported model
+            return [{"instances": model.inference(inputs, do_postprocess=False)[0]}]
+    return TracingAdapter(model, [{"image": image}], inference)
+
+
+def export_torchscript(adapter, image, path):
+    """Trace the adapter with image and save the TorchScript model to path. Returns the traced model."""
+    with torch.no_grad():
+        traced = torch.jit.trace(adapter, (image,))
+    torch.jit.save(traced, path)
+    return traced
+
+
+def export_onnx(adapter, image, path, opset_version=11):
+    """Export the adapter to an ONNX model at path, with the TorchScript-based exporter that TracingAdapter
+    is made for (recent PyTorch versions default to the dynamo-based exporter)."""
+    with torch.no_grad(), open(path, "wb") as f:
+        torch.onnx.export(adapter, (image,), f, opset_version=opset_version, dynamo=False,
+                          input_names=["image"], dynamic_axes={"image": {1: "height", 2: "width"}})
+
+
+def exported_predictions(adapter, outputs, height, width):
+    """Rebuild Instances from the outputs of an exported model, resized to the original image size."""
+    instances = adapter.outputs_schema(outputs)[0]["instances"]
+    return detector_postprocess(instances, height, width)
+
+
+def benchmark(predict, images, warmup=3):
+    """Time predict(image) for each image (after warmup calls). Returns latency percentiles in ms and throughput."""
+    for image in images[:warmup]:
+        predict(image)
+    times = []
+    with torch.no_grad():
+        for image in images:
+            start = time.perf_counter()
+            predict(image)
+            times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    report = { "latency_ms_mean": float(times.mean()), "latency_ms_p50": float(np.percentile(times, 50)),
+               "latency_ms_p95": float(np.percentile(times, 95)), "latency_ms_p99": float(np.percentile(times, 99)),
+               "throughput_img_per_s": float(1000 * len(times) / times.sum()) }
+    logging.getLogger(__name__).info(", ".join(f"{k}={v:.2f}" for k, v in report.items()))
+    return report
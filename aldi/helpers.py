@@ -1,45 +1,43 @@
-import random
+import contextlib
 import torch
 
 from detectron2.evaluation import COCOEvaluator
 
 
 class SaveIO:
-    """Simple PyTorch hook to save the output of a nn.module."""
-    def __init__(self):
+    """Simple PyTorch hook to save the input and/or output of a nn.module.
+    Nothing is saved outside of a `capture` scope, and everything is released when the scope exits."""
+    def __init__(self, save_input=False, save_output=True):
+        self.save_input = save_input
+        self.save_output = save_output
+        self.active = False
         self.input = None
         self.output = None
         
     def __call__(self, module, module_in, module_out):
-        self.input = module_in
-        self.output = module_out
+        if self.active:
+            if self.save_input:
+                self.input = module_in
+            if self.save_output:
+                self.output = module_out
 
-class ManualSeed:
-    """PyTorch hook to manually set the random seed."""
-    def __init__(self):
-        self.reset_seed()
-
-    def reset_seed(self):
-        self.seed = random.randint(0, 2**32 - 1)
-
-    def __call__(self, module, args):
-        torch.manual_seed(self.seed)
-
-class ReplaceProposalsOnce:
-    """PyTorch hook to replace the proposals with the student's proposals, but only once."""
-    def __init__(self):
-        self.proposals = None
-
-    def set_proposals(self, proposals):
-        self.proposals = proposals
+    def release(self):
+        self.input = None
+        self.output = None
 
-    def __call__(self, module, args):
-        ret = None
-        if self.proposals is not None and module.training:
-            images, features, proposals, gt_instances = args
-            ret = (images, features, self.proposals, gt_instances)
-            self.proposals = None
-        return ret
+@contextlib.contextmanager
+def capture(*hooks, enabled=True):
+    """Let the given SaveIO hooks save inputs/outputs within this scope (None entries are ignored).
+    On exit, the hooks are deactivated and release what they saved."""
+    hooks = [h for h in hooks if h is not None] if enabled else []
+    for h in hooks:
+        h.active = True
+    try:
+        yield
+    finally:
+        for h in hooks:
+            h.active = False
+            h.release()
 
 def set_attributes(obj, params):
     """Set attributes of an object from a dictionary."""
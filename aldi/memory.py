@@ -0,0 +1,224 @@
+import contextlib
+import logging
+import torch
+
+from detectron2.utils import comm
+
+
+class PeakMemoryMeter:
+    """Context manager that measures the peak memory (in bytes) used by the code it wraps.
+    - On CUDA devices, this uses the caching allocator's peak statistics.
+    - On CPU, PyTorch does not keep allocator peak statistics, so instead we count the tensors
+      that autograd saves for backward (i.e. activation memory), which is the part of memory
+      use that grows with batch size. The saved storages are kept alive until exit, so that the
+      allocator cannot reuse their addresses for other saved tensors while measuring.
+    After exiting, `baseline` holds the memory that was already allocated on entry (always 0 on CPU).
+    Meters can be nested (e.g. a MicroBatchSizer measurement around a model whose backbone measures its
+    blocks): the memory measured by an inner meter also counts towards the meters around it.
+    """
+    _active = [] # entered meters, innermost last
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.baseline = 0
+        self.peak = 0
+
+    def _outer(self):
+        """The innermost meter around this one that measures the same device, if any."""
+        for meter in reversed(self._active[:-1]):
+            if meter.device == self.device:
+                return meter
+        return None
+
+    def __enter__(self):
+        PeakMemoryMeter._active.append(self)
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            outer = self._outer()
+            if outer is not None:
+                # resetting the peak statistics would lose the outer meter's peak so far
+                outer._peak_so_far = max(outer._peak_so_far, torch.cuda.max_memory_allocated(self.device))
+            self._peak_so_far = 0
+            self.baseline = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self._storages = {}
+            self._hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda t: t)
+            self._hooks.__enter__()
+        return self
+
+    def _pack(self, t):
+        storage = t.untyped_storage()
+        self._storages[storage.data_ptr()] = storage
+        return t
+
+    def __exit__(self, *args):
+        outer = self._outer()
+        PeakMemoryMeter._active.remove(self)
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            # the peak statistics are not reset on exit, so they still include this meter's peak for the outer meter
+            self.peak = max(self._peak_so_far, torch.cuda.max_memory_allocated(self.device)) - self.baseline
+        else:
+            self._hooks.__exit__(*args)
+            self.peak = sum(storage.nbytes() for storage in self._storages.values())
+            if outer is not None:
+                # only the innermost saved tensors hooks are called, so pass the saved storages on
+                outer._storages.update(self._storages)
+            self._storages = {}
+
+
+def _budget_bytes(device, budget_mb, config_key):
+    """Convert a memory budget in MB to bytes. A budget of 0 means 90% of total GPU memory."""
+    budget_bytes = budget_mb * 2**20
+    if budget_bytes <= 0:
+        if device.type != "cuda":
+            raise ValueError(f"{config_key} must be set when not training on CUDA.")
+        budget_bytes = int(0.9 * torch.cuda.get_device_properties(device).total_memory)
+    return budget_bytes
+
+
+class MicroBatchSizer:
+    """Choose the micro-batch size of each training phase (e.g. "source_weak", "distill"; see
+    trainer.run_model_labeled_unlabeled) so that it fits a memory budget.
+
+    The first time a phase is run, its first two micro-batches have size 1 and 2, and the peak memory of
+    their forward and backward passes is measured with PeakMemoryMeter (wrap the forward and backward pass of
+    every micro-batch in `measure`). Measuring through the backward pass matters on CUDA, where the backward
+    pass can peak above the forward pass (e.g. when the gradients are allocated, or when checkpointed
+    activations are recomputed). Memory is assumed to grow linearly with batch size, and the largest
+    micro-batch size that fits the budget is used from then on. Probing micro-batches are regular
+    training micro-batches, so no compute is wasted.
+    In distributed training, all workers use the smallest size chosen by any worker, so that all workers
+    run the same number of backward passes.
+    """
+    PROBE_SIZES = (1, 2)
+
+    def __init__(self, device, budget_bytes, default_batch_size):
+        self.device = torch.device(device)
+        self.budget_bytes = budget_bytes
+        self.default_batch_size = default_batch_size
+        self.sizes = {}
+        self._measurements = {} # phase -> [(peak, baseline)] of its probing micro-batches
+
+    @classmethod
+    def from_config(cls, cfg):
+        device = torch.device(cfg.MODEL.DEVICE)
+        budget_bytes = _budget_bytes(device, cfg.SOLVER.AUTO_IMS_PER_GPU.MEMORY_BUDGET_MB, "SOLVER.AUTO_IMS_PER_GPU.MEMORY_BUDGET_MB")
+        return cls(device, budget_bytes, cfg.SOLVER.IMS_PER_GPU)
+
+    def probing(self, phase):
+        """Whether the micro-batches of the given phase are still being measured."""
+        return phase not in self.sizes
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        """Measure the forward and backward pass of a probing micro-batch. Does nothing once the phase has a size."""
+        if not self.probing(phase):
+            yield
+            return
+        with PeakMemoryMeter(self.device) as meter:
+            yield
+        self._measurements.setdefault(phase, []).append((meter.peak, meter.baseline))
+
+    def slices(self, phase, n):
+        """Yield slices that split n images into micro-batches for the given phase."""
+        start = 0
+        if self.probing(phase):
+            self._measurements[phase] = []
+            for size in self.PROBE_SIZES:
+                if start + size > n:
+                    break
+                yield slice(start, start + size)
+                start += size
+            measurements = self._measurements.pop(phase)
+            # peaks relative to the first baseline: the gradients allocated by the first backward pass
+            # raise the baseline of the second micro-batch
+            baseline = measurements[0][1] if measurements else 0
+            peaks = [peak + b - baseline for peak, b in measurements]
+            self.sizes[phase] = self._fit(phase, peaks, baseline, n)
+
+        size = self.sizes[phase]
+        for i in range(start, n, size):
+            yield slice(i, min(i + size, n))
+
+    def _fit(self, phase, peaks, baseline, n):
+        if len(peaks) < len(self.PROBE_SIZES):
+            size = self.default_batch_size
+        else:
+            per_image = max(peaks[1] - peaks[0], 1)
+            fixed = max(peaks[0] - per_image, 0)
+            size = int((self.budget_bytes - baseline - fixed) // per_image)
+            size = max(1, min(size, n))
+        size = min(comm.all_gather(size))
+        logging.getLogger(__name__).info(f"Using micro-batch size {size} for phase '{phase}' "
+                                         f"(measured peak memory {[p // 2**20 for p in peaks]} MB for sizes "
+                                         f"{list(self.PROBE_SIZES[:len(peaks)])}; budget {self.budget_bytes // 2**20} MB).")
+        return size
+
+
+class BackwardScheduler:
+    """Choose, for each training phase (see trainer.run_model_labeled_unlabeled), whether to call backward
+    after every micro-batch ("immediate") or to keep the phase's graphs alive and backpropagate them together
+    with the last backward pass of the step ("deferred"). Deferring is faster (fewer backward passes) but
+    holds on to the phase's activations.
+
+    Until a schedule is chosen, all phases are immediate and the forward pass of each micro-batch is measured
+    with PeakMemoryMeter. Memory is assumed to grow linearly with the number of images, which gives the memory
+    a deferred phase holds for a whole step. Phases are then deferred greedily, cheapest first, as long as
+    the deferred phases plus the largest micro-batch of any immediate phase fit the budget.
+    In distributed training, all workers use the measurements of the worker that needed the most memory,
+    so that all workers use the same schedule.
+    """
+    def __init__(self, device, budget_bytes):
+        self.device = torch.device(device)
+        self.budget_bytes = budget_bytes
+        self.schedule = None
+        self.costs = {} # phase -> bytes held if deferred
+        self.peaks = {} # phase -> bytes used by its largest micro-batch
+        self.baseline = None
+
+    @classmethod
+    def from_config(cls, cfg):
+        device = torch.device(cfg.MODEL.DEVICE)
+        return cls(device, _budget_bytes(device, cfg.SOLVER.AUTO_BACKWARD.MEMORY_BUDGET_MB, "SOLVER.AUTO_BACKWARD.MEMORY_BUDGET_MB"))
+
+    def defer(self, phase):
+        """Whether backward passes of the given phase should be deferred to the end of the step."""
+        return self.schedule is not None and self.schedule.get(phase, False)
+
+    @contextlib.contextmanager
+    def measure(self, phase, batch_size, phase_size):
+        """Measure the memory used by the forward pass of one micro-batch of batch_size images, out of
+        phase_size images in that phase. Does nothing once a schedule has been chosen."""
+        if self.schedule is not None:
+            yield
+            return
+        with PeakMemoryMeter(self.device) as meter:
+            yield
+        self.baseline = meter.baseline if self.baseline is None else min(self.baseline, meter.baseline)
+        self.costs[phase] = max(self.costs.get(phase, 0), meter.peak * phase_size // batch_size)
+        self.peaks[phase] = max(self.peaks.get(phase, 0), meter.peak)
+
+    def update(self, phases):
+        """Call at the end of every step with the phases that were run. Chooses the schedule once all phases have been measured."""
+        if self.schedule is not None:
+            return
+        if not all(comm.all_gather(all(p in self.costs for p in phases))):
+            return
+        measurements = comm.all_gather((self.costs, self.peaks, self.baseline or 0))
+        costs = { p: max(m[0][p] for m in measurements) for p in phases }
+        peaks = { p: max(m[1][p] for m in measurements) for p in phases }
+        baseline = max(m[2] for m in measurements)
+
+        available = self.budget_bytes - baseline
+        deferred = set()
+        for phase in sorted(phases, key=costs.get):
+            immediate_peak = max([peaks[p] for p in phases if p not in deferred and p != phase], default=0)
+            if sum(costs[p] for p in deferred) + costs[phase] + immediate_peak <= available:
+                deferred.add(phase)
+        self.schedule = { p: p in deferred for p in phases }
+
+        logging.getLogger(__name__).info("Backward schedule: " + ", ".join(
+            f"{p}={'deferred' if self.schedule[p] else 'immediate'} ({costs[p] // 2**20} MB)" for p in phases) +
+            f"; budget {available // 2**20} MB after {baseline // 2**20} MB baseline.")
@@ -1,3 +1,7 @@
+import contextlib
+import logging
+import threading
+import types
 import torch
 from typing import Dict, List
 
@@ -9,8 +13,13 @@ from aldi.align import ALIGN_MIXIN_REGISTRY
 from aldi.distill import DISTILL_MIXIN_REGISTRY
 
 
-def build_aldi(cfg):
-    """Add Align and Distill capabilities to any Meta Architecture dynamically."""
+def build_aldi(cfg, init_weights=True):
+    """Add Align and Distill capabilities to any Meta Architecture dynamically.
+    If init_weights is False, parameters are created on the meta device during construction, so random
+    initialization is skipped, and are then allocated (uninitialized) on cfg.MODEL.DEVICE. Only use this
+    if all weights are loaded from a checkpoint afterwards. With cfg.MODEL.DEVICE "meta", no memory is
+    allocated for weights at all (see ALDITrainer.dry_run).
+    """
     base_cls = META_ARCH_REGISTRY.get(cfg.MODEL.META_ARCHITECTURE)
     align_mixin = ALIGN_MIXIN_REGISTRY.get(cfg.DOMAIN_ADAPT.ALIGN.MIXIN_NAME)
     distill_mixin = DISTILL_MIXIN_REGISTRY.get(cfg.DOMAIN_ADAPT.DISTILL.MIXIN_NAME)
@@ -28,7 +37,122 @@ def build_aldi(cfg):
                     labeled: bool = True, do_align: bool = False):
             return super(ALDI, self).forward(batched_inputs, do_align=do_align, labeled=labeled)
         
-    model = ALDI(cfg)
-    model.to(torch.device(cfg.MODEL.DEVICE))
+    device = torch.device(cfg.MODEL.DEVICE)
+    with contextlib.nullcontext() if init_weights else meta_parameters():
+        model = ALDI(cfg)
+    if not init_weights:
+        materialize(model, device)
+    model.to(device)
+    if cfg.MODEL.COMPILE.ENABLED:
+        compile_modules(model, cfg.MODEL.COMPILE.MODULES,
+                        train_mode=cfg.MODEL.COMPILE.TRAIN_MODE if cfg.MODEL.COMPILE.TRAIN else None,
+                        inference_mode=cfg.MODEL.COMPILE.INFERENCE_MODE if cfg.MODEL.COMPILE.INFERENCE else None,
+                        dynamic=cfg.MODEL.COMPILE.DYNAMIC)
     _log_api_usage("modeling.meta_arch." + cfg.MODEL.META_ARCHITECTURE)
-    return model
\ No newline at end of file
+    return model
+
+
+_meta_parameters = threading.local() # .depth: how many meta_parameters contexts the current thread is in
+_meta_parameters_lock = threading.Lock()
+_meta_parameters_users = 0 # meta_parameters contexts active in any thread
+_register_parameter = None # nn.Module.register_parameter while patched
+
+
+def _register_meta_parameter(module, name, param):
+    _register_parameter(module, name, param)
+    if getattr(_meta_parameters, "depth", 0) and param is not None and not param.is_meta:
+        module._parameters[name] = type(param)(param.data.to("meta"), requires_grad=param.requires_grad)
+
+
+@contextlib.contextmanager
+def meta_parameters():
+    """Within this context, parameters are moved to the meta device as soon as they are registered, so weight
+    initialization does nothing. Buffers are created as usual, since some are not stored in checkpoints
+    (e.g. pixel_mean, anchors). Use `materialize` to allocate the parameters afterwards.
+    nn.Module.register_parameter is patched while any thread is in this context, but only parameters
+    registered by threads in this context are affected. Contexts can be nested."""
+    global _meta_parameters_users, _register_parameter
+    with _meta_parameters_lock:
+        if _meta_parameters_users == 0:
+            _register_parameter = torch.nn.Module.register_parameter
+            torch.nn.Module.register_parameter = _register_meta_parameter
+        _meta_parameters_users += 1
+    _meta_parameters.depth = getattr(_meta_parameters, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _meta_parameters.depth -= 1
+        with _meta_parameters_lock:
+            _meta_parameters_users -= 1
+            if _meta_parameters_users == 0:
+                torch.nn.Module.register_parameter = _register_parameter
+                _register_parameter = None
+
+
+def materialize(model, device):
+    """Replace the meta parameters and buffers of model with uninitialized tensors on device (does nothing for
+    device "meta"). Tensors shared between modules stay shared."""
+    if torch.device(device).type == "meta":
+        return
+    memo = {}
+    for module in model.modules():
+        for tensors in (module._parameters, module._buffers):
+            for name, t in tensors.items():
+                if t is not None and t.is_meta:
+                    if id(t) not in memo:
+                        empty = torch.empty_like(t, device=device)
+                        memo[id(t)] = type(t)(empty, requires_grad=t.requires_grad) if isinstance(t, torch.nn.Parameter) else empty
+                    tensors[name] = memo[id(t)]
+
+
+def compile_modules(model, module_names, train_mode="default", inference_mode="default", dynamic=None):
+    """Compile the forward of the given submodules of model (e.g. "backbone", "roi_heads.box_head") with torch.compile.
+    Compiling the whole ALDI model does not work well: the dynamically created ALDI class, the SaveIO forward hooks,
+    and the Instances/ImageList bookkeeping in the meta architecture and ROI heads all cause graph breaks.
+    Instead, only the forward method of each (tensor-only) submodule is compiled, and nn.Module.__call__ -- including
+    any forward hooks registered on the submodule, such as SaveIO -- still runs eagerly around it.
+
+    Training forward passes (train mode with autograd, i.e. the student) and inference forward passes (no autograd or
+    eval mode, i.e. the teacher, pseudo-labeling, and evaluation) are compiled separately, so that their graphs do
+    not invalidate each other. A mode of None leaves that path uncompiled.
+    Graph breaks found while compiling are logged the first time each path runs.
+    """
+    logger = logging.getLogger(__name__)
+    for name in module_names:
+        try:
+            module = model.get_submodule(name)
+        except AttributeError:
+            logger.warning(f"Not compiling '{name}': {type(model).__name__} has no such submodule.")
+            continue
+        forward = type(module).forward
+        compiled = { "train": torch.compile(forward, mode=train_mode, dynamic=dynamic) if train_mode else None,
+                     "inference": torch.compile(forward, mode=inference_mode, dynamic=dynamic) if inference_mode else None }
+        # the compiled functions and their state are kept on the module and forward is bound to it, so that
+        # copies of the model (e.g. the EMA teacher) call the compiled functions with themselves
+        module._compile_name = name
+        module._compiled_forwards = compiled
+        module._reported_compiles = set()
+        module.forward = types.MethodType(_compiled_forward, module)
+
+
+def _compiled_forward(module, *args, **kwargs):
+    """Forward of a module patched by compile_modules."""
+    path = "train" if module.training and torch.is_grad_enabled() else "inference"
+    forward = module._compiled_forwards[path]
+    if forward is None:
+        return type(module).forward(module, *args, **kwargs)
+    if path in module._reported_compiles:
+        return forward(module, *args, **kwargs)
+
+    breaks = torch._dynamo.utils.counters["graph_break"].copy()
+    ret = forward(module, *args, **kwargs)
+    new_breaks = torch._dynamo.utils.counters["graph_break"] - breaks
+    module._reported_compiles.add(path)
+    name = module._compile_name
+    logger = logging.getLogger(__name__)
+    if new_breaks:
+        logger.warning(f"Compiling {path} forward of '{name}' ({type(module).__name__}) caused {sum(new_breaks.values())} graph breaks:\n" +
+                       "\n".join(f"  {count}x {reason}" for reason, count in new_breaks.items()))
+    else:
+        logger.info(f"Compiled {path} forward of '{name}' ({type(module).__name__}) without graph breaks.")
+    return ret
\ No newline at end of file
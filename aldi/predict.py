@@ -0,0 +1,157 @@
+import io
+import json
+import logging
+import operator
+import os
+import time
+import numpy as np
+import torch
+import torch.utils.data as torchdata
+from PIL import Image
+
+from detectron2.data import detection_utils as utils
+from detectron2.data import transforms as T
+from detectron2.data.common import DatasetFromList
+from detectron2.evaluation.coco_evaluation import instances_to_coco_json
+
+from aldi.dataloader import ShapeGroupedDataset
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+
+def image_dataset_dicts(image_dir):
+    """Dataset dicts for all images in image_dir (recursively), with their path relative to image_dir as image_id."""
+    ret = []
+    for root, dirs, files in os.walk(image_dir):
+        dirs.sort()
+        for f in sorted(files):
+            if f.lower().endswith(IMAGE_EXTENSIONS):
+                file_name = os.path.join(root, f)
+                ret.append({ "file_name": file_name, "image_id": os.path.relpath(file_name, image_dir) })
+    return ret
+
+
+class PredictionMapper:
+    """Read an image and resize it to the test size, like DefaultPredictor. Unlike the test-time DatasetMapper,
+    the original image size is always kept, so that predictions are in original image coordinates, and
+    annotations are never loaded."""
+    def __init__(self, cfg):
+        self.resize = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST)
+        self.image_format = cfg.INPUT.FORMAT
+
+    def __call__(self, dataset_dict):
+        image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
+        return dict(self.preprocess(image), file_name=dataset_dict["file_name"], image_id=dataset_dict["image_id"])
+
+    def decode(self, data):
+        """Model inputs for an encoded image (e.g. the bytes of a JPEG or PNG file), read like utils.read_image
+        reads image files."""
+        image = utils._apply_exif_orientation(Image.open(io.BytesIO(data)))
+        return self.preprocess(utils.convert_PIL_to_numpy(image, self.image_format))
+
+    def preprocess(self, image):
+        """Model inputs for an image (H, W, C) in cfg.INPUT.FORMAT."""
+        resized = self.resize.get_transform(image).apply_image(image)
+        return { "image": torch.as_tensor(np.ascontiguousarray(resized.transpose(2, 0, 1))),
+                 "height": image.shape[0], "width": image.shape[1] }
+
+
+class PredictionDataset(torchdata.Dataset):
+    """Map each dataset dict with mapper. Unlike detectron2.data.common.MapDataset, which retries with other
+    random images if the mapper returns None, every image is mapped exactly once."""
+    def __init__(self, dataset_dicts, mapper):
+        self.dataset_dicts = DatasetFromList(dataset_dicts, copy=False)
+        self.mapper = mapper
+
+    def __len__(self):
+        return len(self.dataset_dicts)
+
+    def __getitem__(self, idx):
+        return self.mapper(self.dataset_dicts[idx])
+
+
+def build_prediction_loader(dataset_dicts, mapper, batch_size, num_workers=0, granularity=64):
+    """Load and batch images for prediction: images are decoded by num_workers processes, and grouped into
+    batches of similar shapes (see ShapeGroupedDataset), so batches are not in dataset order. Every image is
+    loaded exactly once. Memory use is bounded by the DataLoader prefetching and ShapeGroupedDataset buffering."""
+    dataset = PredictionDataset(dataset_dicts, mapper)
+    data_loader = torchdata.DataLoader(dataset, batch_size=1, num_workers=num_workers, collate_fn=operator.itemgetter(0))
+    return ShapeGroupedDataset(data_loader, batch_size, granularity, drop_last=False)
+
+
+class CocoJsonWriter:
+    """Stream detections to a COCO-format results file (a JSON list of {"image_id", "category_id", "bbox", "score"}),
+    without keeping them in memory."""
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.file.write("[")
+        self.empty = True
+
+    def write(self, records):
+        for r in records:
+            self.file.write(("\n" if self.empty else ",\n") + json.dumps(r))
+            self.empty = False
+
+    def close(self):
+        self.file.write("\n]\n")
+        self.file.close()
+
+
+class ParquetWriter:
+    """Stream detections to a Parquet file with one row per detection (image_id, category_id, x, y, w, h, score),
+    writing a row group every row_group_size detections."""
+    COLUMNS = ["image_id", "category_id", "x", "y", "w", "h", "score"]
+
+    def __init__(self, path, row_group_size=100_000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing Parquet files requires pyarrow, e.g. run `pip install pyarrow`.")
+        self.pa = pa
+        self.schema = pa.schema([("image_id", pa.string()), ("category_id", pa.int32())] +
+                                [(c, pa.float32()) for c in self.COLUMNS[2:]])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def write(self, records):
+        self.rows.extend((str(r["image_id"]), r["category_id"], *r["bbox"], r["score"]) for r in records)
+        if len(self.rows) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        columns = list(zip(*self.rows)) if self.rows else [[] for _ in self.COLUMNS]
+        self.writer.write_table(self.pa.table(dict(zip(self.COLUMNS, columns)), schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        if self.rows:
+            self._flush()
+        self.writer.close()
+
+
+def run_predictions(model, data_loader, writer, category_ids=None, log_period=100):
+    """Run model over all batches of data_loader and write its detections (in COCO result format) with writer.
+    Args:
+        category_ids (list[int]): dataset category id of each contiguous class id (default: the class ids)
+    Returns:
+        dict with the number of images and detections, and the throughput in images/s
+    """
+    logger = logging.getLogger(__name__)
+    num_images, num_detections = 0, 0
+    start = time.perf_counter()
+    with torch.no_grad():
+        for i, batch in enumerate(data_loader):
+            for inputs, outputs in zip(batch, model(batch)):
+                records = instances_to_coco_json(outputs["instances"].to("cpu"), inputs["image_id"])
+                if category_ids is not None:
+                    for r in records:
+                        r["category_id"] = category_ids[r["category_id"]]
+                writer.write(records)
+                num_detections += len(records)
+            num_images += len(batch)
+            if (i + 1) % log_period == 0:
+                logger.info(f"Predicted {num_images} images ({num_images / (time.perf_counter() - start):.1f} images/s).")
+    elapsed = time.perf_counter() - start
+    return { "num_images": num_images, "num_detections": num_detections, "images_per_s": num_images / max(elapsed, 1e-9) }
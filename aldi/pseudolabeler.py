@@ -1,6 +1,6 @@
 import torch
 
-from detectron2.structures.boxes import Boxes
+from detectron2.structures.boxes import Boxes, pairwise_iou
 from detectron2.structures.instances import Instances
 
 
@@ -29,6 +29,25 @@ def pseudo_label_inplace(model, unlabeled_weak, unlabeled_strong, threshold):
         if unlabeled_strong is not None:
             add_label(unlabeled_strong, teacher_preds)
 
+def pseudo_label_agreement(predictions, reference_predictions, threshold, iou_threshold=0.5):
+    """Compare the pseudo-labels from predictions (e.g. of a quantized teacher) with the pseudo-labels from
+    reference_predictions (e.g. of the full precision teacher) on the same images. A pseudo-label agrees if
+    the other predictions have a pseudo-label of the same class that overlaps it with IoU >= iou_threshold.
+    Returns:
+        (precision, recall): the fractions of the pseudo-labels from predictions / reference_predictions that agree
+    """
+    agree, total, reference_agree, reference_total = 0, 0, 0, 0
+    labels, _ = process_pseudo_label(predictions, threshold)
+    reference_labels, _ = process_pseudo_label(reference_predictions, threshold)
+    for label, reference_label in zip(labels, reference_labels):
+        match = (pairwise_iou(label.gt_boxes, reference_label.gt_boxes) >= iou_threshold) & \
+                (label.gt_classes[:, None] == reference_label.gt_classes[None, :])
+        agree += match.any(dim=1).sum().item()
+        reference_agree += match.any(dim=0).sum().item()
+        total += len(label)
+        reference_total += len(reference_label)
+    return agree / total if total else 1.0, reference_agree / reference_total if reference_total else 1.0
+
 # Modified from Adaptive Teacher ATeacherTrainer:
 # - Remove RPN option
 def process_pseudo_label(proposals, cur_threshold):
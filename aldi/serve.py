@@ -0,0 +1,177 @@
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+
+
+class LatencyStats:
+    """Thread-safe latency percentiles and throughput of the last `window` requests."""
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.finish_times = collections.deque(maxlen=window)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        """Record a request that took latency seconds and just finished."""
+        with self.lock:
+            self.latencies.append(latency)
+            self.finish_times.append(time.perf_counter())
+            self.count += 1
+
+    def reset(self):
+        """Forget all recorded requests, e.g. after warming up."""
+        with self.lock:
+            self.latencies.clear()
+            self.finish_times.clear()
+            self.count = 0
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            finish_times = list(self.finish_times)
+            ret = { "requests": self.count }
+        if len(latencies) == 0:
+            return ret
+        ret.update({ f"latency_ms_p{p}": float(np.percentile(latencies, p)) for p in (50, 95, 99) })
+        span = finish_times[-1] - finish_times[0]
+        ret["throughput_req_per_s"] = (len(finish_times) - 1) / span if span > 0 else 0.0
+        return ret
+
+
+class DynamicBatcher:
+    """Group concurrent requests into batches: each of num_workers threads takes the oldest waiting request,
+    then waits until at most max_wait_ms after that request arrived for more requests to fill a batch of
+    max_batch_size, and calls predict on the batch. Workers share predict (e.g. one model in eval mode).
+    Requests whose futures were cancelled (e.g. after a timeout) while waiting are skipped.
+    """
+    def __init__(self, predict, max_batch_size=8, max_wait_ms=10, num_workers=1):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.stats = LatencyStats()
+        self.num_batches, self.num_batched = 0, 0
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, inputs):
+        """Queue inputs for prediction. Returns a concurrent.futures.Future of predict's output for them."""
+        future = Future()
+        self.queue.put((time.perf_counter(), inputs, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0][0] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                # once the deadline has passed, only add the requests that are already waiting
+                batch.append(self.queue.get(timeout=max(deadline - time.perf_counter(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = [request for request in self._next_batch() if request[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                with torch.no_grad():
+                    outputs = self.predict([inputs for _, inputs, _ in batch])
+            except Exception as e:
+                logging.getLogger(__name__).exception("Prediction failed.")
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), output in zip(batch, outputs):
+                future.set_result(output)
+            with self.lock:
+                self.num_batches += 1
+                self.num_batched += len(batch)
+
+    def reset_stats(self):
+        """Reset the latency, throughput, and batching stats."""
+        self.stats.reset()
+        with self.lock:
+            self.num_batches, self.num_batched = 0, 0
+
+    def summary(self):
+        """Latency (from when the server receives a request until it responds) and throughput, and batching stats."""
+        ret = self.stats.summary()
+        with self.lock:
+            ret["mean_batch_size"] = self.num_batched / self.num_batches if self.num_batches else 0.0
+        ret["queued"] = self.queue.qsize()
+        return ret
+
+
+def build_server(batcher, preprocess, postprocess, host="127.0.0.1", port=8000, timeout=None):
+    """Local HTTP server for a DynamicBatcher:
+        POST /predict with an encoded image as the body responds with postprocess(prediction) as JSON,
+            where preprocess(body) returns the model inputs for the image. If the prediction takes longer than
+            timeout seconds, responds with 504 instead (and the request is dropped if it is still waiting).
+        POST /stats/reset resets the stats (see DynamicBatcher.reset_stats).
+        GET /stats responds with batcher.summary() as JSON.
+    Each request is handled in its own thread, so images are decoded in parallel.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        # keep connections alive between requests, and don't delay small responses (Nagle's algorithm)
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            if self.path == "/stats/reset":
+                batcher.reset_stats()
+                self._send_json(batcher.summary())
+                return
+            if self.path != "/predict":
+                self.send_error(404)
+                return
+            start = time.perf_counter()
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                inputs = preprocess(body)
+            except Exception as e:
+                self.send_error(400, f"Could not read image: {e}")
+                return
+            future = batcher.submit(inputs)
+            try:
+                result = postprocess(future.result(timeout))
+            except TimeoutError:
+                future.cancel()
+                self.send_error(504, f"Prediction took longer than {timeout} s.")
+                return
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self._send_json(result)
+            batcher.stats.record(time.perf_counter() - start)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                self.send_error(404)
+                return
+            self._send_json(batcher.summary())
+
+        def _send_json(self, obj):
+            data = json.dumps(obj).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # don't log every request
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
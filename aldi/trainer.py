@@ -1,11 +1,15 @@
 import os
 import copy
+import contextlib
 import logging
+import torch
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from detectron2.checkpoint.detection_checkpoint import DetectionCheckpointer
+from detectron2.data import DatasetCatalog
 from detectron2.data.build import build_detection_train_loader, get_detection_dataset_dicts
 from detectron2.engine import hooks, BestCheckpointer
+from detectron2.engine.defaults import create_ddp_model
 from detectron2.evaluation import DatasetEvaluators
 from detectron2.solver import build_optimizer
 from detectron2.utils.events import get_event_storage
@@ -13,11 +17,13 @@ from detectron2.utils import comm
 
 from aldi.aug import WEAK_IMG_KEY, get_augs
 from aldi.backbone import get_adamw_optim
-from aldi.checkpoint import DetectionCheckpointerWithEMA
+from aldi.checkpoint import CompactDetectionCheckpointer, DetectionCheckpointerWithEMA
 from aldi.distill import build_distiller
 from aldi.dropin import DefaultTrainer, AMPTrainer, SimpleTrainer
-from aldi.dataloader import SaveWeakDatasetMapper, UnlabeledDatasetMapper, WeakStrongDataloader
-from aldi.ema import EMA
+from aldi.dataloader import (SaveWeakDatasetMapper, UnlabeledDatasetMapper, WeakStrongDataloader, autotune_num_workers, cpus_per_process,
+                             build_grouped_train_loader, compact_dataset_dicts, padding_waste)
+from aldi.ema import EMA, QuantizedEMA
+from aldi.memory import BackwardScheduler, MicroBatchSizer
 from aldi.helpers import Detectron2COCOEvaluatorAdapter
 from aldi.model import build_aldi
 
@@ -37,10 +43,17 @@ def run_model_labeled_unlabeled(trainer, labeled_weak, labeled_strong, unlabeled
                This is slower, but uses less memory, allowing for larger batch sizes and training larger models that 
                would OOM with backward_at_end=True. Usually, the larger batch size also makes up for the slowdown.
           model_batch_size (int): batch size to feed to the model *per GPU*
+          batch_sizer (MicroBatchSizer): If not None, used to choose the batch size of each phase instead of model_batch_size.
+          ddp_no_sync (bool): If True and backward_at_end=False, only the last backward pass of each step
+               synchronizes gradients across GPUs; gradients of earlier micro-batches are accumulated locally.
+          backward_scheduler (BackwardScheduler): If not None (requires backward_at_end=False), decides per phase whether
+               to call backward after each micro-batch or to defer it to the last backward pass of the step.
      """
      model = trainer.model
      backward_at_end = trainer.backward_at_end
      model_batch_size = trainer.model_batch_size # TODO this could be None
+     batch_sizer = trainer.batch_sizer
+     backward_scheduler = trainer.backward_scheduler
 
      _model = model.module if type(model) == DDP else model
      do_weak = labeled_weak is not None
@@ -49,7 +62,6 @@ def run_model_labeled_unlabeled(trainer, labeled_weak, labeled_strong, unlabeled
      do_distill = trainer.distiller.distill_enabled()
 
      total_batch_size = sum([len(s or []) for s in [labeled_weak, labeled_strong, unlabeled_weak]])
-     num_grad_accum_steps = total_batch_size // model_batch_size
 
      if DEBUG:
           debug_dict['last_labeled_weak'] = copy.deepcopy(labeled_weak)
@@ -58,43 +70,95 @@ def run_model_labeled_unlabeled(trainer, labeled_weak, labeled_strong, unlabeled
           debug_dict['last_unlabeled_strong'] = copy.deepcopy(unlabeled_strong)
 
      loss_dict = {}
-     def add_to_loss_dict(losses, suffix, key_conditional=lambda k: True):
+     def add_to_loss_dict(losses, suffix, weight, key_conditional=lambda k: True):
           """Helper method to add losses to loss_dict.
           Args:
                losses (dict): Dict of losses to add to loss_dict
                suffix (str): Suffix to add to each key in losses
+               weight (float): Fraction of the total batch that produced these losses
                key_conditional (func): Function that takes a key and returns True/False whether to add it to loss_dict
           """
           for k, v in losses.items():
                if key_conditional(k):
-                    v /= num_grad_accum_steps
+                    v = v * weight
                     if not backward_at_end: 
                          v = v.detach()
                     loss_dict[f"{k}_{suffix}"] = loss_dict.get(f"{k}_{suffix}", 0) + v
 
-     def maybe_do_backward(losses, key_conditional=lambda k: True):
-          """Helper method to do backward pass if not doing it at the end."""
+     deferred_losses = []
+     def maybe_do_backward(losses, weight, key_conditional=lambda k: True, name="", last=True):
+          """Helper method to do backward pass if not doing it at the end.
+          Losses of phases the backward scheduler defers are kept until the last backward pass of the step."""
           if not backward_at_end:
                losses = { k: v * 0 if not key_conditional(k) else v for k, v in losses.items() }
-               trainer.do_backward(sum(losses.values()) / num_grad_accum_steps, override=True)
+               loss = sum(losses.values())
+               if backward_scheduler is not None and backward_scheduler.defer(name) and not last:
+                    deferred_losses.append(loss * weight)
+               elif last:
+                    trainer.do_backward(sum(deferred_losses, loss * weight), override=True)
+                    deferred_losses.clear()
+               else:
+                    trainer.do_backward(loss * weight, override=True)
+
+     # only the last backward pass of the step needs to synchronize gradients across GPUs
+     phases = [p for p, enabled in [("source_weak", do_weak), ("source_strong", do_strong), 
+                                    ("target_weak", do_align), ("distill", do_distill)] if enabled]
+     def is_last(name, batch, n):
+          """Helper method to check whether a micro-batch is the last one of the step."""
+          return name == phases[-1] and batch.stop >= n
+
+     def skip_sync(name, batch, n):
+          """Helper method to decide whether to skip DDP gradient synchronization for a micro-batch.
+          Only the last backward pass of the step synchronizes. With a backward scheduler,
+          deferred graphs are backpropagated in the last backward pass, so earlier ones must never synchronize."""
+          ddp_no_sync = trainer.ddp_no_sync or backward_scheduler is not None
+          return not (backward_at_end or is_last(name, batch, n) or not ddp_no_sync or type(model) != DDP)
+
+     def measure(name, batch, n):
+          """Helper method to measure forward pass memory for the backward scheduler, unless the micro-batch
+          sizer is probing the phase."""
+          if backward_scheduler is None or (batch_sizer is not None and batch_sizer.probing(name)):
+               return contextlib.nullcontext()
+          return backward_scheduler.measure(name, batch.stop - batch.start, n)
+
+     def measure_with_backward(name):
+          """Helper method to measure forward and backward pass memory for the micro-batch sizer while it
+          is probing a phase."""
+          if batch_sizer is None:
+               return contextlib.nullcontext()
+          return batch_sizer.measure(name)
+
+     def micro_batches(n, name):
+          """Helper method to split n images into micro-batches (as slices) for gradient accumulation."""
+          if batch_sizer is not None:
+               return batch_sizer.slices(name, n)
+          return (slice(i, i + model_batch_size) for i in range(0, n, model_batch_size))
 
      def do_training_step(data, name="", key_conditional=lambda k: True, **kwargs):
           """Helper method to do a forward pass:
                - Handle gradient accumulation and possible backward passes
                - Handle Detectron2's loss dictionary
           """
-          for batch_i in range(0, len(data), model_batch_size):
-               loss = model(data[batch_i:batch_i+model_batch_size], **kwargs)
-               maybe_do_backward(loss, key_conditional)
-               add_to_loss_dict(loss, name, key_conditional)
+          for batch in micro_batches(len(data), name):
+               weight = len(data[batch]) / total_batch_size
+               no_sync = skip_sync(name, batch, len(data))
+               with model.no_sync() if no_sync else contextlib.nullcontext(), measure_with_backward(name):
+                    with measure(name, batch, len(data)):
+                         loss = model(data[batch], **kwargs)
+                    maybe_do_backward(loss, weight, key_conditional, name, last=is_last(name, batch, len(data)))
+               add_to_loss_dict(loss, name, weight, key_conditional)
 
      def do_distill_step(teacher_data, student_data, name="", key_conditional=lambda k: True, **kwargs):
           assert len(teacher_data) == len(student_data), "Teacher and student data must be the same length."
-          for batch_i in range(0, len(teacher_data), model_batch_size):
-               distill_loss = trainer.distiller(teacher_data[batch_i:batch_i+model_batch_size], 
-                                                student_data[batch_i:batch_i+model_batch_size])
-               maybe_do_backward(distill_loss, key_conditional)
-               add_to_loss_dict(distill_loss, name, key_conditional)
+          for batch in micro_batches(len(teacher_data), name):
+               weight = len(teacher_data[batch]) / total_batch_size
+               no_sync = skip_sync(name, batch, len(teacher_data))
+               with model.no_sync() if no_sync else contextlib.nullcontext(), measure_with_backward(name):
+                    with measure(name, batch, len(teacher_data)):
+                         distill_loss = trainer.distiller(teacher_data[batch], student_data[batch])
+                    maybe_do_backward(distill_loss, weight, key_conditional, name,
+                                      last=is_last(name, batch, len(teacher_data)))
+               add_to_loss_dict(distill_loss, name, weight, key_conditional)
 
      # Weakly-augmented source imagery (Used for normal training and/or domain alignment)
      if do_weak: 
@@ -114,20 +178,40 @@ def run_model_labeled_unlabeled(trainer, labeled_weak, labeled_strong, unlabeled
           if DEBUG: 
             debug_dict['last_pseudolabeled'] = copy.deepcopy(unlabeled_strong)
 
+     if backward_scheduler is not None:
+          backward_scheduler.update(phases)
      return loss_dict
 
 
 # Extend both Detectron2's AMPTrainer and SimpleTrainer classes with DA capabilities
 # Used by DATrainer below in the same way DefaultTrainer uses the original AMP and Simple Trainers
 class _ALDITrainer:
-     def __init__(self, model, data_loader, optimizer, distiller, backward_at_end=True, model_batch_size=None):
+     def __init__(self, model, data_loader, optimizer, distiller, backward_at_end=True, model_batch_size=None, batch_sizer=None,
+                  ddp_no_sync=False, backward_scheduler=None):
           super().__init__(model, data_loader, optimizer, zero_grad_before_forward=not backward_at_end)
+          assert not (backward_scheduler and backward_at_end), "cfg.SOLVER.AUTO_BACKWARD requires cfg.SOLVER.BACKWARD_AT_END=False."
+          # with backward_at_end, the graphs of all micro-batches are kept until the end of the step, so the memory
+          # of one micro-batch does not bound the memory of the step
+          assert not (batch_sizer and backward_at_end), "cfg.SOLVER.AUTO_IMS_PER_GPU requires cfg.SOLVER.BACKWARD_AT_END=False."
           self.distiller = distiller
           self.backward_at_end = backward_at_end
           self.model_batch_size = model_batch_size
+          self.batch_sizer = batch_sizer
+          self.ddp_no_sync = ddp_no_sync
+          self.backward_scheduler = backward_scheduler
 
      def run_model(self, data):
+          self._log_padding_waste(*data)
           return run_model_labeled_unlabeled(self, *data)
+
+     def _log_padding_waste(self, labeled_weak, labeled_strong, unlabeled_weak, unlabeled_strong):
+          """Record the fraction of each batch that is padding (weak and strong images have the same shapes)."""
+          _model = self.model.module if type(self.model) == DDP else self.model
+          size_divisibility = getattr(getattr(_model, "backbone", None), "size_divisibility", 1)
+          storage = get_event_storage()
+          for name, batch in [("labeled", labeled_weak or labeled_strong), ("unlabeled", unlabeled_weak)]:
+               if batch:
+                    storage.put_scalar(f"data/padding_waste_{name}", padding_waste(batch, size_divisibility), smoothing_hint=True)
      
      def do_backward(self, losses, override=False):
         """Disable the final backward pass if we are computing intermediate gradients in run_model.
@@ -140,24 +224,50 @@ class ALDISimpleTrainer(_ALDITrainer, SimpleTrainer): pass
 class ALDITrainer(DefaultTrainer):
      """Modified DefaultTrainer to support Mean Teacher style training."""
      def _create_trainer(self, cfg, model, data_loader, optimizer):
-          # build EMA model if applicable
-          self.ema = EMA(build_aldi(cfg), cfg.EMA.ALPHA, cfg.EMA.START_ITER) if cfg.EMA.ENABLED else None
+          # build EMA model if applicable (copied from the student instead of building and initializing another model)
+          _model = model.module if type(model) == DDP else model
+          self.ema = EMA(_model, cfg.EMA.ALPHA, cfg.EMA.START_ITER, student=model) if cfg.EMA.ENABLED else None
           distiller = build_distiller(cfg=cfg, teacher=self.ema.model if cfg.EMA.ENABLED else model, student=model)
+          # optionally pseudo-label with an int8 copy of the EMA model instead
+          self.quantized_ema = None
+          if cfg.EMA.ENABLED and cfg.EMA.QUANTIZE.ENABLED and hasattr(distiller, "pseudo_labeler"):
+               assert cfg.MODEL.DEVICE == "cpu", "EMA.QUANTIZE.ENABLED requires MODEL.DEVICE cpu."
+               self.quantized_ema = QuantizedEMA(self.ema, cfg.EMA.QUANTIZE.REFRESH_PERIOD, cfg.DOMAIN_ADAPT.TEACHER.THRESHOLD)
+               distiller.pseudo_labeler.model = self.quantized_ema
+          # the main process gets the CPUs that the autotuned dataloader workers leave over (see build_train_loader)
+          if cfg.DATALOADER.AUTOTUNE.ENABLED:
+               num_threads = cfg.DATALOADER.AUTOTUNE.MAIN_PROCESS_THREADS or max(cpus_per_process() - (data_loader.num_workers or 0), 1)
+               logging.getLogger(__name__).info(f"Using {num_threads} torch threads in the main process.")
+               torch.set_num_threads(num_threads)
           trainer = (ALDIAMPTrainer if cfg.SOLVER.AMP.ENABLED else ALDISimpleTrainer)(model, data_loader, optimizer, distiller,
                                                                                   backward_at_end=cfg.SOLVER.BACKWARD_AT_END,
-                                                                                  model_batch_size=cfg.SOLVER.IMS_PER_GPU)
+                                                                                  model_batch_size=cfg.SOLVER.IMS_PER_GPU,
+                                                                                  batch_sizer=MicroBatchSizer.from_config(cfg) if cfg.SOLVER.AUTO_IMS_PER_GPU.ENABLED else None,
+                                                                                  ddp_no_sync=cfg.SOLVER.DDP_NO_SYNC,
+                                                                                  backward_scheduler=BackwardScheduler.from_config(cfg) if cfg.SOLVER.AUTO_BACKWARD.ENABLED else None)
           return trainer
+
+     def create_ddp_model(self, model, broadcast_buffers, cfg):
+          return create_ddp_model(model, broadcast_buffers=broadcast_buffers, bucket_cap_mb=cfg.SOLVER.DDP_BUCKET_CAP_MB)
      
      def _create_checkpointer(self, model, cfg):
           checkpointer = super(ALDITrainer, self)._create_checkpointer(model, cfg, 
-                         ckpt_cls=DetectionCheckpointerWithEMA if cfg. EMA.LOAD_FROM_EMA_ON_START else DetectionCheckpointer)
+                         ckpt_cls=DetectionCheckpointerWithEMA if cfg. EMA.LOAD_FROM_EMA_ON_START else CompactDetectionCheckpointer,
+                         model_dtype=cfg.CHECKPOINT.MODEL_DTYPE, ema_dtype=cfg.CHECKPOINT.EMA_DTYPE, mmap=cfg.CHECKPOINT.MMAP_LOAD)
           if cfg.EMA.ENABLED:
                checkpointer.add_checkpointable("ema", self.ema)
+          if self._resumable_data_loader(cfg):
+               checkpointer.add_checkpointable("dataloader", self._trainer.data_loader)
           return checkpointer
 
+     def _resumable_data_loader(self, cfg):
+          data_loader = self._trainer.data_loader
+          return cfg.DATALOADER.RESUMABLE and isinstance(data_loader, WeakStrongDataloader) and data_loader.resumable()
+
      @classmethod
-     def build_model(cls, cfg):
-          model = build_aldi(cfg)
+     def build_model(cls, cfg, init_weights=True):
+          """See aldi.model.build_aldi for init_weights."""
+          model = build_aldi(cfg, init_weights=init_weights)
           logger = logging.getLogger(__name__)
           logger.info("Model:\n{}".format(model))
           print(model) # TODO: Not sure why logging not working
@@ -173,6 +283,13 @@ class ALDITrainer(DefaultTrainer):
      def build_hooks(self):
           ret = super(ALDITrainer, self).build_hooks()
 
+          # gather the dataloader state of all workers after every step, so that it is up to date whenever
+          # a checkpoint is saved (only the main process saves them). The state is a few integers per loader.
+          if self._resumable_data_loader(self.cfg) and comm.get_world_size() > 1:
+               def sync_data_loader_state(trainer):
+                    trainer._trainer.data_loader.sync_state()
+               ret.insert(0, hooks.CallbackHook(after_step=sync_data_loader_state))
+
           # add hooks to evaluate/save teacher model if applicable
           if self.cfg.EMA.ENABLED:
                def test_and_save_results_ema():
@@ -186,12 +303,13 @@ class ALDITrainer(DefaultTrainer):
 
           # add a hook to save the best (teacher, if EMA enabled) checkpoint to model_best.pth
           if comm.is_main_process():
+               best_checkpointer = self.checkpointer if self.cfg.CHECKPOINT.BEST_INCLUDE_TRAINER_STATE else self.checkpointer.lean_copy()
                if len(self.cfg.DATASETS.TEST) == 1:
-                    ret.insert(-1, BestCheckpointer(self.cfg.TEST.EVAL_PERIOD, self.checkpointer,
+                    ret.insert(-1, BestCheckpointer(self.cfg.TEST.EVAL_PERIOD, best_checkpointer,
                                                     f"bbox/AP50", "max", file_prefix=f"{self.cfg.DATASETS.TEST[0]}_model_best"))
                else: 
                     for test_set in self.cfg.DATASETS.TEST:
-                         ret.insert(-1, BestCheckpointer(self.cfg.TEST.EVAL_PERIOD, self.checkpointer,
+                         ret.insert(-1, BestCheckpointer(self.cfg.TEST.EVAL_PERIOD, best_checkpointer,
                                                     f"{test_set}/bbox/AP50", "max", file_prefix=f"{test_set}_model_best"))
           return ret
      
@@ -208,7 +326,8 @@ class ALDITrainer(DefaultTrainer):
                raise ValueError(f"Unsupported optimizer/backbone combination {cfg.SOLVER.OPTIMIZER} {cfg.MODEL.BACKBONE.NAME}.")
 
      @classmethod
-     def build_train_loader(cls, cfg):
+     def _labeled_unlabeled_batch_sizes(cls, cfg):
+          """Split cfg.SOLVER.IMS_PER_BATCH between the labeled and unlabeled dataloaders according to cfg.DATASETS.BATCH_RATIOS."""
           batch_contents = cfg.DATASETS.BATCH_CONTENTS
           batch_ratios = cfg.DATASETS.BATCH_RATIOS
           total_batch_size = cfg.SOLVER.IMS_PER_BATCH
@@ -220,28 +339,80 @@ class ALDITrainer(DefaultTrainer):
           labeled_bs = max(labeled_bs) if len(labeled_bs) else 0
           unlabeled_bs = [batch_sizes[i] for i in range(len(batch_contents)) if batch_contents[i].startswith("unlabeled")]
           unlabeled_bs = max(unlabeled_bs) if len(unlabeled_bs) else 0
+          return labeled_bs, unlabeled_bs
 
-          # create labeled dataloader
-          labeled_loader = None
-          if labeled_bs > 0 and len(cfg.DATASETS.TRAIN):
-               labeled_loader = build_detection_train_loader(get_detection_dataset_dicts(cfg.DATASETS.TRAIN, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS), 
-                    mapper=SaveWeakDatasetMapper(cfg, is_train=True, augmentations=get_augs(cfg, labeled=True, include_strong_augs="labeled_strong" in batch_contents)),
-                    num_workers=cfg.DATALOADER.NUM_WORKERS, 
-                    total_batch_size=labeled_bs)
+     @classmethod
+     def build_train_loader(cls, cfg):
+          batch_contents = cfg.DATASETS.BATCH_CONTENTS
+          labeled_bs, unlabeled_bs = cls._labeled_unlabeled_batch_sizes(cfg)
 
-          # create unlabeled dataloader
-          unlabeled_loader = None
+          # set up labeled and unlabeled data pipelines
+          # unlabeled images don't need annotations, and labeled ones can use compact annotations if masks/keypoints are not needed
+          compact = cfg.DATALOADER.COMPACT_ANNOTATIONS
+          pipelines = {}
+          if labeled_bs > 0 and len(cfg.DATASETS.TRAIN):
+               dataset_dicts = get_detection_dataset_dicts(cfg.DATASETS.TRAIN, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS)
+               if compact and not (cfg.MODEL.MASK_ON or cfg.MODEL.KEYPOINT_ON):
+                    dataset_dicts = compact_dataset_dicts(dataset_dicts)
+               pipelines["labeled"] = (dataset_dicts, 
+                    SaveWeakDatasetMapper(cfg, is_train=True, augmentations=get_augs(cfg, labeled=True, include_strong_augs="labeled_strong" in batch_contents)),
+                    labeled_bs)
           if unlabeled_bs > 0 and len(cfg.DATASETS.UNLABELED):
-               unlabeled_loader = build_detection_train_loader(get_detection_dataset_dicts(cfg.DATASETS.UNLABELED, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS), 
-                    mapper=UnlabeledDatasetMapper(cfg, is_train=True, augmentations=get_augs(cfg, labeled=False, include_strong_augs="unlabeled_strong" in batch_contents)),
-                    num_workers=cfg.DATALOADER.NUM_WORKERS,
-                    total_batch_size=unlabeled_bs)
+               dataset_dicts = get_detection_dataset_dicts(cfg.DATASETS.UNLABELED, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS)
+               if compact:
+                    dataset_dicts = compact_dataset_dicts(dataset_dicts, keep_annotations=False)
+               pipelines["unlabeled"] = (dataset_dicts, 
+                    UnlabeledDatasetMapper(cfg, is_train=True, augmentations=get_augs(cfg, labeled=False, include_strong_augs="unlabeled_strong" in batch_contents)),
+                    unlabeled_bs)
+
+          # split dataloader workers between pipelines if applicable
+          num_workers = { k: cfg.DATALOADER.NUM_WORKERS for k in pipelines }
+          if cfg.DATALOADER.AUTOTUNE.ENABLED and len(pipelines):
+               num_cpus = cpus_per_process()
+               total_workers = cfg.DATALOADER.AUTOTUNE.TOTAL_WORKERS or max(num_cpus - (cfg.DATALOADER.AUTOTUNE.MAIN_PROCESS_THREADS or 1), 1)
+               num_workers = dict(zip(pipelines, autotune_num_workers(list(pipelines.values()), total_workers, 
+                                                                      cfg.DATALOADER.AUTOTUNE.WARMUP_IMAGES)))
+
+          # create labeled and unlabeled dataloaders
+          if cfg.DATALOADER.RESUMABLE or cfg.DATALOADER.SHAPE_GROUPING.ENABLED:
+               granularity = cfg.DATALOADER.SHAPE_GROUPING.GRANULARITY if cfg.DATALOADER.SHAPE_GROUPING.ENABLED else None
+               loaders = { k: build_grouped_train_loader(dataset_dicts, mapper, batch_size, num_workers=num_workers[k], granularity=granularity)
+                           for k, (dataset_dicts, mapper, batch_size) in pipelines.items() }
+          else:
+               loaders = { k: build_detection_train_loader(dataset_dicts, mapper=mapper, num_workers=num_workers[k], total_batch_size=batch_size)
+                           for k, (dataset_dicts, mapper, batch_size) in pipelines.items() }
+          labeled_loader, unlabeled_loader = loaders.get("labeled"), loaders.get("unlabeled")
 
-          return WeakStrongDataloader(labeled_loader, unlabeled_loader, batch_contents)
+          return WeakStrongDataloader(labeled_loader, unlabeled_loader, batch_contents, num_workers=sum(num_workers.values()))
      
+     @classmethod
+     def dry_run(cls, cfg):
+          """Check that a config is valid without allocating any weights or loading any data: check that its datasets
+          are registered and its batch composition is valid, and build the model, EMA teacher, distiller, optimizer, 
+          and LR scheduler on the meta device."""
+          cfg = cfg.clone()
+          cfg.defrost()
+          cfg.MODEL.DEVICE = "meta"
+          cfg.MODEL.COMPILE.ENABLED = False
+
+          registered = DatasetCatalog.list()
+          for name in cfg.DATASETS.TRAIN + cfg.DATASETS.UNLABELED + cfg.DATASETS.TEST:
+               assert name in registered, f"Dataset '{name}' is not registered."
+          cls._labeled_unlabeled_batch_sizes(cfg)
+
+          model = cls.build_model(cfg, init_weights=False)
+          ema = EMA(model, cfg.EMA.ALPHA, cfg.EMA.START_ITER, student=model) if cfg.EMA.ENABLED else None
+          build_distiller(cfg=cfg, teacher=ema.model if cfg.EMA.ENABLED else model, student=model)
+          optimizer = cls.build_optimizer(cfg, model)
+          cls.build_lr_scheduler(cfg, optimizer)
+          logging.getLogger(__name__).info(f"Dry run succeeded: built a model with {sum(p.numel() for p in model.parameters()) / 1e6:.1f}M parameters.")
+          return model
+
      def before_step(self):
           """Update the EMA model every step."""
           super(ALDITrainer, self).before_step()
           if self.cfg.EMA.ENABLED:
                self.ema.update_weights(self._trainer.model, self.iter)
+               if self.quantized_ema is not None:
+                    self.quantized_ema.update_weights(self.iter)
                
\ No newline at end of file
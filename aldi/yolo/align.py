@@ -4,7 +4,7 @@ import torch.nn.functional as F
 from detectron2.config import configurable
 
 from aldi.align import ConvDiscriminator, ALIGN_MIXIN_REGISTRY
-from aldi.helpers import SaveIO, grad_reverse
+from aldi.helpers import SaveIO, capture, grad_reverse
 
 from .libs.Yolo_Detectron2.yolo_detectron2 import Yolo
 
@@ -32,16 +32,14 @@ class YoloAlignMixin(Yolo):
 
         self.img_align = ConvDiscriminator(768, hidden_dims=[256]) if img_da_enabled else None # TODO dims; same as Yolo
 
-        # register hooks so we can grab output of sub-modules
+        # register hooks so we can grab output of sub-modules (only saved within forward passes that do alignment)
         # allow for img_da_layer to specify either p3, p4, or p5 as the alignment layer
-        self.backbone_io = {
-            "p3": SaveIO(),
-            "p4": SaveIO(),
-            "p5": SaveIO(),
-        }
-        self.model[17].register_forward_hook(self.backbone_io["p3"])
-        self.model[20].register_forward_hook(self.backbone_io["p4"])
-        self.model[23].register_forward_hook(self.backbone_io["p5"])
+        self.backbone_io = None
+        self.align_hook_handles = []
+        if img_da_enabled:
+            self.backbone_io = SaveIO()
+            self.align_hook_handles.append(
+                self.model[{"p3": 17, "p4": 20, "p5": 23}[img_da_layer]].register_forward_hook(self.backbone_io))
 
     @classmethod
     def from_config(cls, cfg):
@@ -56,26 +54,36 @@ class YoloAlignMixin(Yolo):
 
         return ret
 
+    def remove_alignment(self):
+        """Remove the alignment head and the hook that captures its input (e.g. for an inference-only teacher)."""
+        for handle in self.align_hook_handles:
+            handle.remove()
+        self.align_hook_handles = []
+        self.img_align = None
+        self.backbone_io = None
+
     def forward(self, *args, do_align=False, labeled=True, **kwargs):
-        output = super().forward(*args, **kwargs)
-        if self.training:
-            if do_align and self.img_align:
-                if self.img_align:
-                    # extract needed info for alignment: domain labels, image features, instance features
-                    domain_label = 1 if labeled else 0
-                    features = self.backbone_io[self.img_da_layer].output
-                    features = grad_reverse(features)
-                    domain_preds = self.img_align(features)
-                    loss = F.binary_cross_entropy_with_logits(domain_preds, torch.FloatTensor(domain_preds.data.size()).fill_(domain_label).to(features.device))
-                    output["loss_da_img"] = self.img_da_weight * loss
-            elif self.img_align:
-                # need to utilize the modules at some point during the forward pass or PyTorch complains.
-                # this is only an issue when cfg.SOLVER.BACKWARD_AT_END=False, because intermediate backward()
-                # calls may not have used alignment heads
-                # see: https://github.com/pytorch/pytorch/issues/43259#issuecomment-964284292
-                fake_output = 0
-                for aligner in [self.img_align]:
-                    if aligner is not None:
-                        fake_output += sum([p.sum() for p in aligner.parameters()]) * 0
-                output["_da"] = fake_output
+        # the backbone output needed for alignment is released as soon as the alignment loss is computed
+        with capture(self.backbone_io, enabled=self.training and do_align):
+            output = super().forward(*args, **kwargs)
+            if self.training:
+                if do_align and self.img_align:
+                    if self.img_align:
+                        # extract needed info for alignment: domain labels, image features, instance features
+                        domain_label = 1 if labeled else 0
+                        features = self.backbone_io.output
+                        features = grad_reverse(features)
+                        domain_preds = self.img_align(features)
+                        loss = F.binary_cross_entropy_with_logits(domain_preds, torch.FloatTensor(domain_preds.data.size()).fill_(domain_label).to(features.device))
+                        output["loss_da_img"] = self.img_da_weight * loss
+                elif self.img_align:
+                    # need to utilize the modules at some point during the forward pass or PyTorch complains.
+                    # this is only an issue when cfg.SOLVER.BACKWARD_AT_END=False, because intermediate backward()
+                    # calls may not have used alignment heads
+                    # see: https://github.com/pytorch/pytorch/issues/43259#issuecomment-964284292
+                    fake_output = 0
+                    for aligner in [self.img_align]:
+                        if aligner is not None:
+                            fake_output += sum([p.sum() for p in aligner.parameters()]) * 0
+                    output["_da"] = fake_output
         return output
\ No newline at end of file
@@ -5,7 +5,7 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from detectron2.layers.wrappers import cross_entropy
 
 from aldi.distill import DISTILLER_REGISTRY, DISTILL_MIXIN_REGISTRY, Distiller
-from aldi.helpers import SaveIO, set_attributes
+from aldi.helpers import SaveIO, capture, set_attributes
 from aldi.pseudolabeler import PseudoLabeler
 
 from .libs.Yolo_Detectron2.yolo_detectron2 import Yolo
@@ -73,8 +73,10 @@ class YoloDistiller(Distiller):
 
         standard_losses = self.student(student_batched_inputs)
 
-        with torch.no_grad():
-            self.teacher(teacher_batched_inputs)
+        # the teacher forward pass only provides the head outputs for the soft losses
+        if self.soft_distill_enabled():
+            with torch.no_grad():
+                self.teacher(teacher_batched_inputs)
         
         # return to eval mode if necessary
         if was_eval: 
@@ -85,26 +87,33 @@ class YoloDistiller(Distiller):
     def __call__(self, teacher_batched_inputs, student_batched_inputs):
         losses = {}
 
-        # Do a forward pass to get activations, and get hard pseudo-label losses if desired
-        hard_losses = self._distill_forward(teacher_batched_inputs, student_batched_inputs)
-        loss_to_attr = {
-            "loss_cls": self.do_hard_cls,
-            "loss_obj": self.do_hard_obj,
-            "loss_box": self.do_hard_roi_reg,
-        }
-        for k, v in hard_losses.items():
-            if loss_to_attr.get(k, False):
-                losses[k] = v
-            else:
-                # Need to add to standard losses so that the optimizer can see it
-                losses[k] = v * 0.0
-
-        losses.update(self.get_yolo_soft_losses(student_batched_inputs))
-        if self.do_roih_reg_dst:
-            # soft reg = hard reg
-            losses.update({"loss_soft_reg": hard_losses["loss_box"]}) 
+        # head outputs are only saved within this scope if soft losses are enabled, and released once the losses are computed
+        with capture(self.student_head_io, self.teacher_head_io, enabled=self.soft_distill_enabled()):
+            # Do a forward pass to get activations, and get hard pseudo-label losses if desired
+            hard_losses = self._distill_forward(teacher_batched_inputs, student_batched_inputs)
+            loss_to_attr = {
+                "loss_cls": self.do_hard_cls,
+                "loss_obj": self.do_hard_obj,
+                "loss_box": self.do_hard_roi_reg,
+            }
+            for k, v in hard_losses.items():
+                if loss_to_attr.get(k, False):
+                    losses[k] = v
+                else:
+                    # Need to add to standard losses so that the optimizer can see it
+                    losses[k] = v * 0.0
+
+            if self.soft_distill_enabled():
+                losses.update(self.get_yolo_soft_losses(student_batched_inputs))
+            if self.do_roih_reg_dst:
+                # soft reg = hard reg
+                losses.update({"loss_soft_reg": hard_losses["loss_box"]}) 
 
         return losses
+
+    def soft_distill_enabled(self):
+        """Whether any loss needs the student and teacher head outputs."""
+        return self.do_cls_dst or self.do_obj_dst
     
     def get_yolo_soft_losses(self, student_batched_inputs):
         student_logits = self.student_head_io.output
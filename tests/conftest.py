@@ -0,0 +1,52 @@
+import os
+
+import pytest
+import torch
+
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), "..", "configs")
+
+
+@pytest.fixture
+def tiny_cfg():
+    """Config for a small randomly initialized ALDI Faster R-CNN (ResNet-18 FPN) on CPU."""
+    pytest.importorskip("detectron2")
+    from detectron2.config import get_cfg
+    from aldi.config import add_aldi_config
+    import aldi.align # register align mixins with Detectron2
+    import aldi.distill # register distillers and distill mixins with Detectron2
+    import aldi.model # register ALDI R-CNN model with Detectron2
+
+    cfg = get_cfg()
+    add_aldi_config(cfg)
+    cfg.merge_from_file(os.path.join(CONFIG_DIR, "Base-RCNN-FPN.yaml"))
+    cfg.merge_from_list(["MODEL.DEVICE", "cpu",
+                         "MODEL.WEIGHTS", "",
+                         "MODEL.RESNETS.DEPTH", 18,
+                         "MODEL.RESNETS.RES2_OUT_CHANNELS", 64,
+                         "MODEL.ROI_HEADS.NUM_CLASSES", 3,
+                         "MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE", 32,
+                         "MODEL.RPN.BATCH_SIZE_PER_IMAGE", 32,
+                         "MODEL.RPN.POST_NMS_TOPK_TRAIN", 64,
+                         "MODEL.RPN.POST_NMS_TOPK_TEST", 64,
+                         "INPUT.MIN_SIZE_TEST", 128,
+                         "INPUT.MAX_SIZE_TEST", 256,
+                         "SOLVER.AMP.ENABLED", False])
+    return cfg
+
+
+@pytest.fixture
+def make_inputs():
+    """Returns a function that makes n model inputs of random images with random boxes."""
+    def make(n, height=96, width=128, num_boxes=3, num_classes=3, seed=0):
+        from detectron2.structures import Boxes, Instances
+        generator = torch.Generator().manual_seed(seed)
+        ret = []
+        for _ in range(n):
+            xy = torch.rand(num_boxes, 2, generator=generator) * torch.tensor([width / 2, height / 2])
+            wh = 8 + torch.rand(num_boxes, 2, generator=generator) * torch.tensor([width / 2 - 8, height / 2 - 8])
+            instances = Instances((height, width), gt_boxes=Boxes(torch.cat([xy, xy + wh], dim=1)),
+                                  gt_classes=torch.randint(num_classes, (num_boxes,), generator=generator))
+            ret.append({ "image": torch.randint(256, (3, height, width), generator=generator, dtype=torch.uint8).float(),
+                         "height": height, "width": width, "instances": instances })
+        return ret
+    return make
@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("detectron2")
+
+from aldi.ema import EMA
+from aldi.model import build_aldi
+
+
+def test_teacher_removes_alignment_hooks_only_from_itself(tiny_cfg, make_inputs):
+    tiny_cfg.merge_from_list(["DOMAIN_ADAPT.ALIGN.IMG_DA_ENABLED", True, "DOMAIN_ADAPT.ALIGN.INS_DA_ENABLED", True])
+    student = build_aldi(tiny_cfg).train()
+    assert len(student.backbone._forward_hooks) == 1
+    assert len(student.roi_heads.box_head._forward_hooks) == 1
+
+    teacher = EMA(student, 0.999, student=student).model
+    assert teacher.img_align is None and teacher.ins_align is None
+    assert len(teacher.backbone._forward_hooks) == 0
+    assert len(teacher.roi_heads.box_head._forward_hooks) == 0
+
+    # the student still captures the inputs of its alignment heads
+    assert len(student.backbone._forward_hooks) == 1
+    assert len(student.roi_heads.box_head._forward_hooks) == 1
+    losses = student(make_inputs(2), do_align=True)
+    assert {"loss_da_img", "loss_da_ins"} <= set(losses)
@@ -18,6 +18,14 @@ find configs/cityscapes/ -type f -name '*.yaml' | while read -r CONFIG; do
     continue
   fi
   
+  # check that everything can be built on the meta device without loading data or weights
+  python tools/train_net.py --config "$CONFIG" --dry-run \
+    >> "$OUTPUT_FILE" 2> temp.err
+  if [ $? -ne 0 ]; then
+    echo "Error encountered during dry run with config: $CONFIG"
+    cat temp.err
+  fi
+
   # smoke test for train_net
   timeout 15s python tools/train_net.py --config "$CONFIG" SOLVER.MAX_ITER 1 \
     >> "$OUTPUT_FILE" 2> temp.err
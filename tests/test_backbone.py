@@ -0,0 +1,181 @@
+import copy
+from functools import partial
+
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from detectron2.modeling.backbone.vit import Attention
+
+from aldi.backbone import ConvNeXt, LayerNorm, SDPAAttention, ViTCheckpointPolicy, checkpointed_vit_forward
+from aldi.memory import PeakMemoryMeter
+
+
+class ToyBlock(torch.nn.Module):
+    """Stand-in for a ViT block: global attention blocks (window_size 0) have larger activations."""
+    def __init__(self, dim, window_size):
+        super().__init__()
+        self.window_size = window_size
+        hidden = dim * (8 if window_size == 0 else 2)
+        self.mlp = torch.nn.Sequential(torch.nn.Linear(dim, hidden), torch.nn.GELU(), torch.nn.Linear(hidden, dim))
+
+    def forward(self, x):
+        return x + self.mlp(x)
+
+
+class ToyPatchEmbed(torch.nn.Conv2d):
+    def forward(self, x):
+        return super().forward(x).permute(0, 2, 3, 1) # channels last, like detectron2's PatchEmbed
+
+
+class ToyViT(torch.nn.Module):
+    """Stand-in for detectron2's ViT with the attributes used by checkpointed_vit_forward."""
+    def __init__(self, dim=32, depth=8, window_block_indexes=(0, 1, 2, 4, 5, 6), policy=None):
+        super().__init__()
+        self.patch_embed = ToyPatchEmbed(3, dim, kernel_size=8, stride=8)
+        self.pos_embed = None
+        self.blocks = torch.nn.ModuleList(ToyBlock(dim, 4 if i in window_block_indexes else 0) for i in range(depth))
+        self._out_features = ["last_feat"]
+        self.forward = partial(checkpointed_vit_forward, self, True, policy=policy)
+
+
+def make_vit(policy):
+    torch.manual_seed(0)
+    return ToyViT(policy=policy)
+
+
+def activation_bytes(vit, x):
+    """Bytes saved for backward by a training forward pass of vit."""
+    with PeakMemoryMeter("cpu") as meter:
+        vit(x)
+    return meter.peak
+
+
+def test_budget_policy_fits_budget():
+    x = torch.randn(2, 3, 64, 64)
+    all_checkpointed = activation_bytes(make_vit(ViTCheckpointPolicy("all")), x)
+    none_checkpointed = activation_bytes(make_vit(ViTCheckpointPolicy("every_k", every_k=100)), x)
+    budget_bytes = (none_checkpointed - all_checkpointed) // 2
+
+    policy = ViTCheckpointPolicy("budget", budget_bytes=budget_bytes)
+    vit = make_vit(policy)
+    # the first forward pass measures blocks, inside a measurement of the whole forward pass (like MicroBatchSizer)
+    measuring = activation_bytes(vit, x)
+    checkpointed = policy._budget_choices[2 * 8 * 8]
+    assert 0 < len(checkpointed) < len(vit.blocks)
+    is_global = [blk.window_size == 0 for blk in vit.blocks]
+    # global blocks use the most memory, so they are checkpointed first
+    assert all(is_global[i] for i in checkpointed) or all(i in checkpointed for i in range(len(vit.blocks)) if is_global[i])
+
+    # the enclosing measurement includes the blocks that were measured without checkpointing
+    assert measuring > all_checkpointed
+    # with the chosen blocks checkpointed, the activations of the other blocks fit the budget
+    assert activation_bytes(vit, x) - all_checkpointed <= budget_bytes
+
+def test_budget_policy_measures_once_and_scales_with_tokens(monkeypatch):
+    x = torch.randn(1, 3, 64, 64)
+    policy = ViTCheckpointPolicy("budget", budget_bytes=activation_bytes(make_vit(ViTCheckpointPolicy("every_k", every_k=100)), x))
+    vit = make_vit(policy)
+    vit(x)
+    assert policy._budget_choices[8 * 8] == set() # all activations fit the budget
+
+    meters = []
+    monkeypatch.setattr("aldi.backbone.PeakMemoryMeter", lambda device: meters.append(device) or PeakMemoryMeter(device))
+    vit(torch.randn(1, 3, 64, 96)) # 1.5x the tokens: global blocks are checkpointed first
+    vit(torch.randn(3, 3, 64, 64)) # 3x the tokens: most blocks are checkpointed
+    assert len(meters) == 0
+    assert 0 < len(policy._budget_choices[8 * 12]) < len(policy._budget_choices[3 * 8 * 8]) < len(vit.blocks)
+    assert all(vit.blocks[i].window_size == 0 for i in policy._budget_choices[8 * 12])
+
+
+def test_no_checkpointing_without_gradients():
+    vit = make_vit(ViTCheckpointPolicy("all"))
+    x = torch.randn(1, 3, 64, 64)
+    with torch.no_grad():
+        y = vit(x)["last_feat"]
+    assert torch.allclose(y, vit.eval()(x)["last_feat"])
+
+
+@pytest.mark.parametrize("use_rel_pos", [True, False])
+@pytest.mark.parametrize("training", [True, False])
+@pytest.mark.parametrize("size", [(7, 7), (6, 10)])
+def test_sdpa_attention_matches_explicit_attention(use_rel_pos, training, size):
+    torch.manual_seed(0)
+    attn = Attention(64, num_heads=4, use_rel_pos=use_rel_pos, input_size=size).train(training)
+    if use_rel_pos:
+        # relative position embeddings are initialized to zero; use random values so they are tested
+        for p in [attn.rel_pos_h, attn.rel_pos_w]:
+            torch.nn.init.trunc_normal_(p, std=0.5)
+    sdpa_attn = copy.deepcopy(attn)
+    sdpa_attn.__class__ = SDPAAttention
+
+    x = torch.randn(2, *size, 64)
+    outputs, grads = [], []
+    for module in [attn, sdpa_attn]:
+        x_i = x.clone().requires_grad_()
+        out = module(x_i)
+        out.pow(2).mean().backward()
+        outputs.append(out.detach())
+        grads.append([x_i.grad] + [p.grad for p in module.parameters()])
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-5)
+    for g0, g1 in zip(*grads):
+        assert torch.allclose(g0, g1, atol=1e-5)
+
+
+def make_convnext(**kwargs):
+    torch.manual_seed(0)
+    return ConvNeXt(depths=[1, 1, 2, 1], dims=[8, 16, 32, 64], out_features=[1, 2, 3], **kwargs)
+
+
+def test_convnext_outputs_match_in_both_memory_formats():
+    x = torch.randn(2, 3, 64, 96)
+    outputs = {}
+    for channels_last in [False, True]:
+        convnext = make_convnext(channels_last=channels_last).eval()
+        outputs[channels_last] = convnext(x)
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        for out in outputs[channels_last].values():
+            assert out.is_contiguous(memory_format=memory_format)
+    for k, out in outputs[False].items():
+        assert torch.allclose(out, outputs[True][k], atol=1e-5), k
+
+
+def test_channels_first_layer_norm_keeps_memory_format():
+    norm = LayerNorm(8, data_format="channels_first")
+    x = torch.randn(2, 8, 5, 7)
+    y = norm(x)
+    assert y.is_contiguous()
+    y_channels_last = norm(x.contiguous(memory_format=torch.channels_last))
+    assert y_channels_last.is_contiguous(memory_format=torch.channels_last)
+    assert torch.allclose(y, y_channels_last)
+
+
+def test_convnext_checkpointing_gives_same_gradients_with_drop_path():
+    x = torch.randn(2, 3, 64, 96)
+    grads = {}
+    for act_checkpoint in ["none", "stage", "block"]:
+        convnext = make_convnext(drop_path_rate=0.5, act_checkpoint=act_checkpoint).train()
+        torch.manual_seed(1) # same DropPath masks
+        sum(out.sum() for out in convnext(x).values()).backward()
+        grads[act_checkpoint] = { k: p.grad for k, p in convnext.named_parameters() if p.grad is not None }
+    for act_checkpoint in ["stage", "block"]:
+        assert set(grads[act_checkpoint]) == set(grads["none"])
+        for k, grad in grads["none"].items():
+            assert torch.allclose(grad, grads[act_checkpoint][k], atol=1e-6), (act_checkpoint, k)
+
+
+@pytest.mark.parametrize("act_checkpoint", ["stage", "block"])
+def test_convnext_does_not_checkpoint_without_gradients(monkeypatch, act_checkpoint):
+    calls = []
+    def counting_checkpoint(function, *args, **kwargs):
+        calls.append(function)
+        return torch.utils.checkpoint.checkpoint(function, *args, **kwargs)
+    monkeypatch.setattr("aldi.backbone.checkpoint", counting_checkpoint)
+    convnext = make_convnext(act_checkpoint=act_checkpoint).train()
+    x = torch.randn(1, 3, 64, 64)
+    with torch.no_grad():
+        convnext(x)
+    assert len(calls) == 0
+    convnext(x)
+    assert len(calls) == (4 if act_checkpoint == "stage" else 5)
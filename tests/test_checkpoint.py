@@ -0,0 +1,104 @@
+import os
+
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from aldi.checkpoint import CompactDetectionCheckpointer, DetectionCheckpointerWithEMA, _cast_state_dict
+
+
+class ToyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(4, 4)
+        self.norm = torch.nn.BatchNorm1d(4)
+
+
+def test_cast_state_dict_keeps_metadata():
+    state_dict = ToyModel().state_dict()
+    cast = _cast_state_dict(state_dict, torch.float16)
+    assert cast["linear.weight"].dtype == torch.float16
+    assert cast["norm.num_batches_tracked"].dtype == torch.int64
+    assert cast._metadata == state_dict._metadata
+
+
+def test_half_precision_round_trip(tmp_path):
+    torch.manual_seed(0)
+    model = ToyModel()
+    checkpointer = CompactDetectionCheckpointer(model, save_dir=str(tmp_path), save_to_disk=True,
+                                               model_dtype="float16")
+    checkpointer.save("model")
+    saved = torch.load(tmp_path / "model.pth")
+    assert saved["model"]["linear.weight"].dtype == torch.float16
+    assert model.linear.weight.dtype == torch.float32 # the model itself is not cast
+
+    loaded = ToyModel()
+    CompactDetectionCheckpointer(loaded).load(str(tmp_path / "model.pth"))
+    assert loaded.linear.weight.dtype == torch.float32
+    assert torch.equal(loaded.linear.weight, model.linear.weight.half().float())
+
+
+def test_lean_copy_does_not_tag_last_checkpoint(tmp_path):
+    trainer_state = ToyModel() # stands in for the trainer's state
+    checkpointer = CompactDetectionCheckpointer(ToyModel(), save_dir=str(tmp_path), save_to_disk=True,
+                                               trainer=trainer_state)
+    checkpointer.save("model_0000009")
+    checkpointer.lean_copy().save("model_best")
+    assert checkpointer.get_checkpoint_file() == str(tmp_path / "model_0000009.pth")
+    assert "trainer" in torch.load(tmp_path / "model_0000009.pth", weights_only=False)
+    assert "trainer" not in torch.load(tmp_path / "model_best.pth", weights_only=False)
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_mmap_load_falls_back_for_legacy_files(tmp_path, legacy):
+    torch.manual_seed(0)
+    model = ToyModel()
+    path = str(tmp_path / "model.pth")
+    torch.save({"model": model.state_dict()}, path, _use_new_zipfile_serialization=not legacy)
+    assert os.path.exists(path)
+
+    loaded = ToyModel()
+    CompactDetectionCheckpointer(loaded, mmap=True).load(path)
+    for k, v in model.state_dict().items():
+        assert torch.equal(loaded.state_dict()[k], v), k
+
+
+def _save_student_and_ema(path):
+    """Save a checkpoint whose student and EMA weights differ. The EMA model lacks the BatchNorm weights."""
+    student, ema = ToyModel(), ToyModel()
+    torch.nn.init.zeros_(student.linear.weight)
+    torch.nn.init.ones_(ema.linear.weight)
+    torch.nn.init.constant_(student.norm.weight, 2.0)
+    ema_state = { f"model.{k}": v for k, v in ema.state_dict().items() if not k.startswith("norm.") }
+    torch.save({"model": student.state_dict(), "ema": ema_state}, path)
+
+
+def _count_loads(model):
+    calls = []
+    load_state_dict = model.load_state_dict
+    def counting_load_state_dict(*args, **kwargs):
+        calls.append(1)
+        return load_state_dict(*args, **kwargs)
+    model.load_state_dict = counting_load_state_dict
+    return calls
+
+
+def test_ema_checkpointer_loads_ema_as_model_once(tmp_path):
+    path = str(tmp_path / "model.pth")
+    _save_student_and_ema(path)
+    model = ToyModel()
+    calls = _count_loads(model)
+    DetectionCheckpointerWithEMA(model, mmap=True, require_complete=True).resume_or_load(path, resume=False)
+    assert len(calls) == 1
+    assert torch.all(model.linear.weight == 1.0) # EMA weights replace the student weights
+    assert torch.all(model.norm.weight == 2.0) # student weights fill in what the EMA model lacks
+
+
+def test_ema_checkpointer_does_not_swap_on_resume(tmp_path):
+    _save_student_and_ema(str(tmp_path / "model_0000009.pth"))
+    (tmp_path / "last_checkpoint").write_text("model_0000009.pth")
+    model = ToyModel()
+    DetectionCheckpointerWithEMA(model, save_dir=str(tmp_path)).resume_or_load("", resume=True)
+    assert torch.all(model.linear.weight == 0.0)
+    assert torch.all(model.norm.weight == 2.0)
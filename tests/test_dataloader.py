@@ -0,0 +1,128 @@
+import copy
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+pytest.importorskip("detectron2")
+
+from detectron2.data import transforms as T
+from detectron2.structures import BoxMode
+
+from aldi.aug import WEAK_IMG_KEY, SaveImgAug
+from aldi.dataloader import (SaveWeakDatasetMapper, UnlabeledDatasetMapper, WeakStrongDataloader, autotune_num_workers,
+                             build_grouped_train_loader, compact_dataset_dicts)
+
+
+@pytest.fixture
+def dataset_dict(tmp_path):
+    file_name = str(tmp_path / "image.png")
+    Image.fromarray(np.random.RandomState(0).randint(256, size=(60, 80, 3), dtype=np.uint8)).save(file_name)
+    return {
+        "file_name": file_name, "image_id": 0, "height": 60, "width": 80,
+        "annotations": [
+            {"bbox": [10, 5, 20, 30], "bbox_mode": BoxMode.XYWH_ABS, "category_id": 1, "iscrowd": 0},
+            {"bbox": [40.5, 10, 90, 70], "bbox_mode": BoxMode.XYXY_ABS, "category_id": 2, "iscrowd": 0}, # partly outside
+            {"bbox": [0, 0, 10, 10], "bbox_mode": BoxMode.XYWH_ABS, "category_id": 0, "iscrowd": 1}, # dropped
+            {"bbox": [79, 59, 5, 5], "bbox_mode": BoxMode.XYWH_ABS, "category_id": 0}, # empty after clipping
+        ],
+    }
+
+
+def augmentations():
+    return [T.ResizeShortestEdge(48, 1000), T.RandomFlip(prob=1.0), SaveImgAug(WEAK_IMG_KEY)]
+
+
+@pytest.mark.parametrize("mapper_cls, keep_annotations", [(SaveWeakDatasetMapper, True), (UnlabeledDatasetMapper, False)])
+def test_compact_annotations_map_like_standard_ones(dataset_dict, mapper_cls, keep_annotations):
+    mapper = mapper_cls(is_train=True, augmentations=augmentations(), image_format="BGR")
+    original = copy.deepcopy(dataset_dict)
+    standard = mapper(dataset_dict)
+    compact = mapper(compact_dataset_dicts([dataset_dict], keep_annotations=keep_annotations)[0])
+    assert dataset_dict == original # neither mapper modifies its input
+
+    assert set(compact) == set(standard)
+    for k in standard:
+        if isinstance(standard[k], torch.Tensor):
+            assert torch.equal(compact[k], standard[k]), k
+        elif k != "instances":
+            assert compact[k] == standard[k], k
+    assert compact["instances"].image_size == standard["instances"].image_size
+    assert torch.allclose(compact["instances"].gt_boxes.tensor, standard["instances"].gt_boxes.tensor)
+    assert torch.equal(compact["instances"].gt_classes, standard["instances"].gt_classes)
+    assert len(standard["instances"]) == (2 if keep_annotations else 0)
+
+
+def test_unlabeled_mapper_adds_empty_instances_without_annotations(dataset_dict):
+    mapper = UnlabeledDatasetMapper(is_train=True, augmentations=augmentations(), image_format="BGR")
+    del dataset_dict["annotations"]
+    mapped = mapper(dataset_dict)
+    assert mapped["instances"].image_size == tuple(mapped["image"].shape[-2:]) == (48, 64)
+    assert len(mapped["instances"]) == 0
+
+
+class RandomSizeMapper:
+    """Maps an image to a random size (like multi-scale augmentation) and records a random augmentation parameter."""
+    def __call__(self, dataset_dict):
+        height = 32 * np.random.randint(1, 4)
+        return {"image_id": dataset_dict["image_id"], "image": torch.zeros(3, height, 32), "aug": torch.rand(1).item()}
+
+
+def build_resumable_loader(num_workers):
+    dataset_dicts = [{"image_id": i} for i in range(25)]
+    loader = build_grouped_train_loader(dataset_dicts, RandomSizeMapper(), 4, num_workers=num_workers, granularity=32)
+    return WeakStrongDataloader(loader, None, batch_contents=("labeled_strong",))
+
+
+def take(iterator, num_batches):
+    """The image ids and augmentations of the next num_batches labeled batches."""
+    return [[(d["image_id"], d["aug"]) for d in next(iterator)[1]] for _ in range(num_batches)]
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_resume_mid_epoch(num_workers):
+    dataloader = build_resumable_loader(num_workers)
+    iterator = iter(dataloader)
+    take(iterator, 3) # part of the first epoch
+    state = dataloader.state_dict()
+    assert state["labeled"][0]["pending"] # some images are waiting in incomplete groups
+    expected = take(iterator, 10) # the rest of the first epoch and part of the second one
+
+    resumed = build_resumable_loader(num_workers)
+    resumed.load_state_dict(state)
+    assert take(iter(resumed), 10) == expected
+
+
+class FakeClock:
+    """Stands in for time.perf_counter; advanced by CostlyMapper."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CostlyMapper:
+    """Mapper that takes a known time per image on a FakeClock."""
+    def __init__(self, clock, cost):
+        self.clock = clock
+        self.cost = cost
+
+    def __call__(self, dataset_dict):
+        self.clock.now += self.cost
+        return dataset_dict
+
+
+@pytest.mark.parametrize("costs, batch_sizes, total_workers, expected", [
+    ([1.0, 3.0], [4, 4], 8, [2, 6]),
+    ([1.0, 1.0], [2, 6], 8, [2, 6]), # cost per batch, not per image
+    ([1.0, 1.0, 20.0], [1, 1, 1], 4, [1, 1, 2]), # at least one worker each, without exceeding the total
+    ([1.0, 1.0, 1.0], [1, 1, 1], 2, [1, 1, 1]), # fewer workers than pipelines
+])
+def test_autotune_num_workers_is_proportional_to_batch_cost(monkeypatch, costs, batch_sizes, total_workers, expected):
+    clock = FakeClock()
+    monkeypatch.setattr("aldi.dataloader.time.perf_counter", clock)
+    pipelines = [([{"image_id": i} for i in range(10)], CostlyMapper(clock, cost), batch_size)
+                 for cost, batch_size in zip(costs, batch_sizes)]
+    assert autotune_num_workers(pipelines, total_workers, num_images=4) == expected
@@ -0,0 +1,102 @@
+"""
+Check that skipping DDP gradient synchronization for intermediate backward passes
+(SOLVER.DDP_NO_SYNC=True with SOLVER.BACKWARD_AT_END=False) produces the same gradients
+as synchronizing after every backward pass, while communicating less.
+Also checks the backward scheduler (SOLVER.AUTO_BACKWARD.ENABLED=True), which defers the
+backward passes of phases that fit its memory budget to the last backward pass of the step.
+Runs two processes on CPU with the gloo backend.
+"""
+import os
+import socket
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+pytest.importorskip("detectron2")
+
+from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from aldi.distill import Distiller
+from aldi.memory import BackwardScheduler
+from aldi.trainer import run_model_labeled_unlabeled
+
+NUM_PROCS = 2
+
+
+class ToyDetector(torch.nn.Module):
+    """Stand-in for an ALDI model: takes a list of dicts and returns a dict of losses.
+    The detection head is not used by target-domain alignment."""
+    def __init__(self):
+        super().__init__()
+        self.backbone = torch.nn.Sequential(torch.nn.Linear(16, 64), torch.nn.ReLU())
+        self.head = torch.nn.Linear(64, 1)
+        self.img_align = torch.nn.Linear(64, 1)
+
+    def forward(self, batched_inputs, labeled=True, do_align=False):
+        features = self.backbone(torch.stack([i["x"] for i in batched_inputs]))
+        losses = {"loss_toy": torch.nn.functional.mse_loss(self.head(features), torch.stack([i["y"] for i in batched_inputs]))}
+        if do_align:
+            domain_preds = self.img_align(features)
+            losses["loss_da_img"] = torch.nn.functional.binary_cross_entropy_with_logits(
+                domain_preds, torch.full_like(domain_preds, float(labeled)))
+        return losses
+
+
+def get_grads(rank, ddp_no_sync, backward_scheduler=None, num_steps=3):
+    torch.manual_seed(0)
+    model = DDP(ToyDetector())
+    calls = {"n": 0}
+    def counting_allreduce_hook(state, bucket):
+        state["n"] += 1
+        return allreduce_hook(None, bucket)
+    model.register_comm_hook(calls, counting_allreduce_hook)
+
+    trainer = SimpleNamespace(model=model, backward_at_end=False, model_batch_size=2, batch_sizer=None,
+                              ddp_no_sync=ddp_no_sync, backward_scheduler=backward_scheduler,
+                              distiller=Distiller(None, None),
+                              do_backward=lambda losses, override=False: losses.backward())
+    grads = []
+    for step in range(num_steps):
+        torch.manual_seed(1 + rank + step * NUM_PROCS) # different data on every worker
+        data = [{"x": torch.randn(16), "y": torch.randn(1)} for _ in range(12)]
+        model.zero_grad()
+        calls["n"] = 0
+        run_model_labeled_unlabeled(trainer, None, data[:6], data[6:], None)
+        grads.append([p.grad.clone() for p in model.parameters()])
+    return grads, calls["n"]
+
+
+def _worker(rank, port):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=NUM_PROCS)
+    try:
+        synced_grads, synced_calls = get_grads(rank, ddp_no_sync=False)
+        # with a budget of 5KB, only one of the two phases is deferred (the schedule is chosen after the first step)
+        schedulers = [BackwardScheduler("cpu", budget_bytes) for budget_bytes in (2**30, 5 * 2**10)]
+        for name, kwargs in [("no_sync", dict(ddp_no_sync=True)),
+                             ("all deferred", dict(ddp_no_sync=True, backward_scheduler=schedulers[0])),
+                             ("partly deferred", dict(ddp_no_sync=True, backward_scheduler=schedulers[1]))]:
+            grads, calls = get_grads(rank, **kwargs)
+            for step_grads, step_synced_grads in zip(grads, synced_grads):
+                for g0, g1 in zip(step_synced_grads, step_grads):
+                    assert torch.allclose(g0, g1, atol=1e-6), f"Gradients differ between synchronized and {name} backward passes."
+            assert calls < synced_calls, f"{name} does not communicate less than synchronizing every backward pass."
+        assert schedulers[0].schedule == {"source_strong": True, "target_weak": True}
+        assert schedulers[1].schedule == {"source_strong": True, "target_weak": False}
+    finally:
+        dist.destroy_process_group()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_ddp_no_sync_gradients_match():
+    mp.spawn(_worker, args=(_free_port(),), nprocs=NUM_PROCS)
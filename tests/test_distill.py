@@ -0,0 +1,152 @@
+import copy
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+
+pytest.importorskip("detectron2")
+
+from detectron2.modeling.proposal_generator.rpn import RPN
+from detectron2.modeling.roi_heads.fast_rcnn import FastRCNNOutputLayers
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from aldi.distill import ALDIDistiller
+from aldi.model import build_aldi
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Count the calls to the RPN and box predictor methods that only compute losses."""
+    counts = {}
+    for cls, name in [(RPN, "label_and_sample_anchors"), (RPN, "losses"), (FastRCNNOutputLayers, "losses")]:
+        def counted(*args, _method=getattr(cls, name), _key=f"{cls.__name__}.{name}", **kwargs):
+            counts[_key] = counts.get(_key, 0) + 1
+            return _method(*args, **kwargs)
+        monkeypatch.setattr(cls, name, counted)
+    return counts
+
+
+def test_only_losses_skips_disabled_losses(tiny_cfg, make_inputs, calls):
+    model = build_aldi(tiny_cfg).train()
+    inputs = make_inputs(2)
+
+    losses = model(inputs)
+    assert set(losses) == {"loss_rpn_cls", "loss_rpn_loc", "loss_cls", "loss_box_reg"}
+    assert calls == {"RPN.label_and_sample_anchors": 1, "RPN.losses": 1, "FastRCNNOutputLayers.losses": 1}
+
+    calls.clear()
+    with model.only_losses({"loss_cls"}):
+        losses = model(inputs)
+    assert set(losses) == {"loss_cls", "loss_box_reg"}
+    assert calls == {"FastRCNNOutputLayers.losses": 1}
+
+    calls.clear()
+    with model.only_losses({"loss_rpn_cls"}):
+        losses = model(inputs)
+    assert set(losses) == {"loss_rpn_cls", "loss_rpn_loc"}
+    assert calls == {"RPN.label_and_sample_anchors": 1, "RPN.losses": 1}
+
+    # losses are computed again outside of the context
+    calls.clear()
+    assert set(model(inputs)) == {"loss_rpn_cls", "loss_rpn_loc", "loss_cls", "loss_box_reg"}
+
+
+def test_distiller_skips_disabled_hard_losses_and_hooks(tiny_cfg, make_inputs, calls):
+    student = build_aldi(tiny_cfg).train()
+    teacher = copy.deepcopy(student).eval()
+    distiller = ALDIDistiller(teacher, student, do_hard_cls=True, do_hard_roi_reg=True, pseudo_label_threshold=0.0)
+
+    # no soft distillation losses: the student outputs are not captured
+    for module in [student.proposal_generator.rpn_head, student.roi_heads.box_pooler, student.roi_heads.box_predictor]:
+        assert len(module._forward_hooks) == 0
+
+    unlabeled = make_inputs(2, seed=1)
+    for i in unlabeled:
+        del i["instances"]
+    calls.clear()
+    losses = distiller(copy.deepcopy(unlabeled), copy.deepcopy(unlabeled))
+    assert set(losses) == {"loss_cls", "loss_box_reg"}
+    # only the student computes losses (the teacher only predicts), and its RPN losses are skipped
+    assert calls == {"FastRCNNOutputLayers.losses": 1}
+    assert all(torch.isfinite(v) for v in losses.values())
+
+
+def test_distiller_hooks_only_modules_it_distills(tiny_cfg):
+    student = build_aldi(tiny_cfg).train()
+    teacher = copy.deepcopy(student).eval()
+    ALDIDistiller(teacher, student, do_cls_dst=True)
+    assert len(student.proposal_generator.rpn_head._forward_hooks) == 0
+    assert len(student.roi_heads.box_pooler._forward_hooks) == 1
+    assert len(student.roi_heads.box_predictor._forward_hooks) == 1
+
+
+@pytest.fixture
+def process_group():
+    """A single-process gloo process group, so that models can be wrapped in DDP on CPU."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=0, world_size=1)
+    yield
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("find_unused_parameters", [False, True])
+def test_distiller_keeps_disabled_hard_losses_only_when_ddp_needs_them(tiny_cfg, make_inputs, process_group,
+                                                                      find_unused_parameters):
+    student = build_aldi(tiny_cfg).train()
+    teacher = copy.deepcopy(student).eval()
+    ddp_student = DDP(student, find_unused_parameters=find_unused_parameters)
+    distiller = ALDIDistiller(teacher, ddp_student, do_hard_cls=True, do_hard_roi_reg=True, pseudo_label_threshold=0.0)
+
+    unlabeled = make_inputs(2, seed=1)
+    for i in unlabeled:
+        del i["instances"]
+    losses = distiller(copy.deepcopy(unlabeled), copy.deepcopy(unlabeled))
+    if find_unused_parameters:
+        assert set(losses) == {"loss_cls", "loss_box_reg"}
+    else:
+        # the RPN losses keep the RPN's parameters in the synchronized backward pass
+        assert set(losses) == {"loss_cls", "loss_box_reg", "loss_rpn_cls", "loss_rpn_loc"}
+        assert losses["loss_rpn_cls"].item() == 0.0
+    sum(losses.values()).backward()
+    # gradients are not synchronized, so unused parameters do not matter
+    with ddp_student.no_sync():
+        assert set(distiller(copy.deepcopy(unlabeled), copy.deepcopy(unlabeled))) == {"loss_cls", "loss_box_reg"}
+
+
+def test_distill_targets_match_teacher_forward_on_student_proposals(tiny_cfg, make_inputs):
+    """distill_targets gives the same teacher box predictions as running the whole teacher in train mode with
+    the student's RPN proposals and the same proposal sampling (as distillation did before distill_targets)."""
+    student = build_aldi(tiny_cfg).train()
+    teacher = copy.deepcopy(student).train()
+    with torch.no_grad():
+        for p in teacher.roi_heads.box_predictor.parameters():
+            p.add_(0.1 * torch.randn_like(p))
+    inputs = make_inputs(2, seed=1) # the "pseudo-labels" are the same for teacher and student
+
+    saved = {}
+    def save(key, index):
+        return lambda module, args, output: saved.__setitem__(key, (args, output)[index])
+    def seed(module, args):
+        torch.manual_seed(0) # teacher and student sample the same proposals
+    def replace_proposals(module, args):
+        images, features, proposals, targets = args
+        return images, features, saved["student_proposals"], targets
+    hooks = [student.proposal_generator.register_forward_hook(save("student_proposals", 1)),
+             student.roi_heads.box_pooler.register_forward_hook(save("student_proposal_boxes", 0)),
+             teacher.roi_heads.box_predictor.register_forward_hook(save("teacher_box_predictions", 1)),
+             student.roi_heads.register_forward_pre_hook(seed),
+             teacher.roi_heads.register_forward_pre_hook(seed),
+             teacher.roi_heads.register_forward_pre_hook(replace_proposals)]
+    student(copy.deepcopy(inputs))
+    saved["student_proposals"] = saved["student_proposals"][0]
+    with torch.no_grad():
+        teacher(copy.deepcopy(inputs))
+    for hook in hooks:
+        hook.remove()
+
+    _, _, box_predictions = teacher.distill_targets(inputs, proposal_boxes=saved["student_proposal_boxes"][1], rpn=False)
+    for expected, actual in zip(saved["teacher_box_predictions"], box_predictions):
+        assert torch.allclose(expected, actual, atol=1e-5)
@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from aldi.ema import EMA, quantized_copy
+from aldi.model import build_aldi
+from aldi.pseudolabeler import pseudo_label_agreement
+
+
+class ToyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.stem = torch.nn.Linear(4, 8)
+        self.stem.requires_grad_(False) # frozen, so shared between the student and the EMA model
+        self.norm = torch.nn.BatchNorm1d(8)
+        self.head = torch.nn.Linear(8, 2)
+
+    @property
+    def device(self):
+        return self.head.weight.device
+
+
+def make_ema(seed):
+    torch.manual_seed(seed)
+    student = ToyModel()
+    ema = EMA(student, alpha=0.5, student=student)
+    with torch.no_grad():
+        for p in student.parameters():
+            p.add_(1.0)
+    ema.update_weights(student, iter=1)
+    return student, ema
+
+
+def test_state_dict_round_trip():
+    student, ema = make_ema(0)
+    assert ema.shared_keys == {"stem.weight", "stem.bias"}
+    state_dict = ema.state_dict()
+    # shared tensors are saved with the EMA model too
+    assert set(state_dict) == { "model." + k for k in student.state_dict() }
+
+    _, loaded = make_ema(1)
+    loaded.load_state_dict(state_dict)
+    for k, v in loaded.state_dict().items():
+        assert torch.equal(v, state_dict[k]), k
+
+
+def test_load_state_dict_without_shared_tensors():
+    _, ema = make_ema(0)
+    state_dict = { k: v for k, v in ema.state_dict().items() if not k.startswith("model.stem.") }
+    state_dict["model.align.weight"] = torch.zeros(1) # weights the EMA model does not have are ignored
+
+    student, loaded = make_ema(1)
+    loaded.load_state_dict(state_dict)
+    assert torch.equal(loaded.model.head.weight, ema.model.head.weight)
+    assert loaded.model.stem.weight is student.stem.weight
+
+
+def test_quantized_teacher_pseudo_labels_agree(tiny_cfg, make_inputs):
+    tiny_cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.0 # a randomly initialized model has low scores
+    torch.manual_seed(0)
+    model = build_aldi(tiny_cfg).eval()
+    quantized = quantized_copy(model)
+    assert quantized.roi_heads.box_head.fc1.weight().dtype == torch.qint8
+
+    inputs = make_inputs(4, seed=1)
+    with torch.no_grad():
+        reference = model.inference(inputs, do_postprocess=False)
+        predictions = quantized.inference(inputs, do_postprocess=False)
+    assert sum(len(p) for p in reference) > 0
+    precision, recall = pseudo_label_agreement(predictions, reference, threshold=0.0)
+    assert precision >= 0.8 and recall >= 0.8
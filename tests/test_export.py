@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from aldi.export import (benchmark, build_deployable_model, export_onnx, export_torchscript, exported_predictions,
+                         tracing_adapter)
+from aldi.model import build_aldi
+
+
+@pytest.fixture
+def deployable_model(tiny_cfg, tmp_path):
+    """A plain detector loaded from the checkpoint of a randomly initialized ALDI model, which keeps all of its
+    detections so that there is something to compare."""
+    tiny_cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.0
+    torch.manual_seed(0)
+    path = str(tmp_path / "model.pth")
+    torch.save({"model": build_aldi(tiny_cfg).state_dict()}, path)
+    return build_deployable_model(tiny_cfg, path, use_ema=False)
+
+
+@pytest.fixture
+def images():
+    """Images already resized to the test size (see tiny_cfg), with their original heights and widths."""
+    generator = torch.Generator().manual_seed(0)
+    return [(torch.randint(256, (3, 128, 160), generator=generator).float(), 240, 300),
+            (torch.randint(256, (3, 128, 192), generator=generator).float(), 128, 192)]
+
+
+def assert_same_predictions(model, adapter, run_exported, images):
+    for image, height, width in images:
+        with torch.no_grad():
+            eager = model([{"image": image, "height": height, "width": width}])[0]["instances"]
+            exported = exported_predictions(adapter, run_exported(image), height, width)
+        assert len(eager) > 0
+        assert len(exported) == len(eager)
+        assert torch.allclose(exported.pred_boxes.tensor, eager.pred_boxes.tensor, atol=1e-3)
+        assert torch.allclose(exported.scores, eager.scores, atol=1e-5)
+        assert torch.equal(exported.pred_classes, eager.pred_classes)
+
+
+def test_torchscript_matches_eager(deployable_model, images, tmp_path):
+    adapter = tracing_adapter(deployable_model, images[0][0])
+    traced = export_torchscript(adapter, images[0][0], str(tmp_path / "model.ts"))
+    loaded = torch.jit.load(str(tmp_path / "model.ts"))
+    assert_same_predictions(deployable_model, adapter, traced, images)
+    assert_same_predictions(deployable_model, adapter, loaded, images)
+
+
+def test_onnx_matches_eager(deployable_model, images, tmp_path):
+    onnxruntime = pytest.importorskip("onnxruntime")
+    adapter = tracing_adapter(deployable_model, images[0][0])
+    path = str(tmp_path / "model.onnx")
+    export_onnx(adapter, images[0][0], path)
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    run_exported = lambda image: tuple(torch.as_tensor(o) for o in session.run(None, {"image": image.numpy()}))
+    assert_same_predictions(deployable_model, adapter, run_exported, images)
+
+
+def test_benchmark_reports_percentiles():
+    report = benchmark(lambda x: x.sum(), [torch.ones(8)] * 20, warmup=2)
+    assert set(report) == {"latency_ms_mean", "latency_ms_p50", "latency_ms_p95", "latency_ms_p99", "throughput_img_per_s"}
+    assert report["latency_ms_p50"] <= report["latency_ms_p95"] <= report["latency_ms_p99"]
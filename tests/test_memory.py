@@ -0,0 +1,102 @@
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from aldi.memory import MicroBatchSizer, PeakMemoryMeter
+
+MB = 2**20
+
+
+def test_fit_is_linear_in_batch_size():
+    sizer = MicroBatchSizer("cpu", budget_bytes=100 * MB, default_batch_size=2)
+    # 10 MB fixed + 5 MB per image: (100 - 10) / 5 = 18 images
+    assert sizer._fit("phase", [15 * MB, 20 * MB], 0, n=64) == 18
+    # the baseline (memory already allocated before the forward pass) counts against the budget
+    assert sizer._fit("phase", [15 * MB, 20 * MB], 50 * MB, n=64) == 8
+    # never more than the number of images in the phase, never less than 1
+    assert sizer._fit("phase", [15 * MB, 20 * MB], 0, n=4) == 4
+    assert sizer._fit("phase", [150 * MB, 300 * MB], 0, n=64) == 1
+
+
+def test_fit_falls_back_to_default_without_measurements():
+    sizer = MicroBatchSizer("cpu", budget_bytes=100 * MB, default_batch_size=3)
+    assert sizer._fit("phase", [15 * MB], 0, n=64) == 3
+
+
+def test_fit_accounts_for_baseline_growth_between_probes():
+    sizer = MicroBatchSizer("cpu", budget_bytes=100 * MB, default_batch_size=2)
+    slices = sizer.slices("phase", 64)
+    next(slices)
+    # the first backward pass allocates 5 MB of gradients, which the second probe sees as baseline
+    sizer._measurements["phase"].append((15 * MB, 0))
+    next(slices)
+    sizer._measurements["phase"].append((15 * MB, 5 * MB))
+    next(slices)
+    # 10 MB fixed + 5 MB per image, as in test_fit_is_linear_in_batch_size
+    assert sizer.sizes["phase"] == 18
+
+
+def run_phase(sizer, model, phase, n):
+    """Run n images through model in micro-batches chosen by sizer, like the trainer. Returns the slices."""
+    data = torch.randn(n, 64)
+    slices = []
+    for batch in sizer.slices(phase, n):
+        with sizer.measure(phase):
+            loss = model(data[batch].clone()).sum()
+            loss.backward()
+        slices.append(batch)
+    return slices
+
+
+@pytest.mark.parametrize("n", [1, 2, 3, 10, 37])
+def test_slices_cover_all_images_once(n):
+    model = torch.nn.Sequential(torch.nn.Linear(64, 256), torch.nn.ReLU(), torch.nn.Linear(256, 1))
+    # one image saves 1.25KB of activations (its input and the ReLU output), plus the 1KB weight of the last layer:
+    # (16KB - 1KB) / 1.25KB = 12 images fit the budget
+    sizer = MicroBatchSizer("cpu", budget_bytes=16 * 2**10, default_batch_size=2)
+    for _ in range(2): # probing, then with the fitted size
+        slices = run_phase(sizer, model, "phase", n)
+        covered = [i for s in slices for i in range(n)[s]]
+        assert covered == list(range(n))
+    if n >= 3:
+        assert slices[0] == slice(0, sizer.sizes["phase"])
+        assert sizer.sizes["phase"] == min(n, 12)
+    else:
+        assert sizer.sizes["phase"] == 2 # not enough images to probe: default batch size
+
+
+def test_meter_counts_each_saved_storage_once():
+    x = torch.randn(256, 256, requires_grad=True)
+    with PeakMemoryMeter("cpu") as meter:
+        y = x.sin()
+        for _ in range(10):
+            y = y * x # saves x every time
+    # x and the inputs of each multiplication
+    assert meter.peak == 11 * x.untyped_storage().nbytes()
+    with PeakMemoryMeter("cpu") as meter2:
+        for _ in range(10):
+            x.exp().sum().backward() # each step's saved result is freed before the next step
+    # storages are held until exit, so freed addresses are not reused and each step is counted
+    assert meter2.peak == 10 * x.untyped_storage().nbytes()
+
+
+def test_meter_removes_hooks_on_exception():
+    with pytest.raises(RuntimeError):
+        with PeakMemoryMeter("cpu"):
+            raise RuntimeError()
+    x = torch.randn(4, requires_grad=True)
+    assert x.exp().grad_fn._saved_result is not None
+    assert torch._C._autograd._top_saved_tensors_default_hooks(False) is None
+
+
+def test_nested_meters_count_towards_outer_meter():
+    x = torch.randn(256, 256, requires_grad=True)
+    nbytes = x.untyped_storage().nbytes()
+    with PeakMemoryMeter("cpu") as outer:
+        y = x.exp()
+        with PeakMemoryMeter("cpu") as inner:
+            y = y * x.sin()
+        y = y.cos()
+    assert inner.peak == 3 * nbytes # x, and the result of exp and of sin
+    assert outer.peak == 4 * nbytes # the input of cos, too
@@ -0,0 +1,101 @@
+import copy
+import threading
+
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from aldi.checkpoint import CompactDetectionCheckpointer
+from aldi.model import build_aldi, compile_modules, materialize, meta_parameters
+
+
+class ToyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.net = torch.nn.Sequential(torch.nn.Linear(8, 8), torch.nn.ReLU())
+
+    def forward(self, x):
+        return self.net(x)
+
+
+def graph_breaks():
+    return sum(torch._dynamo.utils.counters["graph_break"].values())
+
+
+def test_compiled_forward_is_bound_to_each_copy():
+    torch._dynamo.reset()
+    model = ToyModel()
+    compile_modules(model, ["net"])
+    teacher = copy.deepcopy(model) # like the EMA teacher
+    assert teacher.net.forward.__self__ is teacher.net
+    with torch.no_grad():
+        teacher.net[0].weight.add_(1.0)
+
+    x = torch.randn(4, 8)
+    for m in [model, teacher]:
+        for training in [True, False]:
+            expected = torch.relu(torch.nn.functional.linear(x, m.net[0].weight, m.net[0].bias))
+            assert torch.allclose(m.train(training)(x), expected, atol=1e-6)
+    assert model.net._reported_compiles == {"train", "inference"}
+
+
+def test_backbone_compiles_without_graph_breaks(tiny_cfg, make_inputs):
+    torch._dynamo.reset()
+    tiny_cfg.merge_from_list(["MODEL.COMPILE.ENABLED", True, "MODEL.COMPILE.MODULES", ["backbone"]])
+    model = build_aldi(tiny_cfg).train()
+    images = model.preprocess_image(make_inputs(2)).tensor
+
+    breaks = graph_breaks()
+    features = model.backbone(images)
+    assert graph_breaks() == breaks
+    assert model.backbone._reported_compiles == {"train"}
+    sum(f.sum() for f in features.values()).backward()
+    assert all(p.grad is not None for p in model.backbone.parameters() if p.requires_grad)
+
+
+def test_meta_parameters_nested():
+    register_parameter = torch.nn.Module.register_parameter
+    with meta_parameters():
+        with meta_parameters():
+            assert torch.nn.Linear(2, 2).weight.is_meta
+        assert torch.nn.Linear(2, 2).weight.is_meta
+        # buffers are created as usual
+        assert not torch.nn.BatchNorm1d(2).running_mean.is_meta
+    assert not torch.nn.Linear(2, 2).weight.is_meta
+    assert torch.nn.Module.register_parameter is register_parameter
+
+
+def test_meta_parameters_only_affect_current_thread():
+    entered, built = threading.Event(), threading.Event()
+    def build_in_context():
+        with meta_parameters():
+            entered.set()
+            built.wait()
+    thread = threading.Thread(target=build_in_context)
+    thread.start()
+    entered.wait()
+    try:
+        assert not torch.nn.Linear(2, 2).weight.is_meta
+    finally:
+        built.set()
+        thread.join()
+
+
+def build_uninitialized(cls):
+    with meta_parameters():
+        model = cls()
+    materialize(model, "cpu")
+    return model
+
+
+def test_checkpointer_requires_complete_checkpoint(tmp_path):
+    torch.save({"model": ToyModel().state_dict()}, tmp_path / "complete.pth")
+    torch.save({"model": { k: v for k, v in ToyModel().state_dict().items() if k != "net.0.bias" }}, tmp_path / "partial.pth")
+    for build in [ToyModel, lambda: build_uninitialized(ToyModel)]:
+        CompactDetectionCheckpointer(build(), require_complete=True).load(str(tmp_path / "complete.pth"))
+        CompactDetectionCheckpointer(build()).load(str(tmp_path / "partial.pth"))
+        with pytest.raises(ValueError, match="net.0.bias"):
+            CompactDetectionCheckpointer(build(), require_complete=True).load(str(tmp_path / "partial.pth"))
+        with pytest.raises(ValueError):
+            CompactDetectionCheckpointer(build(), require_complete=True).load("")
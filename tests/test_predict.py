@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+pytest.importorskip("detectron2")
+
+from detectron2.structures import Boxes, Instances
+
+from aldi.predict import PredictionMapper, build_prediction_loader, run_predictions
+
+
+class ToyMapper:
+    """Images of two shapes, so that the loader has two groups that are left incomplete at the end."""
+    def __call__(self, dataset_dict):
+        height = 64 if dataset_dict["image_id"] % 3 else 128
+        return { "image": torch.zeros(3, height, 96), "height": height, "width": 96, "image_id": dataset_dict["image_id"] }
+
+
+class ToyDetector(torch.nn.Module):
+    """Predicts one box per image."""
+    def forward(self, batch):
+        return [{ "instances": Instances((d["height"], d["width"]), pred_boxes=Boxes(torch.tensor([[0.0, 0.0, 10.0, 10.0]])),
+                                         scores=torch.tensor([0.9]), pred_classes=torch.tensor([1])) } for d in batch]
+
+
+class ListWriter:
+    def __init__(self):
+        self.records = []
+
+    def write(self, records):
+        self.records.extend(records)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+@pytest.mark.parametrize("num_images", [1, 4, 11])
+def test_every_image_is_predicted_once(num_images, num_workers):
+    dataset_dicts = [{"image_id": i} for i in range(num_images)]
+    data_loader = build_prediction_loader(dataset_dicts, ToyMapper(), batch_size=4, num_workers=num_workers)
+    assert all(len(set(d["image"].shape for d in batch)) == 1 for batch in data_loader)
+
+    writer = ListWriter()
+    results = run_predictions(ToyDetector(), data_loader, writer, category_ids={1: 7})
+    assert results["num_images"] == results["num_detections"] == num_images
+    assert sorted(r["image_id"] for r in writer.records) == list(range(num_images))
+    assert all(r["category_id"] == 7 for r in writer.records)
+
+
+@pytest.mark.parametrize("image_format", ["BGR", "RGB"])
+def test_mapper_decodes_images_like_image_files(tiny_cfg, tmp_path, image_format):
+    tiny_cfg.INPUT.FORMAT = image_format
+    mapper = PredictionMapper(tiny_cfg)
+    file_name = str(tmp_path / "image.jpg")
+    Image.fromarray(np.random.RandomState(0).randint(256, size=(60, 80, 3), dtype=np.uint8)).save(file_name)
+    with open(file_name, "rb") as f:
+        decoded = mapper.decode(f.read())
+    mapped = mapper({"file_name": file_name, "image_id": 0})
+    assert (decoded["height"], decoded["width"]) == (mapped["height"], mapped["width"]) == (60, 80)
+    assert decoded["image"].shape == (3, 128, 171) # resized to INPUT.MIN_SIZE_TEST
+    assert torch.equal(decoded["image"], mapped["image"])
@@ -0,0 +1,115 @@
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+from aldi.serve import DynamicBatcher, LatencyStats, build_server
+
+
+class RecordingPredict:
+    """Doubles its inputs and records the size of each batch, optionally after a delay or failing."""
+    def __init__(self, delay=0.0, fail=False):
+        self.batch_sizes = []
+        self.delay = delay
+        self.fail = fail
+
+    def __call__(self, batch):
+        self.batch_sizes.append(len(batch))
+        time.sleep(self.delay)
+        if self.fail:
+            raise ValueError("prediction failed")
+        return [2 * x for x in batch]
+
+
+def test_requests_are_batched_up_to_max_batch_size():
+    predict = RecordingPredict()
+    batcher = DynamicBatcher(predict, max_batch_size=4, max_wait_ms=500)
+    futures = [batcher.submit(i) for i in range(10)]
+    assert [f.result(timeout=5) for f in futures] == [2 * i for i in range(10)]
+    # full batches are predicted as soon as they are full; the rest is predicted at its deadline
+    assert predict.batch_sizes == [4, 4, 2]
+    assert batcher.summary()["mean_batch_size"] == pytest.approx(10 / 3)
+
+
+def test_batch_is_predicted_at_deadline():
+    predict = RecordingPredict()
+    batcher = DynamicBatcher(predict, max_batch_size=4, max_wait_ms=100)
+    start = time.perf_counter()
+    assert batcher.submit(1).result(timeout=5) == 2
+    assert time.perf_counter() - start >= 0.09
+    assert predict.batch_sizes == [1]
+
+
+def test_exceptions_are_propagated_to_futures():
+    predict = RecordingPredict(fail=True)
+    batcher = DynamicBatcher(predict, max_batch_size=2, max_wait_ms=200)
+    futures = [batcher.submit(i) for i in range(3)]
+    for f in futures:
+        with pytest.raises(ValueError, match="prediction failed"):
+            f.result(timeout=5)
+    # the worker keeps serving after a failure
+    predict.fail = False
+    assert batcher.submit(3).result(timeout=5) == 6
+
+
+def test_cancelled_requests_are_skipped():
+    predict = RecordingPredict(delay=0.2)
+    batcher = DynamicBatcher(predict, max_batch_size=1, max_wait_ms=0)
+    first = batcher.submit(1)
+    time.sleep(0.05) # the first request is being predicted
+    second = batcher.submit(2)
+    assert second.cancel()
+    assert first.result(timeout=5) == 2
+    assert batcher.submit(3).result(timeout=5) == 6
+    assert predict.batch_sizes == [1, 1]
+
+
+def test_stats_reset():
+    stats = LatencyStats()
+    for latency in [0.1, 0.2, 0.3]:
+        stats.record(latency)
+    assert stats.summary()["requests"] == 3
+    stats.reset()
+    assert stats.summary() == {"requests": 0}
+
+
+@pytest.fixture
+def serve():
+    """Returns a function that starts a server for a DynamicBatcher and returns an HTTP connection to it."""
+    servers, connections = [], []
+    def start(batcher, timeout=None):
+        server = build_server(batcher, preprocess=lambda body: int(body), postprocess=lambda output: {"output": output},
+                              port=0, timeout=timeout)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        connections.append(http.client.HTTPConnection(*server.server_address[:2], timeout=10))
+        return connections[-1]
+    yield start
+    for connection in connections:
+        connection.close()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def request(connection, method, path, body=None):
+    connection.request(method, path, body=body)
+    response = connection.getresponse()
+    data = response.read()
+    return response.status, json.loads(data) if response.status == 200 else None
+
+
+def test_server_predicts_and_resets_stats(serve):
+    connection = serve(DynamicBatcher(RecordingPredict(), max_batch_size=4, max_wait_ms=1))
+    assert request(connection, "POST", "/predict", b"21") == (200, {"output": 42})
+    status, stats = request(connection, "GET", "/stats")
+    assert stats["requests"] == 1 and stats["mean_batch_size"] == 1.0
+    status, stats = request(connection, "POST", "/stats/reset")
+    assert stats["requests"] == 0 and stats["mean_batch_size"] == 0.0
+
+
+def test_server_times_out(serve):
+    connection = serve(DynamicBatcher(RecordingPredict(delay=0.5), max_batch_size=1, max_wait_ms=0), timeout=0.1)
+    assert request(connection, "POST", "/predict", b"1")[0] == 504
@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+pytest.importorskip("detectron2")
+
+from aldi.distill import Distiller
+from aldi.memory import BackwardScheduler
+from aldi.trainer import run_model_labeled_unlabeled
+
+
+class ToyDetector(torch.nn.Module):
+    """Stand-in for an ALDI model: takes a list of dicts and returns a dict of losses."""
+    def __init__(self):
+        super().__init__()
+        self.backbone = torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.ReLU())
+        self.head = torch.nn.Linear(32, 1)
+        self.img_align = torch.nn.Linear(32, 1)
+
+    def forward(self, batched_inputs, labeled=True, do_align=False):
+        features = self.backbone(torch.stack([i["x"] for i in batched_inputs]))
+        losses = {"loss_toy": torch.nn.functional.mse_loss(self.head(features), torch.stack([i["y"] for i in batched_inputs]))}
+        if do_align:
+            domain_preds = self.img_align(features)
+            losses["loss_da_img"] = torch.nn.functional.binary_cross_entropy_with_logits(
+                domain_preds, torch.full_like(domain_preds, float(labeled)))
+        return losses
+
+
+def make_trainer(backward_at_end, schedule=None):
+    torch.manual_seed(0)
+    backward_scheduler = None
+    if schedule is not None:
+        backward_scheduler = BackwardScheduler("cpu", 2**30)
+        backward_scheduler.schedule = schedule
+    trainer = SimpleNamespace(model=ToyDetector(), backward_at_end=backward_at_end, model_batch_size=2, batch_sizer=None,
+                              ddp_no_sync=False, backward_scheduler=backward_scheduler,
+                              distiller=Distiller(None, None), backward_losses=[])
+    def do_backward(losses, override=False):
+        trainer.backward_losses.append(losses.item())
+        losses.backward()
+    trainer.do_backward = do_backward
+    return trainer
+
+
+def run_step(trainer, data):
+    loss_dict = run_model_labeled_unlabeled(trainer, data[:6], data[6:12], data[12:], None)
+    if trainer.backward_at_end:
+        sum(loss_dict.values()).backward()
+    return [p.grad.clone() for p in trainer.model.parameters()]
+
+
+@pytest.fixture
+def data():
+    torch.manual_seed(1)
+    return [{"x": torch.randn(16), "y": torch.randn(1)} for _ in range(18)]
+
+
+@pytest.mark.parametrize("schedule", [
+    None,
+    {"source_weak": True, "source_strong": True, "target_weak": True},
+    {"source_weak": True, "source_strong": False, "target_weak": False},
+    {"source_weak": False, "source_strong": True, "target_weak": False},
+    {"source_weak": False, "source_strong": False, "target_weak": True},
+])
+def test_accumulated_gradients_match_fused_backward(data, schedule):
+    fused_grads = run_step(make_trainer(backward_at_end=True), data)
+    grads = run_step(make_trainer(backward_at_end=False, schedule=schedule), data)
+    for g0, g1 in zip(fused_grads, grads):
+        assert torch.allclose(g0, g1, atol=1e-6)
+
+
+def test_deferred_losses_are_only_backpropagated_at_the_end():
+    # every image gives the same loss, so every micro-batch of a phase has the same weighted loss
+    data = [{"x": torch.ones(16), "y": torch.zeros(1)} for _ in range(18)]
+    trainer = make_trainer(backward_at_end=False, schedule={"source_weak": True, "source_strong": False, "target_weak": False})
+    run_step(trainer, data)
+    # source_strong and target_weak call backward for each of their 3 micro-batches; the 3 deferred
+    # source_weak micro-batches (with the same losses as source_strong) are added to the last one
+    losses = trainer.backward_losses
+    assert len(losses) == 6
+    assert losses[:5] == pytest.approx([losses[0]] * 3 + [losses[3]] * 2)
+    assert losses[5] == pytest.approx(losses[3] + 3 * losses[0])
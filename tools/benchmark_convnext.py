@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Compare the forward/backward speed of the ConvNeXt backbone with the default (contiguous)
+memory format and with channels_last (cfg.MODEL.CONVNEXT.CHANNELS_LAST), and check that
+both produce the same outputs. E.g.:
+    python tools/benchmark_convnext.py --device cuda --batch-size 4 --size 1024
+"""
+import argparse
+import time
+
+import torch
+
+from aldi.backbone import ConvNeXt
+
+
+def benchmark(model, x, iters, warmup=2):
+    for i in range(warmup + iters):
+        if i == warmup:
+            if x.device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        outs = model(x)
+        sum(o.float().mean() for o in outs.values()).backward()
+    if x.device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+def main(args):
+    torch.manual_seed(0)
+    x = torch.randn(args.batch_size, 3, args.size, args.size, device=args.device)
+    models = {}
+    for channels_last in [False, True]:
+        torch.manual_seed(0)
+        models[channels_last] = ConvNeXt(depths=args.depths, dims=args.dims, out_features=[0, 1, 2, 3], 
+                                         channels_last=channels_last).to(args.device)
+
+    with torch.no_grad():
+        outs = [models[channels_last].eval()(x) for channels_last in [False, True]]
+    max_diff = max((outs[0][k] - outs[1][k]).abs().max().item() for k in outs[0])
+    print(f"Max output difference between memory formats: {max_diff:.2e}")
+
+    with torch.autocast(args.device, enabled=args.amp):
+        for channels_last, model in models.items():
+            seconds = benchmark(model.train(), x, args.iters)
+            print(f"channels_last={channels_last}: {seconds * 1000:.1f} ms per forward/backward")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--amp", action="store_true")
+    parser.add_argument("--depths", type=int, nargs=4, default=[3, 3, 9, 3])
+    parser.add_argument("--dims", type=int, nargs=4, default=[96, 192, 384, 768])
+    main(parser.parse_args())
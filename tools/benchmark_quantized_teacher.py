@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Compare pseudo-labeling with an int8 quantized teacher (cfg.EMA.QUANTIZE, see aldi/ema.py:quantized_copy) to
+pseudo-labeling with the full precision teacher on CPU: agreement of their pseudo-labels (at
+cfg.DOMAIN_ADAPT.TEACHER.THRESHOLD) and throughput. Uses the EMA weights of MODEL.WEIGHTS and the first images
+of the first unlabeled dataset by default. E.g.:
+    python tools/benchmark_quantized_teacher.py --config-file path/to/config.yaml MODEL.WEIGHTS path/to/model_best.pth
+"""
+import itertools
+import json
+
+import torch
+
+from detectron2.data import build_detection_test_loader
+from detectron2.engine import default_argument_parser
+
+from aldi.ema import quantized_copy
+from aldi.export import benchmark, build_deployable_model
+from aldi.pseudolabeler import pseudo_label_agreement
+from train_net import setup
+
+
+def main(args):
+    cfg = setup(args)
+    cfg.defrost()
+    cfg.MODEL.DEVICE = "cpu"
+    cfg.freeze()
+    dataset = args.dataset or (cfg.DATASETS.UNLABELED + cfg.DATASETS.TEST)[0]
+
+    model = build_deployable_model(cfg, cfg.MODEL.WEIGHTS, use_ema=not args.student)
+    quantized = quantized_copy(model)
+    inputs = [x[0] for x in itertools.islice(build_detection_test_loader(cfg, dataset), args.num_images)]
+    batches = [inputs[i:i + args.batch_size] for i in range(0, len(inputs), args.batch_size)]
+
+    with torch.no_grad():
+        predictions = [p for batch in batches for p in quantized.inference(batch, do_postprocess=False)]
+        reference = [p for batch in batches for p in model.inference(batch, do_postprocess=False)]
+    precision, recall = pseudo_label_agreement(predictions, reference, cfg.DOMAIN_ADAPT.TEACHER.THRESHOLD, args.iou)
+
+    report = {"dataset": dataset, "num_images": len(inputs), "batch_size": args.batch_size,
+              "threshold": cfg.DOMAIN_ADAPT.TEACHER.THRESHOLD, "int8_precision": precision, "int8_recall": recall}
+    for name, m in [("float32", model), ("int8", quantized)]:
+        report[name] = benchmark(lambda batch: m.inference(batch, do_postprocess=False), batches)
+        report[name]["throughput_img_per_s"] *= len(inputs) / len(batches)
+    report["speedup"] = report["float32"]["latency_ms_mean"] / report["int8"]["latency_ms_mean"]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = default_argument_parser()
+    parser.add_argument("--dataset", default=None, help="dataset to pseudo-label (default: the first of DATASETS.UNLABELED)")
+    parser.add_argument("--student", action="store_true", help="use the student weights instead of the EMA weights")
+    parser.add_argument("--num-images", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU at which pseudo-labels of the same class agree")
+    main(parser.parse_args())
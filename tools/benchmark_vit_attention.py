@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Check that ViT attention with fused scaled dot product attention (cfg.VIT.USE_SDPA, see
+aldi.backbone.SDPAAttention) matches Detectron2's explicit attention, including
+relative position biases and gradients, and compare their speed and activation memory. E.g.:
+    python tools/benchmark_vit_attention.py --size 64 --window-size 0   # global attention block
+    python tools/benchmark_vit_attention.py --size 64 --window-size 14  # windowed attention block
+"""
+import argparse
+import copy
+import time
+
+import torch
+from detectron2.modeling.backbone.vit import Block
+
+from aldi.backbone import SDPAAttention
+from aldi.memory import PeakMemoryMeter
+
+
+def run(block, x, iters):
+    """Returns (output, parameter gradients, seconds per forward/backward, activation bytes)."""
+    for i in range(iters + 1):
+        if i == 1:
+            start = time.perf_counter()
+        block.zero_grad()
+        with PeakMemoryMeter(x.device) as meter:
+            out = block(x)
+        out.pow(2).mean().backward()
+    if x.device.type == "cuda":
+        torch.cuda.synchronize()
+    seconds = (time.perf_counter() - start) / iters
+    return out.detach(), [p.grad.clone() for p in block.parameters()], seconds, meter.peak
+
+
+def main(args):
+    torch.manual_seed(0)
+    block = Block(args.dim, args.num_heads, use_rel_pos=True, window_size=args.window_size,
+                  input_size=(args.window_size or args.size,) * 2).to(args.device)
+    # relative position embeddings are initialized to zero; use random values so they are tested
+    for p in [block.attn.rel_pos_h, block.attn.rel_pos_w]:
+        torch.nn.init.trunc_normal_(p, std=0.02)
+    sdpa_block = copy.deepcopy(block)
+    sdpa_block.attn.__class__ = SDPAAttention
+
+    x = torch.randn(args.batch_size, args.size, args.size, args.dim, device=args.device)
+    out, grads, seconds, memory = run(block, x, args.iters)
+    sdpa_out, sdpa_grads, sdpa_seconds, sdpa_memory = run(sdpa_block, x, args.iters)
+
+    max_out_diff = (out - sdpa_out).abs().max().item()
+    max_grad_diff = max((g0 - g1).abs().max().item() for g0, g1 in zip(grads, sdpa_grads))
+    print(f"Max difference: {max_out_diff:.2e} (outputs), {max_grad_diff:.2e} (gradients)")
+    assert max_out_diff < args.atol and max_grad_diff < args.atol, "SDPA attention does not match explicit attention."
+    print(f"Explicit attention: {seconds * 1000:.1f} ms, {memory / 2**20:.1f} MB activations")
+    print(f"SDPA attention:     {sdpa_seconds * 1000:.1f} ms, {sdpa_memory / 2**20:.1f} MB activations")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--size", type=int, default=32, help="feature map size (image size / 16)")
+    parser.add_argument("--window-size", type=int, default=0, help="0 for global attention")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--num-heads", type=int, default=12)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    main(parser.parse_args())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Report the graph breaks torch.compile runs into, for the whole ALDI model (training forward and
+inference) and for each of the submodules in cfg.MODEL.COMPILE.MODULES, which are what
+cfg.MODEL.COMPILE.ENABLED actually compiles (see aldi/model.py:compile_modules).
+Breaks are grouped by reason and by the line of code that caused them, e.g. SaveIO hooks
+(aldi/helpers.py) or the dynamically created ALDI class (aldi/model.py). Uses random images. E.g.:
+    python tools/explain_compile.py --config-file configs/cityscapes/ALDI-Best-Cityscapes.yaml MODEL.DEVICE cpu
+"""
+from collections import Counter
+
+import torch
+
+from detectron2.engine import default_argument_parser
+from detectron2.structures import Boxes, Instances
+
+from aldi.model import build_aldi
+from train_net import setup
+
+
+def random_batch(batch_size, size, num_classes):
+    batch = []
+    for _ in range(batch_size):
+        instances = Instances((size, size))
+        instances.gt_boxes = Boxes(torch.tensor([[size / 4, size / 4, size / 2, size / 2]]))
+        instances.gt_classes = torch.randint(num_classes, (1,))
+        batch.append({"image": torch.randint(256, (3, size, size), dtype=torch.uint8), "height": size, "width": size,
+                      "instances": instances})
+    return batch
+
+
+def report(name, fn, *args, **kwargs):
+    torch._dynamo.reset()
+    explanation = torch._dynamo.explain(fn)(*args, **kwargs)
+    print(f"{name}: {explanation.graph_count} graphs, {explanation.graph_break_count} graph breaks")
+    breaks = Counter()
+    for reason in explanation.break_reasons:
+        frame = reason.user_stack[-1] if reason.user_stack else None
+        location = f"{frame.filename}:{frame.lineno} ({frame.name})" if frame else "unknown location"
+        breaks[(reason.reason.splitlines()[0], location)] += 1
+    for (reason, location), count in breaks.most_common():
+        print(f"  {count}x {reason} at {location}")
+
+
+def capture_inputs(model, module_names, run):
+    """Record the inputs to each named submodule during run()."""
+    inputs, handles = {}, []
+    for name in module_names:
+        try:
+            module = model.get_submodule(name)
+        except AttributeError:
+            print(f"{name}: no such submodule")
+            continue
+        handles.append(module.register_forward_pre_hook(
+            lambda m, args, kwargs, name=name: inputs.setdefault(name, (m, args, kwargs)), with_kwargs=True))
+    run()
+    for handle in handles:
+        handle.remove()
+    return inputs
+
+
+def main(args):
+    cfg = setup(args)
+    cfg.defrost()
+    cfg.MODEL.COMPILE.ENABLED = False
+    model = build_aldi(cfg)
+    batch = random_batch(args.batch_size, args.size, cfg.MODEL.ROI_HEADS.NUM_CLASSES)
+    do_align = cfg.DOMAIN_ADAPT.ALIGN.IMG_DA_ENABLED or cfg.DOMAIN_ADAPT.ALIGN.INS_DA_ENABLED
+
+    model.train()
+    report("Model training forward", model, batch, labeled=True, do_align=do_align)
+    inputs = capture_inputs(model, cfg.MODEL.COMPILE.MODULES, lambda: model(batch, labeled=True, do_align=do_align))
+    for name, (module, module_args, module_kwargs) in inputs.items():
+        report(f"{name} training forward", type(module).forward, module, *module_args, **module_kwargs)
+
+    model.eval()
+    with torch.no_grad():
+        report("Model inference", model.inference, batch, do_postprocess=False)
+        inputs = capture_inputs(model, cfg.MODEL.COMPILE.MODULES, lambda: model.inference(batch, do_postprocess=False))
+        for name, (module, module_args, module_kwargs) in inputs.items():
+            report(f"{name} inference forward", type(module).forward, module, *module_args, **module_kwargs)
+
+
+if __name__ == "__main__":
+    parser = default_argument_parser()
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--size", type=int, default=512)
+    main(parser.parse_args())
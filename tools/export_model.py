@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Export a trained ALDI checkpoint (EMA teacher by default, or the student) to a plain TorchScript or ONNX
+detector that does not depend on the ALDI training code, and compare its CPU latency and throughput
+with the eager model. E.g.:
+    python tools/export_model.py --config-file path/to/config.yaml --output exported/ --format torchscript \\
+        --sample-image path/to/image.jpg MODEL.WEIGHTS path/to/model_best.pth
+
+The exported model takes a float32 image tensor (C, H, W, values in 0-255) in cfg.INPUT.FORMAT that has been resized so that
+its shortest edge is INPUT.MIN_SIZE_TEST (at most INPUT.MAX_SIZE_TEST), and returns flattened predictions in
+the resized image's coordinates. See export_info.json in the output directory.
+"""
+import json
+import logging
+import os
+
+import torch
+
+from detectron2.data import detection_utils
+from detectron2.data import transforms as T
+from detectron2.engine import default_argument_parser
+
+from aldi.ema import quantized_copy
+from aldi.export import (benchmark, build_deployable_model, export_onnx, export_torchscript, exported_predictions,
+                         tracing_adapter)
+from train_net import setup
+
+
+def load_images(cfg, paths, num_images):
+    """Read and resize the sample images (random images if there are none), and repeat them to num_images."""
+    resize = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST)
+    originals = [detection_utils.read_image(p, format=cfg.INPUT.FORMAT) for p in paths]
+    if not originals:
+        originals = [torch.randint(256, (cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST, 3), dtype=torch.uint8).numpy()]
+    images = []
+    for i in range(num_images):
+        original = originals[i % len(originals)]
+        resized = resize.get_transform(original).apply_image(original)
+        images.append((torch.as_tensor(resized.astype("float32").transpose(2, 0, 1)), original.shape[0], original.shape[1]))
+    return images
+
+
+def max_box_difference(a, b):
+    if len(a) != len(b):
+        return None
+    if len(a) == 0:
+        return 0.0
+    return (a.pred_boxes.tensor - b.pred_boxes.tensor).abs().max().item()
+
+
+def main(args):
+    cfg = setup(args)
+    cfg.defrost()
+    cfg.MODEL.DEVICE = "cpu"
+    cfg.freeze()
+    logger = logging.getLogger("aldi")
+    os.makedirs(args.output, exist_ok=True)
+
+    model = build_deployable_model(cfg, cfg.MODEL.WEIGHTS, use_ema=not args.student)
+    if args.quantize:
+        assert args.format == "torchscript", "--quantize is only supported for TorchScript export."
+        model = quantized_copy(model)
+    images = load_images(cfg, args.sample_image, args.num_images)
+    adapter = tracing_adapter(model, images[0][0])
+
+    if args.format == "torchscript":
+        path = os.path.join(args.output, "model.ts")
+        traced = export_torchscript(adapter, images[0][0], path)
+        run_exported = lambda image: traced(image)
+    else:
+        path = os.path.join(args.output, "model.onnx")
+        export_onnx(adapter, images[0][0], path)
+        try:
+            import onnxruntime
+        except ImportError:
+            onnxruntime = None
+            logger.warning("onnxruntime is not installed (e.g. run `pip install onnxruntime`), so the ONNX model is not benchmarked.")
+        if onnxruntime is not None:
+            session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+            run_exported = lambda image: tuple(torch.as_tensor(o) for o in session.run(None, {"image": image.numpy()}))
+        else:
+            run_exported = None
+    logger.info(f"Exported model to {path}")
+
+    info = {
+        "weights": cfg.MODEL.WEIGHTS,
+        "ema": not args.student,
+        "int8": args.quantize,
+        "input_format": cfg.INPUT.FORMAT,
+        "min_size_test": cfg.INPUT.MIN_SIZE_TEST,
+        "max_size_test": cfg.INPUT.MAX_SIZE_TEST,
+        "outputs_schema": str(adapter.outputs_schema),
+    }
+    with open(os.path.join(args.output, "export_info.json"), "w") as f:
+        json.dump(info, f, indent=2)
+
+    # compare the exported model with the eager model on CPU
+    report = {"format": args.format, "num_images": len(images), "torch_threads": torch.get_num_threads()}
+    report["eager"] = benchmark(lambda x: model([{"image": x[0], "height": x[1], "width": x[2]}]), images)
+    if run_exported is not None:
+        report["exported"] = benchmark(lambda x: exported_predictions(adapter, run_exported(x[0]), x[1], x[2]), images)
+        report["speedup"] = report["eager"]["latency_ms_mean"] / report["exported"]["latency_ms_mean"]
+        with torch.no_grad():
+            image, height, width = images[0]
+            eager_instances = model([{"image": image, "height": height, "width": width}])[0]["instances"]
+            exported_instances = exported_predictions(adapter, run_exported(image), height, width)
+        report["max_box_difference"] = max_box_difference(eager_instances, exported_instances)
+    with open(os.path.join(args.output, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = default_argument_parser()
+    parser.add_argument("--output", required=True, help="directory to write the exported model and reports to")
+    parser.add_argument("--format", choices=["torchscript", "onnx"], default="torchscript")
+    parser.add_argument("--student", action="store_true", help="export the student weights instead of the EMA weights")
+    parser.add_argument("--quantize", action="store_true", help="dynamically quantize nn.Linear layers to int8 (see aldi/ema.py:quantized_copy)")
+    parser.add_argument("--sample-image", nargs="*", default=[], help="images used for tracing and benchmarking (default: a random image)")
+    parser.add_argument("--num-images", type=int, default=20, help="number of images to benchmark on")
+    main(parser.parse_args())
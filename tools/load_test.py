@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Generate load for tools/serve.py: --concurrency clients send images to the server back to back, and the
+client-side p50/p95/p99 latency and throughput are reported along with the server's own stats, which are reset
+after the warmup. E.g.:
+    python tools/load_test.py --url http://127.0.0.1:8000 --images path/to/images/ --concurrency 16 --duration 60
+Uses random JPEG images if --images is not given.
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+from PIL import Image
+
+from aldi.serve import LatencyStats
+
+
+def load_images(image_dir, size, num_random=8):
+    """Encoded images from image_dir, or random JPEG images of the given size."""
+    if image_dir:
+        paths = sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir)
+                       if f.lower().endswith((".jpg", ".jpeg", ".png")))
+        assert paths, f"No images found in {image_dir}."
+        return [open(p, "rb").read() for p in paths]
+    images = []
+    for _ in range(num_random):
+        buffer = io.BytesIO()
+        Image.fromarray(np.random.randint(256, size=(size[1], size[0], 3), dtype=np.uint8)).save(buffer, format="JPEG")
+        images.append(buffer.getvalue())
+    return images
+
+
+def client(url, images, offset, end_time, stats, errors):
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    i = offset
+    while time.perf_counter() < end_time:
+        start = time.perf_counter()
+        try:
+            connection.request("POST", "/predict", body=images[i % len(images)],
+                               headers={"Content-Type": "application/octet-stream"})
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection(url.hostname, url.port)
+            ok = False
+        if ok:
+            stats.record(time.perf_counter() - start)
+        else:
+            errors.append(i)
+        i += 1
+    connection.close()
+
+
+def run(url, images, concurrency, duration):
+    stats, errors = LatencyStats(window=10**7), []
+    end_time = time.perf_counter() + duration
+    threads = [threading.Thread(target=client, args=(url, images, i, end_time, stats, errors)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return dict(stats.summary(), errors=len(errors))
+
+
+def server_request(url, method, path):
+    """Send a request without a body to the server and return its JSON response."""
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    connection.request(method, path)
+    ret = json.loads(connection.getresponse().read())
+    connection.close()
+    return ret
+
+
+def main(args):
+    url = urlparse(args.url)
+    images = load_images(args.images, args.size)
+    if args.warmup > 0:
+        run(url, images, args.concurrency, args.warmup)
+    server_request(url, "POST", "/stats/reset")
+    report = {"concurrency": args.concurrency, "duration_s": args.duration, "client": run(url, images, args.concurrency, args.duration)}
+    report["server"] = server_request(url, "GET", "/stats")
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--images", default=None, help="directory of images to send (default: random images)")
+    parser.add_argument("--size", type=int, nargs=2, default=[1024, 512], help="width and height of random images")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of clients sending requests at the same time")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to generate load for")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of load before measuring")
+    main(parser.parse_args())
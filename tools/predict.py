@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Run a trained ALDI checkpoint (EMA weights by default) over a directory of images or a registered dataset, and
+stream its detections to a COCO-format results JSON file or a Parquet file, without computing any metrics.
+Images are decoded by multiple workers and batched by shape (see aldi/predict.py). E.g.:
+    python tools/predict.py --config-file path/to/config.yaml --input path/to/images/ --output predictions.json \\
+        --batch-size 8 MODEL.WEIGHTS path/to/model_best.pth
+
+For directory inputs, the image_id of each detection is the image path relative to the directory, and
+category ids are the model's contiguous class ids (0 to MODEL.ROI_HEADS.NUM_CLASSES - 1). For --dataset,
+category ids are mapped back to that dataset's category ids (if its metadata maps them), as in COCO evaluation.
+Detections below MODEL.ROI_HEADS.SCORE_THRESH_TEST are not kept. With --num-gpus > 1, each process
+predicts a shard of the images and writes its own output file (with the process rank before the extension).
+"""
+import json
+import logging
+import os
+
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.engine import default_argument_parser, launch
+from detectron2.utils import comm
+
+from aldi.export import build_deployable_model
+from aldi.predict import (CocoJsonWriter, ParquetWriter, PredictionMapper, build_prediction_loader, image_dataset_dicts,
+                          run_predictions)
+from train_net import setup
+
+
+def main(args):
+    cfg = setup(args)
+    logger = logging.getLogger("aldi")
+    dataset_dicts = image_dataset_dicts(args.input) if args.input else DatasetCatalog.get(args.dataset)
+    dataset_dicts = dataset_dicts[comm.get_rank()::comm.get_world_size()]
+
+    category_ids = None
+    metadata = MetadataCatalog.get(args.dataset) if args.dataset else None
+    if hasattr(metadata, "thing_dataset_id_to_contiguous_id"):
+        category_ids = {v: k for k, v in metadata.thing_dataset_id_to_contiguous_id.items()}
+
+    output = args.output
+    if comm.get_world_size() > 1:
+        root, ext = os.path.splitext(output)
+        output = f"{root}_{comm.get_rank()}{ext}"
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    writer = ParquetWriter(output) if output.endswith(".parquet") else CocoJsonWriter(output)
+
+    model = build_deployable_model(cfg, cfg.MODEL.WEIGHTS, use_ema=not args.student)
+    num_workers = cfg.DATALOADER.NUM_WORKERS if args.num_workers is None else args.num_workers
+    data_loader = build_prediction_loader(dataset_dicts, PredictionMapper(cfg), args.batch_size, num_workers, args.granularity)
+    try:
+        results = run_predictions(model, data_loader, writer, category_ids)
+    finally:
+        writer.close()
+    logger.info(f"Wrote {results['num_detections']} detections for {results['num_images']} images to {output} "
+                f"({results['images_per_s']:.1f} images/s).")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    parser = default_argument_parser()
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument("--input", help="directory of images to predict on")
+    inputs.add_argument("--dataset", help="name of a registered dataset to predict on")
+    parser.add_argument("--output", required=True, help="output file: COCO results JSON, or Parquet if it ends with .parquet")
+    parser.add_argument("--student", action="store_true", help="use the student weights instead of the EMA weights")
+    parser.add_argument("--batch-size", type=int, default=8, help="images per batch, per process")
+    parser.add_argument("--num-workers", type=int, default=None, help="image decoding workers (default: DATALOADER.NUM_WORKERS)")
+    parser.add_argument("--granularity", type=int, default=64, help="batch images whose sizes round up to the same multiple of this")
+    args = parser.parse_args()
+    launch(
+        main,
+        args.num_gpus,
+        num_machines=args.num_machines,
+        machine_rank=args.machine_rank,
+        dist_url=args.dist_url,
+        args=(args,),
+    )
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Serve a trained ALDI checkpoint (EMA weights by default) over a local HTTP interface, grouping concurrent
+requests into dynamic batches (see aldi/serve.py). Runs on MODEL.DEVICE, e.g. cpu. E.g.:
+    python tools/serve.py --config-file path/to/config.yaml --port 8000 --max-batch-size 8 --max-wait-ms 10 \\
+        MODEL.WEIGHTS path/to/model_best.pth MODEL.DEVICE cpu
+
+    curl --data-binary @image.jpg http://127.0.0.1:8000/predict
+    curl http://127.0.0.1:8000/stats
+
+POST /predict takes an encoded image (e.g. JPEG or PNG) and returns {"instances": [{"category_id", "bbox", "score"}]},
+with boxes in XYWH format in original image coordinates, and the model's contiguous class ids as category ids
+(0 to MODEL.ROI_HEADS.NUM_CLASSES - 1). Requests that take longer than --timeout seconds get a 504 response.
+GET /stats returns p50/p95/p99 latency and throughput, which are also logged every --report-period seconds.
+POST /stats/reset resets them, e.g. after warming up.
+See tools/load_test.py to generate load.
+"""
+import json
+import logging
+import threading
+
+import torch
+
+from detectron2.engine import default_argument_parser
+from detectron2.evaluation.coco_evaluation import instances_to_coco_json
+
+from aldi.ema import quantized_copy
+from aldi.export import build_deployable_model
+from aldi.predict import PredictionMapper
+from aldi.serve import DynamicBatcher, build_server
+from train_net import setup
+
+
+def main(args):
+    cfg = setup(args)
+    logger = logging.getLogger("aldi")
+    # split the CPU threads between the workers, which run concurrently
+    torch.set_num_threads(max(1, torch.get_num_threads() // args.num_workers))
+
+    model = build_deployable_model(cfg, cfg.MODEL.WEIGHTS, use_ema=not args.student)
+    if args.quantize:
+        assert cfg.MODEL.DEVICE == "cpu", "--quantize requires MODEL.DEVICE cpu."
+        model = quantized_copy(model)
+    mapper = PredictionMapper(cfg)
+
+    def postprocess(outputs):
+        records = instances_to_coco_json(outputs["instances"].to("cpu"), None)
+        for r in records:
+            del r["image_id"]
+        return {"instances": records}
+
+    batcher = DynamicBatcher(model, args.max_batch_size, args.max_wait_ms, args.num_workers)
+    server = build_server(batcher, mapper.decode, postprocess, args.host, args.port, args.timeout)
+
+    stop = threading.Event()
+    def report():
+        while not stop.wait(args.report_period):
+            logger.info(f"Serving stats: {json.dumps(batcher.summary())}")
+    threading.Thread(target=report, daemon=True).start()
+
+    logger.info(f"Serving on http://{args.host}:{args.port} with {args.num_workers} workers "
+                f"(max batch size {args.max_batch_size}, max wait {args.max_wait_ms} ms).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        logger.info(f"Final serving stats: {json.dumps(batcher.summary())}")
+
+
+if __name__ == "__main__":
+    parser = default_argument_parser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--student", action="store_true", help="serve the student weights instead of the EMA weights")
+    parser.add_argument("--quantize", action="store_true", help="dynamically quantize nn.Linear layers to int8 (CPU only)")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10, help="how long a request may wait for others to batch with")
+    parser.add_argument("--num-workers", type=int, default=1, help="threads running the model concurrently")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds a request may take before the server responds with 504")
+    parser.add_argument("--report-period", type=float, default=30, help="seconds between logged stats")
+    main(parser.parse_args())
@@ -12,9 +12,8 @@ from detectron2.data import MetadataCatalog
 from detectron2.engine import default_argument_parser, default_setup, launch
 from detectron2.evaluation import verify_results
 
-from aldi.checkpoint import DetectionCheckpointerWithEMA
+from aldi.checkpoint import CompactDetectionCheckpointer, DetectionCheckpointerWithEMA
 from aldi.config import add_aldi_config
-from aldi.ema import EMA
 from aldi.trainer import ALDITrainer
 import aldi.align # register align mixins with Detectron2
 import aldi.datasets # register datasets with Detectron2
@@ -62,13 +61,19 @@ def main(args):
     """
     cfg = setup(args)
 
+    ## Change here
+    if args.dry_run:
+        ALDITrainer.dry_run(cfg)
+        return
+    ## End change
+
     if args.eval_only:
-        model = ALDITrainer.build_model(cfg)
         ## Change here
-        ckpt = DetectionCheckpointerWithEMA(model, save_dir=cfg.OUTPUT_DIR)
-        if cfg.EMA.ENABLED and cfg.EMA.LOAD_FROM_EMA_ON_START:
-            ema = EMA(ALDITrainer.build_model(cfg), cfg.EMA.ALPHA, cfg.EMA.START_ITER)
-            ckpt.add_checkpointable("ema", ema)
+        # all weights come from the checkpoint, so skip random initialization.
+        # if cfg.EMA.LOAD_FROM_EMA_ON_START, the checkpointer loads the EMA weights (if any) into the model
+        model = ALDITrainer.build_model(cfg, init_weights=False)
+        ckpt_cls = DetectionCheckpointerWithEMA if cfg.EMA.LOAD_FROM_EMA_ON_START else CompactDetectionCheckpointer
+        ckpt = ckpt_cls(model, save_dir=cfg.OUTPUT_DIR, mmap=cfg.CHECKPOINT.MMAP_LOAD, require_complete=True)
         ckpt.resume_or_load(cfg.MODEL.WEIGHTS, resume=args.resume)
         ## End change
         res = ALDITrainer.test(cfg, model)
@@ -83,7 +88,9 @@ def main(args):
     return trainer.train()
 
 if __name__ == "__main__":
-    args = default_argument_parser().parse_args()
+    parser = default_argument_parser()
+    parser.add_argument("--dry-run", action="store_true", help="only check that the config is valid; see ALDITrainer.dry_run")
+    args = parser.parse_args()
     print("Command Line Args:", args)
     launch(
         main,
@@ -14,9 +14,8 @@ from detectron2.config import get_cfg
 from detectron2.engine import default_argument_parser, default_setup, launch
 from detectron2.evaluation import inference_on_dataset
 
-from aldi.checkpoint import DetectionCheckpointerWithEMA
+from aldi.checkpoint import CompactDetectionCheckpointer, DetectionCheckpointerWithEMA
 from aldi.config import add_aldi_config
-from aldi.ema import EMA
 from aldi.trainer import ALDITrainer
 import aldi.datasets # register datasets with Detectron2
 import aldi.model # register ALDI R-CNN model with Detectron2
@@ -55,11 +54,10 @@ def main(args):
     cfg = setup(args)
 
     # load model
-    model = ALDITrainer.build_model(cfg)
-    ckpt = DetectionCheckpointerWithEMA(model, save_dir=cfg.OUTPUT_DIR)
-    if cfg.EMA.ENABLED and cfg.EMA.LOAD_FROM_EMA_ON_START:
-        ema = EMA(ALDITrainer.build_model(cfg), cfg.EMA.ALPHA, cfg.EMA.START_ITER)
-        ckpt.add_checkpointable("ema", ema)
+    # if cfg.EMA.LOAD_FROM_EMA_ON_START, the checkpointer loads the EMA weights (if any) into the model
+    model = ALDITrainer.build_model(cfg, init_weights=False)
+    ckpt_cls = DetectionCheckpointerWithEMA if cfg.EMA.LOAD_FROM_EMA_ON_START else CompactDetectionCheckpointer
+    ckpt = ckpt_cls(model, save_dir=cfg.OUTPUT_DIR, require_complete=True)
     ckpt.resume_or_load(cfg.MODEL.WEIGHTS, resume=args.resume)
     
     # feature map options